@@ -1,2 +1,6 @@
 # Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
-# See "LICENSE" file for license.
\ No newline at end of file
+# See "LICENSE" file for license.
+
+# Bump this whenever a change alters converted output, so that cached
+# conversions from older versions are not reused.
+__version__ = '0.2'
@@ -3,6 +3,58 @@
 
 import re
 
+# An array of patterns that should be ignored when adding the get text
+# function. Each one is applied to whatever text the patterns before it left
+# unmatched, so order is important!!!
+# A pattern can also be a [pattern, sub patterns] pair, in which case the
+# sub patterns are applied to the text of each match, see isolate_strings.
+# existing_gettext keeps the get text formatting the template already had
+# from being wrapped again, and comes before the patterns that would split
+# it at its quotes.
+existing_gettext = r'\$\{ *_\(.*?\) *\}'
+to_ignore = [
+        r'<script.*?>.*?</script>',
+        r'<style.*?>.*?</style>',
+        r'<!--.*?-->',
+        r"% if.*?:",
+        r"% elif.*?:",
+        r"% else.*?:",
+        [r'<input.*?(?<=[^%])>',
+            [existing_gettext, r'(?:title|alt)=[\'"](.*?)[\'"]',
+             r'^.*[=<>%]+.*$']],
+        [r'<area.*?(?<=[^%])>',
+            [existing_gettext, r'(?:title|alt)=[\'"](.*?)[\'"]',
+             r'^.*[=<>%]+.*$']],
+        [r'<option.*?(?<=[^%])>',
+            [existing_gettext, r'(?:title|alt)=[\'"](.*?)[\'"]',
+             r'^.*[=<>%]+.*$']],
+        r'<%doc>.*?</%doc>',
+        r'&nbsp;',
+        r'checked\\',
+        r'selected\\',
+        r'display: none;\\',
+        r"</?[^>]+>",
+        r"</?[^>]+\\",
+        r" onclick=.?>",
+        existing_gettext,
+        r"\r?\n",
+        r"\"",
+        r"\\",
+        r'^\s+',
+        r'^\s*% .*',
+        r"\$\{.*?\}",
+        r'^\s+$'
+       ]
+
+
+# Strings that are left bare instead of being wrapped, checked in this order
+# as the spaces and then the parentheses around a string are moved outside
+# of the wrapping, see wrap_text.
+bare_text = frozenset(['>', '/>'])
+bare_spaced_text = frozenset(['(', ')'])
+bare_inner_text = frozenset([':', '*', '-', '%', '[', ']', '|'])
+
+
 def add_intl(template_string):
     """Wraps the language specific text in an html mako template in the
     proper get text formatting.
@@ -11,61 +63,154 @@ def add_intl(template_string):
 
     returns The converted string
     """
-    analyze = [template_string]
-    # An array of patterns that should be ignored
-    # when adding the get text function.
-    # Warning order is important!!!
-    to_ignore = [
-            r'<script.*?>.*?</script>',
-            r'<style.*?>.*?</style>',
-            r'<!--.*?-->',
-            r"% if.*?:",
-            r"% elif.*?:",
-            r"% else.*?:",
-            [r'<input.*?(?<=[^%])>',
-                [r'(?:title|alt)=[\'"](.*?)[\'"]', r'^.*[=<>%]+.*$']],
-            [r'<area.*?(?<=[^%])>',
-                [r'(?:title|alt)=[\'"](.*?)[\'"]', r'^.*[=<>%]+.*$']],
-            [r'<option.*?(?<=[^%])>',
-                [r'(?:title|alt)=[\'"](.*?)[\'"]', r'^.*[=<>%]+.*$']],
-            r'<%doc>.*?</%doc>',
-            r'&nbsp;',
-            r'checked\\',
-            r'selected\\',
-            r'display: none;\\',
-            r"</?[^>]+>",
-            r"</?[^>]+\\",
-            r" onclick=.?>",
-            r"\r?\n",
-            r"\"",
-            r"\\",
-            r'^\s+',
-            r'^\s*% .*',
-            r"\$\{.*?\}",
-            r'^\s+$'
-           ]
-    # Convert the array of IgnoredSections and strings to a array
-    # of just strings with the non ignored ones wrapped in the gettext
-    # formatting
-    analyze = isolate_strings(to_ignore, analyze)
-
-    def flatten_string(res, cur_str):
+    # Convert the template to a array of IgnoredSections and strings, and
+    # then to a array of just strings with the non ignored ones wrapped in
+    # the gettext formatting
+    analyze = lexer.isolate(template_string)
+    res_array = []
+    for cur_str in analyze:
         if isinstance(cur_str, IgnoredSection):
-            res.append(cur_str.val)
+            res_array.append(cur_str.val)
         else:
-            res.append('${ _("%s") }' % cur_str)
-        return res
-    res_array = reduce(flatten_string, analyze, [])
-    # character clean up.
-    res_string = "".join(res_array).replace('${ _(">") }', '>').replace('${ _("/>") }','/>')
-    res_string = res_string.replace('${ _(" ', ' ${ _("').replace(' ") }','") } ')
-    res_string = res_string.replace('${ _("(") }', '(').replace('${ _(")") }', ')')
-    res_string = res_string.replace('${ _("(', '(${ _("').replace(')") }', '") })')
-    res_string = res_string.replace('${ _(":") }', ':').replace('${ _("*") }', '*')
-    res_string = res_string.replace('${ _("-") }', '-').replace('${ _("%") }', '%')
-    res_string = res_string.replace('${ _("[") }', '[').replace('${ _("]") }', ']')
-    res_string = res_string.replace('${ _("|") }', '|')
-    return res_string
+            res_array.append(wrap_text(cur_str))
+    return "".join(res_array)
+
+
+def wrap_text(text):
+    """Wraps one string in the get text formatting.
+
+    Punctuation on its own is left bare, and a leading and a trailing space,
+    then a leading ( and a trailing ), are moved outside of the wrapping.
+
+    example:
+        wrap_text(" (Hello) ") -> ' (${ _("Hello") }) '
+    """
+    if text in bare_text:
+        return text
+    before = after = ''
+    if text[:1] == ' ':
+        before = ' '
+        text = text[1:]
+    if text[-1:] == ' ':
+        after = ' '
+        text = text[:-1]
+    if text in bare_spaced_text:
+        return before + text + after
+    if text[:1] == '(':
+        before += '('
+        text = text[1:]
+    if text[-1:] == ')':
+        after = ')' + after
+        text = text[:-1]
+    if text in bare_inner_text:
+        return before + text + after
+    return '%s${ _("%s") }%s' % (before, text, after)
+
+
+# A character of a pattern that matches only itself
+_literal_r = re.compile(r'\\([^\w\s])|([^\\.^$*+?{}\[\]()|])')
+
+
+def _required_text(regex):
+    """Returns literal text that every match of regex starts with, so that
+    strings without it need not be searched. This is '' when the pattern
+    does not start with plain text.
+    """
+    if '|' in regex:
+        return ''
+    literal = []
+    pos = 0
+    match = _literal_r.match(regex)
+    while match is not None:
+        literal.append(match.group(1) or match.group(2))
+        pos = match.end()
+        match = _literal_r.match(regex, pos)
+    if literal and regex[pos:pos + 1] in ('*', '+', '?', '{'):
+        # the last character is optional or repeated
+        literal.pop()
+    return ''.join(literal)
+
+
+class Lexer(object):
+    """Splits strings into text and IgnoredSections with a to_ignore list,
+    compiled once.
+
+    Every pattern is applied to the text the patterns before it left
+    unmatched. Rather than running each pattern over the whole document
+    before moving on to the next, the lexer goes depth first: a piece of
+    text is passed down the list of patterns until one matches, and the
+    pieces around and inside the match carry on from the next pattern.
+    The result is the same, but it is built left to right in one go
+    instead of being rebuilt once per pattern.
+    """
+    flags = re.M | re.S
+
+    def __init__(self, to_ignore):
+        self.layers = []
+        for regex in to_ignore:
+            sub_lexer = None
+            if isinstance(regex, list):
+                regex, sub_exs = regex
+                sub_lexer = Lexer(sub_exs)
+            self.layers.append((re.compile(regex, self.flags), sub_lexer,
+                                _required_text(regex)))
+
+    def isolate(self, string, analyzed_list=None):
+        """Returns string split into strings and IgnoredSection objects,
+        appended to analyzed_list if given.
+        """
+        if analyzed_list is None:
+            analyzed_list = []
+        self._isolate(string, 0, analyzed_list)
+        return analyzed_list
+
+    def _isolate(self, string, k, analyzed_list):
+        """Applies the patterns from k on to string"""
+        layers = self.layers
+        if not string and k < len(layers):
+            # an empty string has nothing left in it to match
+            return
+        while k < len(layers):
+            regex, sub_lexer, required = layers[k]
+            if required not in string:
+                k += 1
+                continue
+            matches = regex.finditer(string)
+            match = next(matches, None)
+            if match is None:
+                # nothing matched, try the next pattern
+                k += 1
+                continue
+            k += 1
+            cur_index = 0
+            matched = []
+            while match is not None:
+                #Split in around the matches and set the matches to ignore
+                start = match.start()
+                if cur_index != start:
+                    self._isolate(string[cur_index:start], k, analyzed_list)
+                if sub_lexer is not None:
+                    sub_lexer.isolate(match.group(0), matched)
+                elif regex.groups:
+                    _analyze_groups(match, matched)
+                else:
+                    analyzed_list.append(IgnoredSection(match.group()))
+                if matched:
+                    for item in matched:
+                        if isinstance(item, IgnoredSection):
+                            analyzed_list.append(item)
+                        else:
+                            self._isolate(item, k, analyzed_list)
+                    del matched[:]
+                cur_index = match.end()
+                match = next(matches, None)
+            if cur_index != len(string):
+                self._isolate(string[cur_index:], k, analyzed_list)
+            return
+        analyzed_list.append(string)
+
+lexer = Lexer(to_ignore)
+
 
 def isolate_strings(to_ignore, analyze):
     """Takes the array of reg_ex's in to_ignore and applies them
@@ -86,52 +231,13 @@ def isolate_strings(to_ignore, analyze):
 
     returns An array of strings and Ignorable section objects.
     """
-    for regex in to_ignore:
-        def analyze_string(analyze_list, cur_str):
-            if not isinstance(cur_str, IgnoredSection):
-                sec_ex = None
-                pri_ex = regex
-                if type(pri_ex).__name__ == 'list':
-                    pri_ex = regex[0]
-                    sec_ex = regex[1]
-                matches = analyze_matches(pri_ex, cur_str, sec_ex)
-                for item in matches:
-                    analyze_list.append(item)
-            else:
-                analyze_list.append(cur_str)
-            return analyze_list
-
-        analyze = reduce(analyze_string, analyze, [])
-    return analyze
-
-def analyze_matches(regex, string, sec_exs=None):
-    """Splits the string based on the regex and returns a list containing the
-    split string along with the matched tokes as IgnoredSection objects.
-
-    regex -- The regular expression pattern to match on.
-    string -- The string to analyze
-
-    example:
-        analyze_matches("\n", "test\nstring")
-                -> ["test", IgnoredSection("\n"), "string"]
-    """
+    string_lexer = Lexer(to_ignore)
     analyzed_list = []
-    cur_index = 0
-    for match in re.finditer(regex, string, (re.M | re.S)):
-        #Split in around the matches and set the matches to ignore
-        start = match.start()
-        end = match.end()
-        if(cur_index != start):
-            analyzed_list.append(string[cur_index:start])
-
-        if sec_exs is None:
-            _analyze_groups(match, analyzed_list)
+    for cur_str in analyze:
+        if isinstance(cur_str, IgnoredSection):
+            analyzed_list.append(cur_str)
         else:
-            analyzed_list += isolate_strings(sec_exs, [match.group(0)])
-        cur_index=end
-
-    if cur_index != len(string):
-        analyzed_list.append(string[cur_index:len(string)])
+            string_lexer.isolate(cur_str, analyzed_list)
     return analyzed_list
 
 def _analyze_groups(match, analyzed_list):
@@ -0,0 +1,200 @@
+# Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
+# See "LICENSE" file for license.
+
+"""Converts whole template trees, optionally across a pool of processes."""
+import errno
+import glob
+import logging
+import multiprocessing
+import os
+
+import expressions
+from addintl import add_intl
+from converter import Converter
+
+# The cache entry of the BranchFolder stats of a result is its key with this
+# added
+_fold_suffix = '.fold'
+
+
+def convert_string(cs_data, do_conv=True, do_intl=True, cache=None,
+                   hoist=False, folder=None):
+    """Runs the conversion steps selected by do_conv and do_intl on a string
+    of ClearSilver and returns the result.
+
+    hoist -- Bind repeated HDF paths to locals as the template is
+        converted, see Converter.
+    folder -- An optional BranchFolder, which removes the branches its
+        constants rule out as the template is converted, see Converter.
+
+    cache -- An optional ConversionCache. A stored result for the same
+        contents and options is returned without converting, and new
+        results are stored. With a folder, what it did is stored too, and
+        added to its stats on a hit.
+    """
+    if cache is not None:
+        constants = folder.digest() if folder is not None else None
+        key = cache.key(cs_data, do_conv, do_intl, hoist, constants)
+        result = cache.get(key)
+        if result is not None and folder is not None:
+            folded = cache.get(key + _fold_suffix)
+            if folded is None:
+                # Converted again, so that the stats are right
+                result = None
+            else:
+                folder.count(*map(int, folded.split()))
+        if result is not None:
+            return result
+    if folder is not None:
+        before = folder.stats()
+    if do_conv:
+        result = Converter(cs_data, hoist, folder).convert()
+    else:
+        result = cs_data
+    if do_intl:
+        result = add_intl(result)
+    if cache is not None:
+        cache.put(key, result)
+        if folder is not None:
+            cache.put(key + _fold_suffix, '%d %d %d' % tuple(
+                after - start
+                for start, after in zip(before, folder.stats())))
+    return result
+
+
+def _glob_root(pattern):
+    """Returns the directory that the files matched by pattern are made
+    relative to: the longest leading part of pattern without wildcards.
+    """
+    root = os.path.dirname(pattern)
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    return root or os.curdir
+
+
+def find_templates(paths):
+    """Yields (source, relative_path) for every file named by paths.
+
+    paths -- A list of files, directories or glob patterns. Directories are
+        walked recursively and relative_path is relative to the directory,
+        so the output can mirror the input tree. Files and glob matches are
+        relative to the part of the path before the first wildcard.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            roots = [(path, path)]
+        else:
+            root = _glob_root(path)
+            roots = [(match, root) for match in sorted(glob.glob(path))]
+        for match, root in roots:
+            if not os.path.isdir(match):
+                yield match, os.path.relpath(match, root)
+                continue
+            for dirpath, dirnames, filenames in os.walk(match):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    source = os.path.join(dirpath, filename)
+                    yield source, os.path.relpath(source, root)
+
+
+def convert_file(job):
+    """Converts one file. This is the unit of work handed to the pool.
+
+    job -- A (source, target, do_conv, do_intl, cache, hoist, folder)
+        tuple.
+
+    returns (source, error, stats) where error is None on success, or a
+    message, and stats are the (hits, misses) this file added to the
+    expression cache of the process, followed by the (conditions,
+    branches, removed) it added to the stats of the folder.
+    """
+    source, target, do_conv, do_intl, cache, hoist, folder = job
+    hits, misses = expressions.cache.hits, expressions.cache.misses
+    folded = folder.stats() if folder is not None else (0, 0, 0)
+    try:
+        with open(source, 'r') as f:
+            cs_data = f.read()
+        result = convert_string(cs_data, do_conv, do_intl, cache, hoist,
+                                folder)
+        target_dir = os.path.dirname(target)
+        if target_dir:
+            try:
+                os.makedirs(target_dir)
+            except OSError, e:
+                # Another worker may have made it first.
+                if e.errno != errno.EEXIST:
+                    raise
+        with open(target, 'w') as f:
+            f.write(result)
+        error = None
+    except Exception, e:
+        logging.debug("Converting %s failed", source, exc_info=True)
+        error = "%s: %s" % (e.__class__.__name__, e)
+    stats = (expressions.cache.hits - hits, expressions.cache.misses - misses)
+    stats += tuple(
+        after - before for before, after
+        in zip(folded, folder.stats() if folder is not None else folded))
+    return source, error, stats
+
+
+def convert_tree(paths, output_dir, jobs=1, do_conv=True, do_intl=True,
+                 cache=None, stats=None, hoist=False, folder=None):
+    """Converts every template found under paths into output_dir.
+
+    paths -- Files, directories or glob patterns, see find_templates.
+    output_dir -- The converted files are written here, mirroring the
+        layout of the input.
+    jobs -- The number of worker processes. With 1 everything is converted
+        in this process.
+    cache -- An optional ConversionCache shared by the workers. It is pruned
+        back to its size limit once every file is done.
+    stats -- An optional dict. The expression cache hits and misses of all
+        the workers are added up in it under 'expression_hits' and
+        'expression_misses'. With a folder, what it did is added up under
+        'folded_conditions', 'removed_branches' and 'removed_bytes'.
+    hoist, folder -- See convert_string. Each worker has a copy of the
+        folder, so only stats has the totals.
+
+    Yields (source, error) pairs as files finish, in no particular order
+    when jobs > 1. error is None for files that converted cleanly.
+    """
+    work = [
+        (source, os.path.join(output_dir, relative), do_conv, do_intl, cache,
+         hoist, folder)
+        for source, relative in find_templates(paths)
+    ]
+    if stats is None:
+        stats = {}
+    stats.setdefault('expression_hits', 0)
+    stats.setdefault('expression_misses', 0)
+    folded_keys = ('folded_conditions', 'removed_branches', 'removed_bytes')
+    if folder is not None:
+        for name in folded_keys:
+            stats.setdefault(name, 0)
+
+    def collect(result):
+        source, error, file_stats = result
+        stats['expression_hits'] += file_stats[0]
+        stats['expression_misses'] += file_stats[1]
+        if folder is not None:
+            for name, count in zip(folded_keys, file_stats[2:]):
+                stats[name] += count
+        return source, error
+
+    if jobs <= 1 or len(work) <= 1:
+        for job in work:
+            yield collect(convert_file(job))
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            chunksize = max(1, len(work) // (jobs * 4))
+            for result in pool.imap_unordered(convert_file, work, chunksize):
+                yield collect(result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    if cache is not None:
+        cache.prune()
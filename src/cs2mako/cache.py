@@ -0,0 +1,130 @@
+# Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
+# See "LICENSE" file for license.
+
+"""On-disk cache of converted templates, so unchanged files are not converted
+again on the next run.
+"""
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+
+from cs2mako import __version__
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+
+class ConversionCache(object):
+    """Stores conversion results in a directory, one file per entry.
+
+    Entries are keyed on a hash of the template contents, the converter
+    version and the conversion options, so any change to one of them is a
+    miss. The modification time of an entry is bumped on every hit and
+    prune() removes the least recently used entries once the directory
+    grows past max_size bytes.
+
+    The cache only holds plain attributes so that it can be handed to
+    batch worker processes.
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, cs_data, do_conv, do_intl, hoist=False, constants=None):
+        """Returns the cache key for converting cs_data with these options
+
+        constants -- The digest() of the BranchFolder, if any.
+        """
+        options = "%d%d" % (do_conv, do_intl)
+        # Added only when set, so entries from before stay valid
+        if hoist:
+            options += 'h'
+        if constants is not None:
+            options += 'c' + constants
+        digest = hashlib.sha1()
+        digest.update("%s\0%s\0" % (__version__, options))
+        digest.update(cs_data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Returns the stored result for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = f.read()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            # Mark the entry as recently used for prune().
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """Stores result under key.
+
+        The entry is written to a temporary file and renamed into place, so
+        concurrent workers never see a partial entry.
+        """
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(result)
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def _entries(self):
+        """Yields (mtime, size, path) for every entry in the cache"""
+        if not os.path.isdir(self.directory):
+            return
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def prune(self):
+        """Evicts least recently used entries until the cache fits in
+        max_size. Returns the number of entries removed.
+        """
+        entries = sorted(self._entries())
+        total = sum(size for mtime, size, path in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        logging.debug("Pruned %d cache entries, %d bytes left", removed, total)
+        return removed
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        for mtime, size, path in list(self._entries()):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
@@ -0,0 +1,333 @@
+# Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
+# See "LICENSE" file for license.
+
+"""Compiles ClearSilver templates straight to Python render functions.
+
+The converter writes Mako, and Mako lexes that text again to compile it to
+Python. generate() writes the Python from the token stream instead, much
+as Mako would have written it:
+
+    <?cs var:html_escape(x) ?>   -> write(_html_escape(unicode(x)))
+    <?cs if:x ?>                 -> if x:
+    <?cs each:item = x.items ?>  -> for item in x.items:
+    <?cs set:x.y = #1 ?>         -> hdf.set_value("x.y", int(1))
+
+A compiled template is a function of (write, get). write takes each piece
+of output, and get(name) returns the value of a name the template uses,
+once per render, as Context.get does for Mako:
+
+    render = compile_template(cs_data, 'events/page.html')
+    out = []
+    render(out.append, get)
+
+Expressions are rewritten as the converter rewrites them. Strings are not
+wrapped for gettext, as add_intl would.
+
+"""
+import __builtin__
+import ast
+
+from mako import filters
+
+import tokens
+from converter import tokenize
+
+
+# The module globals of every compiled template
+template_globals = {
+    '_html_escape': filters.html_escape,
+    '_url_escape': filters.url_escape,
+}
+
+# Mako filters that are functions of template_globals. Any other filter is
+# a name the template gets, like striptags.
+filter_functions = {'h': '_html_escape', 'u': '_url_escape'}
+
+# Names of the generated code itself, which are never looked up with get
+reserved_names = frozenset(['write', 'get', '_alt'] +
+                           filter_functions.values())
+
+_indent = '    '
+
+# How Open_set writes below a root
+_set_value = 'hdf.set_value("'
+
+
+class _Rebind(object):
+    """Gets a root of the Hdf again after <?cs set ?> wrote below it, see
+    _Generator.set
+    """
+    def __init__(self, depth, root):
+        self.depth = depth
+        self.root = root
+
+
+class _Scope(object):
+    """The Python function of the template or of a def"""
+    def __init__(self, header, params=()):
+        self.header = header
+        self.params = set(params)
+        # Names the code reads and assigns
+        self.loads = set()
+        self.stores = set()
+        # (depth, line) pairs and _Rebinds
+        self.lines = []
+
+
+class _Generator(object):
+    """Turns the token stream of a template into Python source, see
+    generate()
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.main = self.scope = _Scope('def render(write, get):')
+        self.defs = []
+        self.def_names = set()
+        # The open blocks: [close name, scope, depth of the body, where the
+        # body starts in scope.lines, (scope, depth) to resume after a def]
+        self.blocks = []
+        self.depth = 1
+        self.text = []
+        self.tags = {
+            tokens.Open_var: self.var,
+            tokens.Open_set: self.set,
+            tokens.Open_include: self.include,
+            tokens.Open_comment: self.comment,
+            tokens.Open_def: self.def_,
+            tokens.Open_name: self.name,
+            tokens.Open_call: self.call,
+            tokens.Open_if: self.if_,
+            tokens.Open_elif: self.elif_,
+            tokens.Open_elseif: self.elif_,
+            tokens.Open_else: self.else_,
+            tokens.Open_alt: self.alt,
+            tokens.Open_each: self.each,
+            tokens.Open_loop: self.each,
+        }
+
+    def error(self, message):
+        return ValueError('%s: %s' % (self.filename, message))
+
+    def run(self, stream):
+        tags = self.tags
+        for token in stream:
+            cls = token.__class__
+            if cls is tokens.Char or cls is tokens.StopToken:
+                # A ?> outside a tag is text, as in the converted Mako
+                self.text.append(token.token)
+            elif cls is tokens.CloseToken:
+                self.close(token)
+            else:
+                tag = tags.get(cls)
+                if tag is None:
+                    raise self.error('can not compile <?cs %s ?>' % (
+                        token.name,))
+                tag(token, self.tag_part(token, stream))
+        if self.blocks:
+            raise self.error('<?cs %s ?> is not closed' % (
+                self.blocks[-1][0],))
+        self.flush()
+
+    def tag_part(self, token, stream):
+        """Returns the text between an open token and its ?>"""
+        pieces = []
+        for part in stream:
+            if part.__class__ is tokens.StopToken:
+                return ''.join(pieces).strip()
+            if part.__class__ is not tokens.Char:
+                break
+            pieces.append(part.token)
+        raise self.error('%s has no ?>' % (token.token,))
+
+    def flush(self):
+        if self.text:
+            text = ''.join(self.text).decode('utf-8')
+            self.text = []
+            if text:
+                self.line('write(%r)' % (text,))
+
+    def parse(self, source, mode='eval'):
+        try:
+            return ast.parse(source, mode=mode)
+        except SyntaxError, e:
+            raise self.error('%s in %r' % (e.msg, source))
+
+    def names(self, source, mode='eval'):
+        """Notes the names source reads and assigns in the current scope"""
+        tree = self.parse(source, mode)
+        scope = self.scope
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                if isinstance(node.ctx, (ast.Store, ast.Param)):
+                    scope.stores.add(node.id)
+                else:
+                    scope.loads.add(node.id)
+
+    def line(self, line):
+        self.scope.lines.append((self.depth, line))
+
+    def statement(self, line):
+        self.flush()
+        self.names(line, 'exec')
+        self.line(line)
+
+    def open(self, close_name, header):
+        self.flush()
+        self.line(header)
+        self.depth += 1
+        self.blocks.append([close_name, self.scope, self.depth,
+                            len(self.scope.lines), None])
+
+    def end_block(self):
+        """Ends the body of the innermost block, which must not be empty"""
+        self.flush()
+        scope, start = self.blocks[-1][1], self.blocks[-1][3]
+        if len(scope.lines) == start:
+            self.line('pass')
+        self.depth -= 1
+
+    def close(self, token):
+        if not self.blocks or self.blocks[-1][0] != token.name:
+            # Left as text, as in the converted Mako
+            self.text.append(token.token)
+            return
+        close_name, scope, depth, start, resume = self.blocks[-1]
+        if close_name == 'def':
+            self.flush()
+            self.line("return u''")
+        self.end_block()
+        self.blocks.pop()
+        if resume is not None:
+            self.scope, self.depth = resume
+
+    def var(self, token, source):
+        expression = token.sanitize_expression(source)
+        expression, applied_filters = tokens.extract_filters(expression)
+        code = 'unicode(%s)' % (expression,)
+        for name in applied_filters:
+            code = '%s(%s)' % (filter_functions.get(name, name), code)
+        self.statement('write(%s)' % (code,))
+
+    def set(self, token, source):
+        buf = []
+        token.emit_tag(None, buf, [source])
+        line = ''.join(buf).strip()
+        self.statement(line)
+        if line.startswith(_set_value):
+            key = line[len(_set_value):line.index('"', len(_set_value))]
+            # A root that was missing is there now, and a node of an
+            # HdfOverlay is a copy once it is written
+            self.scope.lines.append(_Rebind(self.depth, key.split('.')[0]))
+
+    def include(self, token, source):
+        self.statement('include(%s)' % (source,))
+
+    def comment(self, token, source):
+        pass
+
+    def def_(self, token, source):
+        function = self.parse('def %s: pass' % (source,), 'exec').body[0]
+        params = [node.id for node in ast.walk(function.args)
+                  if isinstance(node, ast.Name)]
+        self.flush()
+        # Defs are functions of the template, wherever they are, like the
+        # defs of Mako
+        self.def_names.add(function.name)
+        scope = _Scope('def %s:' % (source,), params)
+        self.defs.append(scope)
+        self.blocks.append(['def', scope, 1, 0, (self.scope, self.depth)])
+        self.scope = scope
+        self.depth = 1
+
+    def name(self, token, source):
+        self.statement('write(unicode(name(%s)))' % (source,))
+
+    def call(self, token, source):
+        self.statement('write(unicode(%s))' % (source,))
+
+    def if_(self, token, source):
+        expression = token.sanitize_expression(source)
+        self.names(expression)
+        self.open('if', 'if %s:' % (expression,))
+
+    def branch(self, header):
+        if not self.blocks or self.blocks[-1][0] != 'if':
+            raise self.error('%s is not in an if' % (header,))
+        self.end_block()
+        self.line(header)
+        self.depth += 1
+        self.blocks[-1][3] = len(self.scope.lines)
+
+    def elif_(self, token, source):
+        expression = token.sanitize_expression(source)
+        self.names(expression)
+        self.branch('elif %s:' % (expression,))
+
+    def else_(self, token, source):
+        self.branch('else:')
+
+    def alt(self, token, source):
+        expression = token.sanitize_expression(source)
+        self.names(expression)
+        self.flush()
+        self.line('_alt = %s' % (expression,))
+        self.line('if _alt:')
+        self.depth += 1
+        self.line('write(unicode(_alt))')
+        self.depth -= 1
+        self.open('alt', 'else:')
+
+    def each(self, token, source):
+        expression = token.sanitize_expression(source)
+        self.names('for %s: pass' % (expression,), 'exec')
+        self.open(token.name, 'for %s:' % (expression,))
+
+    def source(self):
+        lines = ['# -*- coding: utf-8 -*-']
+        self.assemble(self.main, 0, lines, self.defs, self.def_names)
+        lines.append('')
+        return '\n'.join(lines)
+
+    def assemble(self, scope, depth, out, defs, def_names):
+        local_names = scope.params | scope.stores
+        body = []
+        for entry in scope.lines:
+            if isinstance(entry, _Rebind):
+                if entry.root in local_names:
+                    continue
+                scope.loads.add(entry.root)
+                entry = (entry.depth,
+                         '%s = get(%r)' % (entry.root, entry.root))
+            body.append(_indent * (depth + entry[0]) + entry[1])
+        free = (scope.loads - local_names - def_names - reserved_names -
+                set(__builtin__.__dict__))
+        pad = _indent * (depth + 1)
+        out.append(_indent * depth + scope.header)
+        for name in sorted(free):
+            out.append('%s%s = get(%r)' % (pad, name, name))
+        for function in defs:
+            self.assemble(function, depth + 1, out, (), def_names)
+        out.extend(body)
+        if not (body or free or defs):
+            out.append(pad + 'pass')
+
+
+def generate(cs_data, filename='<template>'):
+    """Returns the Python source of the render function of the ClearSilver
+    template cs_data, see the module docstring.
+
+    Raises ValueError for templates that can not be compiled.
+    """
+    if isinstance(cs_data, unicode):
+        cs_data = cs_data.encode('utf-8')
+    generator = _Generator(filename)
+    generator.run(iter(tokenize(cs_data)))
+    return generator.source()
+
+
+def compile_template(cs_data, filename='<template>'):
+    """Returns the render function of the ClearSilver template cs_data"""
+    namespace = dict(template_globals)
+    code = compile(generate(cs_data, filename), filename, 'exec')
+    exec code in namespace
+    return namespace['render']
@@ -7,13 +7,14 @@ import re
 
 import patterns
 import tokens
+from hoist import hoist_paths
 
 
 def open_token(scanner, token):
     """This is a factory for OpenToken objects"""
     match = patterns.open_r.search(token)
     name = match.group(1)
-    logging.debug("Opening token %s" % name)
+    logging.debug("Opening token %s", name)
     if not match:
         raise ValueError("token (%s) not okay." % (token,))
     Class = getattr(tokens, "Open_" + name, tokens.OpenToken)
@@ -31,9 +32,233 @@ scanner = re.Scanner(
     flags=re.MULTILINE,
 )
 
+tag_tokens = {
+    'open': open_token,
+    'comment': tokens.Open_comment,
+    'else': tokens.Open_else,
+    'close': tokens.CloseToken,
+    'stop': tokens.StopToken,
+}
+
+
+# Lines that only hold a line continuation, left behind by the if/each
+# indentation. post_process removes them.
+continuation_r = re.compile(r"^[ \t]*\\\r?\n", re.MULTILINE)
+
+# How much of the input convert_stream reads at a time
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def tokenize(s):
+    """Yields the token stream for the string s in a single pass.
+
+    patterns.tag_r finds the next tag boundary and everything in between is
+    yielded as one Char slice, so no per-character tokens are built. The
+    stream is the same as tokenize_lines(s), including the trailing empty
+    Char.
+
+    """
+    pos = 0
+    for match in patterns.tag_r.finditer(s):
+        start = match.start()
+        if start != pos:
+            yield tokens.Char(None, s[pos:start])
+        yield tag_tokens[match.lastgroup](None, match.group())
+        pos = match.end()
+    if pos != len(s):
+        yield tokens.Char(None, s[pos:])
+    # LR(1) peek make last token get stuck as pending after StopIteration
+    yield tokens.Char(None, '')
+
+
+def read_lines(infile, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the contents of infile in pieces of about chunk_size that
+    each end on a line break, apart from the last one.
+    """
+    # Pieces of the current, unfinished line
+    pending = []
+    while True:
+        chunk = infile.read(chunk_size)
+        if not chunk:
+            break
+        end = chunk.rfind('\n') + 1
+        if not end:
+            pending.append(chunk)
+            continue
+        pending.append(chunk[:end])
+        yield ''.join(pending)
+        pending = [chunk[end:]]
+    rest = ''.join(pending)
+    if rest:
+        yield rest
+
+
+def tokenize_stream(infile, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the same token stream as tokenize(infile.read()), reading
+    infile a chunk at a time.
+
+    Tags never span a line, so each chunk can be scanned on its own as long
+    as it ends on a line break. The text either side of a chunk boundary is
+    glued back into one Char, because some tags treat every token of their
+    tag part separately.
+
+    """
+    # Text since the last tag, which may run on into the next chunk
+    text = []
+    for chunk in read_lines(infile, chunk_size):
+        pos = 0
+        for match in patterns.tag_r.finditer(chunk):
+            start = match.start()
+            if start != pos:
+                text.append(chunk[pos:start])
+            if text:
+                yield tokens.Char(None, ''.join(text))
+                text = []
+            yield tag_tokens[match.lastgroup](None, match.group())
+            pos = match.end()
+        if pos != len(chunk):
+            text.append(chunk[pos:])
+    if text:
+        yield tokens.Char(None, ''.join(text))
+    # LR(1) peek make last token get stuck as pending after StopIteration
+    yield tokens.Char(None, '')
+
+
+class ContinuationFilter(object):
+    """Writes converted text to outfile as it is appended, with the same
+    cleanup as Converter.post_process.
+
+    continuation_r only ever matches whole lines, so once about
+    buffer_size bytes are pending the complete lines are filtered and
+    written, and only the last, unfinished line is held back.
+    """
+    def __init__(self, outfile, buffer_size=DEFAULT_CHUNK_SIZE):
+        self._write = outfile.write
+        self._buffer_size = buffer_size
+        self._pending = []
+        # How many of the pending pieces are known not to hold a line break
+        self._clean = 0
+        # Bytes appended since the last flush()
+        self._size = 0
+
+    def append(self, text):
+        self._pending.append(text)
+        self._size += len(text)
+        if self._size >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Writes out every complete line that is pending"""
+        pending = self._pending
+        self._size = 0
+        for i in xrange(len(pending) - 1, self._clean - 1, -1):
+            end = pending[i].rfind('\n') + 1
+            if end:
+                break
+        else:
+            self._clean = len(pending)
+            return
+        lines = pending[:i]
+        lines.append(pending[i][:end])
+        self._write(continuation_r.sub('', ''.join(lines)))
+        self._pending = [pending[i][end:]]
+        self._pending.extend(pending[i + 1:])
+        self._clean = len(self._pending)
+
+    def close(self):
+        self.flush()
+        self._write(''.join(self._pending))
+        self._pending = []
+        self._clean = 0
+
+
+def tokenize_lines(s):
+    """The original line-by-line tokenizer, built on scanner.
+
+    Every unmatched character comes out of re.Scanner as its own Char, and
+    runs of them are glued back together here. Kept as the reference for
+    tokenize() in the tests and benchmarks.
+
+    """
+    def scan(s):
+        first_line = True
+        for line in s.split("\n"):
+            logging.debug("Current Line:%s", line)
+            if first_line is not True:
+                yield tokens.Char(None, "\n")
+            else:
+                first_line = False
+            scanned_tokens = scanner.scan(line)[0]
+            for token in scanned_tokens:
+                yield token
+
+    last_char = None
+
+    for token in scan(s):
+        if isinstance(token, tokens.Char):
+            if last_char is None:
+                last_char = []
+            last_char.append(token.token)
+        else:
+            if last_char is not None:
+                yield tokens.Char(None, ''.join(last_char))
+                last_char = None
+            yield token
+    if last_char is not None:
+        yield tokens.Char(None, ''.join(last_char))
+    # LR(1) peek make last token get stuck as pending after StopIteration
+    yield tokens.Char(None, '')
+
+
+class TokenCursor(object):
+    """The parser's view of the token stream, with one token of lookahead.
+
+    The emit methods of the tokens pull their contents with next() and look
+    ahead with peek(). nest_depth tracks how deeply the current if/each/loop
+    is nested, for indenting the generated Mako.
+
+    Like the end of the stream, next() raises StopIteration as soon as there
+    is no token left to peek at, so the last token never comes out (the
+    tokenizers end with an empty Char for that reason).
+    """
+    __slots__ = ('_next', '_peek', '_debug', 'count', 'nest_depth')
+
+    def __init__(self, tokens):
+        self._next = iter(tokens).next
+        # Checked once here rather than formatting a message per token
+        self._debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.count = 0
+        self.nest_depth = -1
+        self._peek = self._next()
+
+    def peek(self):
+        """Returns the next token without consuming it"""
+        return self._peek
+
+    def next(self):
+        """Consumes and returns the next token"""
+        token = self._peek
+        self.count += 1
+        if self._debug:
+            logging.debug("Emitting: %s", token)
+        self._peek = self._next()
+        return token
+
+
 class Converter(object):
-    def __init__(self, input_string):
+    """Converts a ClearSilver template to Mako.
+
+    hoist -- Bind the HDF paths the template looks up more than once to
+        locals, see hoist.py. This needs the whole template, so
+        convert_stream() does not do it.
+    folder -- An optional fold.BranchFolder, which removes the branches
+        that its constants rule out. Like hoist, it needs the whole
+        template.
+    """
+    def __init__(self, input_string, hoist=False, folder=None):
         self.input_string = input_string
+        self.hoist = hoist
+        self.folder = folder
 
     def tokenize(self):
         """takes input string and yields the token list
@@ -45,82 +270,49 @@ class Converter(object):
                     PDA on token
                 ...
 
-        Uses a few generators to get around the fact that re.Scanner
-        doesn't seem to support multiline, and non-match tokens need
-        to be tokenized into a generic single-character token.
-
         """
-        def tokenize(s):
-            first_line = True
-            for line in s.split("\n"):
-                logging.debug("Current Line:%s" % line)
-                if first_line is not True:
-                    yield tokens.Char(None, "\n")
-                else:
-                    first_line = False
-                scanned_tokens = scanner.scan(line)[0]
-                for token in scanned_tokens:
-                    yield token
-
-        last_char = None
-
-        for token in tokenize(self.input_string):
-            if isinstance(token, tokens.Char):
-                if last_char is None:
-                    last_char = []
-                last_char.append(token.token)
-            else:
-                if last_char is not None:
-                    yield tokens.Char(None, ''.join(last_char))
-                    last_char = None
-                yield token
-        if last_char is not None:
-            yield tokens.Char(None, ''.join(last_char))
-        # LR(1) peek make last token get stuck as pending after StopIteration
-        yield tokens.Char(None, '')
+        stream = tokenize(self.input_string)
+        if self.folder is not None:
+            # First, so that paths are not bound for branches it removes
+            stream = self.folder.fold(stream)
+        if self.hoist:
+            stream = hoist_paths(stream)
+        return stream
 
     def convert(self):
         """Streaming parser and code generator, retuns list of strings"""
-        gen = self.tokenize()
-
-        class counter(object):
-            def __init__(self):
-                self.count = 0
-            def inc(self):
-                self.count += 1
-                return self.count
-        counter = counter()
-
-        def generator():
-            counter.inc()
-            generator.count = counter.count
-            logging.debug("Emitting: %s" % generator.peek)
-            try:
-                return generator.peek
-            finally:
-                generator.peek = gen.next()
-        # pre-fill these tracker variables
-        generator.count = counter.count
-        generator.peek = gen.next()
-        generator.nest_depth = -1
+        cursor = TokenCursor(self.tokenize())
 
         buf = []
         try:
-            while True:
-                next = generator()
-                buf.append(
-                    next.emit(generator)
-                )
+            tokens.parse(cursor, buf)
         except StopIteration:
             pass
 
         return self.post_process(buf)
 
+    @classmethod
+    def convert_stream(cls, infile, outfile, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Converts the ClearSilver read from infile and writes the Mako to
+        outfile, without holding either in memory.
+
+        Input is read and output written chunk_size at a time. The text of
+        each top-level token is final as soon as it is complete, so memory
+        use is bounded by the largest top-level tag rather than the whole
+        file. The output is the same as convert() on the whole input.
+        """
+        cursor = TokenCursor(tokenize_stream(infile, chunk_size))
+        out = ContinuationFilter(outfile, chunk_size)
+        try:
+            tokens.parse(cursor, out)
+        except StopIteration:
+            pass
+        out.close()
+
     def post_process(self, buf):
         """Post process the converted template to perform some additional
         tweaks
         """
         converted = "".join(buf)
-        pat = re.compile(r"^[ \t]*\\\r?\n", re.MULTILINE)
-        processed = re.sub(pat, '', converted, 0)
+        processed = continuation_r.sub('', converted)
         return processed
@@ -0,0 +1,127 @@
+# Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
+# See "LICENSE" file for license.
+
+"""Rewrites ClearSilver expressions into Python for the generated Mako.
+
+    #var        -> int(var)
+    !a          -> not a
+    a || b      -> a or b
+    a && b      -> a and b
+
+"""
+import re
+
+# Everything the rewriter has to act on. The text between matches is copied
+# through untouched.
+operator_r = re.compile(r'\#([a-zA-Z0-9._]+)|!|\|\||\&\&')
+
+# The characters \s matches, which str.strip() would not agree on for
+# unicode expressions.
+whitespace = ' \t\n\r\f\v'
+
+# Operator -> (precedence of the rewrite, replacement). The whitespace
+# around an operator is swallowed by its replacement; two different
+# operators next to each other end up separated by a single space, two of
+# the same kind keep both of their spaces.
+operators = {
+    '!': (1, ' not '),
+    '||': (2, ' or '),
+    '&&': (3, ' and '),
+}
+
+
+def rewrite(expression):
+    """Rewrites the ClearSilver operators in expression in one left to right
+    pass, see the module docstring.
+    """
+    out = []
+    # The kind of operator that produced out[-1], or None for plain text
+    last = None
+    pos = 0
+    length = len(expression)
+    while True:
+        match = operator_r.search(expression, pos)
+        if match is None:
+            break
+        start = match.start()
+        end = match.end()
+        token = match.group()
+        if token[0] == '#':
+            out.append(expression[pos:start])
+            out.append('int(%s)' % match.group(1))
+            last = None
+            pos = end
+            continue
+
+        skip = end
+        while skip < length and expression[skip] in whitespace:
+            skip += 1
+        if token == '!':
+            # ! is only "not" when it is not part of a != comparison.
+            if skip < length and expression[skip] != '=':
+                end = skip
+            elif skip > end:
+                end = skip - 1
+            else:
+                out.append(expression[pos:end])
+                last = None
+                pos = end
+                continue
+        else:
+            end = skip
+
+        kind, replacement = operators[token]
+        text = expression[pos:start].rstrip(whitespace)
+        if text:
+            out.append(text)
+        elif last is not None and last != kind:
+            out[-1] = out[-1].rstrip(whitespace)
+        out.append(replacement)
+        last = kind
+        pos = end
+    out.append(expression[pos:])
+    return ''.join(out)
+
+
+class ExpressionCache(object):
+    """A bounded memo of rewrite() results keyed on the raw expression.
+
+    The same expressions turn up over and over across a template tree. When
+    the memo fills up it is simply emptied, which is cheaper than tracking
+    recency for entries this small.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._memo = {}
+
+    def rewrite(self, expression):
+        try:
+            result = self._memo[expression]
+        except KeyError:
+            self.misses += 1
+            result = rewrite(expression)
+            if len(self._memo) >= self.maxsize:
+                self._memo.clear()
+            self._memo[expression] = result
+            return result
+        self.hits += 1
+        return result
+
+    def info(self):
+        """Returns (hits, misses, maxsize, currsize)"""
+        return self.hits, self.misses, self.maxsize, len(self._memo)
+
+    def clear(self):
+        """Empties the memo and resets the counters"""
+        self._memo.clear()
+        self.hits = 0
+        self.misses = 0
+
+cache = ExpressionCache()
+
+
+def sanitize(expression):
+    """rewrite() through the module-wide cache"""
+    return cache.rewrite(expression)
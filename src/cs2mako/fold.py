@@ -0,0 +1,321 @@
+# Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
+# See "LICENSE" file for license.
+
+"""Folds the conditions of a template on HDF values known ahead of time.
+
+Given the constants of a deployment, like feature flags and the locale,
+
+    Lang.Locale = en_US
+    Features.new_header = 0
+
+BranchFolder.fold() rewrites the token stream ahead of the parser, so that
+
+    <?cs if:Features.new_header ?>new<?cs elif:Lang.Locale == "en_US" ?>
+    us<?cs else ?>other<?cs /if ?>
+
+converts as if it had been
+
+    us
+
+A condition is evaluated with the nodes of the constants, as the template
+would be at render time. Conditions on other values are left as they are,
+though an operand of and, or and not that is known can still decide them.
+A branch that can not be taken is removed, a branch that is always taken
+ends the chain as its else, and an if left with only that is replaced by
+its contents.
+
+Constants that the template sets, and names that a loop or def binds, are
+not folded. Included templates are assumed not to set them.
+
+"""
+import ast
+import hashlib
+import re
+
+import tokens
+from tree import Block
+from tree import Tag
+from tree import Unsupported
+from tree import build
+from tree import flatten
+from tree import known_tags
+from tree import size
+
+
+path_r = re.compile(r'[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*$')
+
+name_r = re.compile(r'[A-Za-z_]\w*')
+
+# Tags whose names up to an = are locals of their contents
+binding_tags = (tokens.Open_each, tokens.Open_loop)
+
+_literal_names = {'True': True, 'False': False, 'None': None}
+
+
+def _path(node):
+    """Returns the dotted path of a Name or Attribute node, or None"""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return '.'.join(reversed(parts))
+
+
+def _is_pure(node):
+    """Whether evaluating node can have no effect other than its value.
+    int() is the only call the converter writes itself.
+    """
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call) and not (
+                isinstance(child.func, ast.Name) and child.func.id == 'int'):
+            return False
+    return True
+
+
+class _Paths(ast.NodeTransformer):
+    """Replaces the constant paths of an expression with names bound to
+    their nodes
+    """
+    def __init__(self, hdf):
+        self.hdf = hdf
+        self.namespace = dict(_literal_names, __builtins__={}, int=int)
+
+    def replace(self, node):
+        name = '_const%d' % (len(self.namespace),)
+        self.namespace[name] = self.hdf.get(_path(node))
+        return ast.copy_location(ast.Name(name, ast.Load()), node)
+
+    def visit_Name(self, node):
+        if node.id in _literal_names or node.id == 'int':
+            return node
+        return self.replace(node)
+
+    visit_Attribute = replace
+
+
+class BranchFolder(object):
+    """Removes the branches of if chains that constants rule out, see the
+    module docstring.
+
+    hdf -- An Hdf of the constants. Every node that has a value is one.
+    """
+    def __init__(self, hdf):
+        self.hdf = hdf
+        self.constants = hdf.get_value_dict()
+        self._digest = None
+        # How much was done, over every template
+        self.conditions = 0
+        self.branches = 0
+        self.removed = 0
+
+    def digest(self):
+        """Returns a hash of the constants, for cache keys"""
+        if self._digest is None:
+            self._digest = hashlib.sha1(
+                repr(sorted(self.constants.items()))).hexdigest()
+        return self._digest
+
+    def stats(self):
+        """Returns (conditions, branches, removed): the conditions decided,
+        the branches removed and the bytes of ClearSilver they held
+        """
+        return self.conditions, self.branches, self.removed
+
+    def count(self, conditions, branches, removed):
+        """Adds to the stats, for a template that was folded elsewhere"""
+        self.conditions += conditions
+        self.branches += branches
+        self.removed += removed
+
+    def fold(self, stream):
+        """Returns the token list of stream with its conditions folded.
+        Streams it can not rewrite are returned as they are.
+        """
+        stream = list(stream)
+        try:
+            root = build(stream)
+        except Unsupported:
+            return stream
+        self._known = self._known_paths(root)
+        if not self._known:
+            return stream
+        # Condition -> truth, as the same ones turn up over and over
+        self._truths = {}
+        work = [root]
+        while work:
+            self._fold_children(work.pop(), work)
+        return flatten(root)
+
+    def _known_paths(self, root):
+        """Returns the constants the template root can not change"""
+        sets = []
+        roots = set()
+        work = [root]
+        while work:
+            for child in work.pop():
+                if isinstance(child, Block):
+                    tag = child.tag
+                    for branch_tag, body in child.branches:
+                        work.append(body)
+                elif isinstance(child, Tag):
+                    tag = child
+                else:
+                    continue
+                cls = tag.open.__class__
+                if cls is tokens.Open_set:
+                    target = tag.text.split('=', 1)[0].strip()
+                    if path_r.match(target):
+                        sets.append(target)
+                    else:
+                        roots.update(name_r.findall(target))
+                elif cls is tokens.Open_def:
+                    roots.update(name_r.findall(tag.text.partition('(')[2]))
+                elif cls in binding_tags or cls not in known_tags:
+                    roots.update(name_r.findall(tag.text.split('=', 1)[0]))
+        known = set()
+        for path in self.constants:
+            if path.split('.', 1)[0] in roots:
+                continue
+            if any(path == target or path.startswith(target + '.') or
+                   target.startswith(path + '.') for target in sets):
+                continue
+            known.add(path)
+        return known
+
+    def _fold_children(self, children, work):
+        """Folds the if blocks of children, and adds the lists of children
+        inside them to work
+        """
+        result = []
+        pending = children[::-1]
+        while pending:
+            child = pending.pop()
+            if not isinstance(child, Block):
+                result.append(child)
+                continue
+            cls = child.tag.open.__class__
+            if cls is tokens.Open_if:
+                replacement = self._fold_if(child)
+                if replacement is not None:
+                    pending.extend(reversed(replacement))
+                    continue
+            result.append(child)
+            if cls in known_tags and cls is not tokens.Open_alt:
+                for tag, body in child.branches:
+                    work.append(body)
+        children[:] = result
+
+    def _fold_if(self, block):
+        """Removes the branches of block that can not be taken. Returns the
+        children to put in its place, or None to keep it.
+        """
+        kept = []
+        decided = 0
+        for tag, body in block.branches:
+            if tag.open.__class__ is tokens.Open_else:
+                truth = True
+            else:
+                truth = self._condition(tag)
+                if truth is not None:
+                    decided += 1
+            if truth is not False:
+                kept.append((tag, body, truth))
+                if truth:
+                    break
+        if not decided:
+            return None
+        self.conditions += decided
+        self.branches += len(block.branches) - len(kept)
+        before = size([block])
+        if not kept:
+            self.removed += before
+            return []
+        if kept[0][2]:
+            self.removed += before - size(kept[0][1])
+            return kept[0][1]
+        branches = []
+        for tag, body, truth in kept:
+            if truth:
+                if tag.open.__class__ is not tokens.Open_else:
+                    tag = Tag(tokens.Open_else(None, '<?cs else '), '',
+                              tokens.StopToken(None, '?>'))
+            elif not branches and tag.open.__class__ is not tokens.Open_if:
+                tag = Tag(tokens.Open_if(None, '<?cs if:', 'if'), tag.text,
+                          tag.stop)
+            branches.append([tag, body])
+        block.branches = branches
+        self.removed += before - size([block])
+        return None
+
+    def _condition(self, tag):
+        """Returns whether the condition of tag is true, or None when that
+        is not known
+        """
+        expression = tag.open.sanitize_expression(tag.text).strip()
+        try:
+            return self._truths[expression]
+        except KeyError:
+            pass
+        try:
+            truth = self._truth(ast.parse(expression, mode='eval').body)
+        except SyntaxError:
+            truth = None
+        self._truths[expression] = truth
+        return truth
+
+    def _truth(self, node):
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            truth = self._truth(node.operand)
+            return None if truth is None else not truth
+        if isinstance(node, ast.BoolOp):
+            # The value that ends the evaluation of the operands
+            last = isinstance(node.op, ast.Or)
+            unknown = False
+            for value in node.values:
+                truth = self._truth(value)
+                if truth is last:
+                    return last
+                if truth is None:
+                    if not _is_pure(value):
+                        # Folding would skip it
+                        return None
+                    unknown = True
+            return None if unknown else not last
+        if not self._is_constant(node):
+            return None
+        paths = _Paths(self.hdf)
+        expression = ast.fix_missing_locations(
+            ast.Expression(paths.visit(node)))
+        try:
+            return bool(eval(compile(expression, '<condition>', 'eval'),
+                             paths.namespace))
+        except Exception:
+            return None
+
+    def _is_constant(self, node):
+        """Whether node only uses literals and known constants"""
+        if isinstance(node, (ast.Num, ast.Str)):
+            return True
+        if isinstance(node, ast.Name):
+            return node.id in _literal_names or node.id in self._known
+        if isinstance(node, ast.Attribute):
+            return _path(node) in self._known
+        if isinstance(node, ast.BoolOp):
+            return all(self._is_constant(value) for value in node.values)
+        if isinstance(node, ast.UnaryOp):
+            return self._is_constant(node.operand)
+        if isinstance(node, ast.BinOp):
+            return (self._is_constant(node.left) and
+                    self._is_constant(node.right))
+        if isinstance(node, ast.Compare):
+            return all(self._is_constant(value)
+                       for value in [node.left] + node.comparators)
+        if isinstance(node, ast.Call):
+            return (isinstance(node.func, ast.Name) and
+                    node.func.id == 'int' and len(node.args) == 1 and
+                    not (node.keywords or node.starargs or node.kwargs) and
+                    self._is_constant(node.args[0]))
+        return False
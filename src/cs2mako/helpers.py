@@ -2,10 +2,48 @@
 # See "LICENSE" file for license.
 
 """These functions should be made available via cs2mako in the Mako context"""
+import re
 
 
-def include(clearsilver_name):
-    """loads clearsilver file and returns a rendered mako file"""
-    pass
+def template_uri(clearsilver_name):
+    """Returns the Mako URI of the converted template of clearsilver_name.
 
-# need to put whatever ported clearsilver functions we have in here
\ No newline at end of file
+    ClearSilver names are relative to the template root, Mako URIs start
+    with a slash, as in the <%include file="/..."/> that include:
+    converts to.
+    """
+    return '/' + clearsilver_name.lstrip('/')
+
+
+def gettext(text):
+    """Stands in for _() in templates converted with gettext strings"""
+    return text
+
+
+def name(node):
+    """<?cs name:node ?>: the last part of the key of an Hdf node"""
+    try:
+        return node._name
+    except AttributeError:
+        return unicode(node)
+
+
+tag_r = re.compile(r'<[^>]*>')
+
+
+def striptags(value):
+    """html_strip(): value without its HTML tags"""
+    return tag_r.sub(u'', unicode(value))
+
+
+# What js_escape() escapes as \uXXXX: quotes and the backslash, what could
+# end a <script> or a comment, and line breaks
+js_escape_r = re.compile(u'[\\\\\'"<>&=\\-;`\x00-\x1f\u2028\u2029]')
+
+
+def escapejs(value):
+    """js_escape(): value made safe for a JavaScript string"""
+    return js_escape_r.sub(lambda match: u'\\u%04X' % ord(match.group()),
+                           unicode(value))
+
+# need to put whatever ported clearsilver functions we have in here
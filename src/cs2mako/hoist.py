@@ -0,0 +1,233 @@
+# Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
+# See "LICENSE" file for license.
+
+"""Binds HDF paths that a template looks up more than once to locals.
+
+hoist_paths() rewrites the token stream ahead of the parser:
+
+    <?cs var:mg.event.title ?> ... <?cs if:mg.event.title ?>
+
+converts as if it had been
+
+    <?cs each:_path0 = (mg.event.title,) ?>
+    <?cs var:_path0 ?> ... <?cs if:_path0 ?>
+    <?cs /each ?>
+
+The binding is a loop of one, because Mako copies locals() after every
+<% %> block at the top level of a template, which costs more than the
+lookups it saves. A missing path costs the most, as every step of it
+makes a new NullHdfNode.
+
+Paths are bound once per stretch of a scope (the template, a def, the
+body of an if branch, each or loop) that has no set, include or call in
+it, since those can change what a path finds. Only the lookups that run
+whenever the stretch does count: a path the stretch only looks up in an
+if branch or a loop is bound in there, as the guard may be what keeps the
+lookup from failing. Lookups in there reuse the bindings of the stretch
+around them, though.
+
+"""
+import re
+
+import tokens
+from tree import Block
+from tree import Tag
+from tree import Unsupported
+from tree import build
+from tree import flatten
+from tree import known_tags
+
+
+# A dotted path. String literals are matched too, so that what is in them
+# is skipped. A path followed by .0 is not valid Python, and is left alone.
+path_r = re.compile(
+    r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')'''
+    r'|(?<![\w.])([A-Za-z_]\w*(?:\.[A-Za-z_]\w*)+)(?![\w.])')
+
+name_r = re.compile(r'[A-Za-z_]\w*')
+
+# Tags whose expression can be rewritten
+rewritten_tags = (tokens.Open_var, tokens.Open_name, tokens.Open_if,
+                  tokens.Open_elif, tokens.Open_elseif, tokens.Open_alt,
+                  tokens.Open_each, tokens.Open_loop)
+
+# Tags that may change what a path finds
+barrier_tags = (tokens.Open_set, tokens.Open_include, tokens.Open_call)
+
+# Tags that end the stretch they are in, wherever they are
+opaque_tags = barrier_tags + (tokens.Open_def,)
+
+
+def _is_boundary(child):
+    """Whether a child of a scope ends the stretch before it"""
+    if isinstance(child, Tag):
+        return child.open.__class__ not in rewritten_tags + (
+            tokens.Open_comment,)
+    if isinstance(child, Block):
+        return (child.opaque or
+                child.tag.open.__class__ not in rewritten_tags)
+    return False
+
+
+def _loop_names(tag):
+    """The names an each or loop tag assigns"""
+    return set(name_r.findall(tag.text.split('=', 1)[0]))
+
+
+class PathHoister(object):
+    """Rewrites the token stream of a template, see the module docstring.
+
+    min_uses -- How many lookups of a path there must be in a stretch
+        for it to be bound.
+    """
+    def __init__(self, min_uses=2):
+        self.min_uses = min_uses
+        # How much was done, over every template
+        self.bindings = 0
+        self.lookups = 0
+
+    def hoist(self, stream):
+        """Returns the token list of stream with its paths bound"""
+        stream = list(stream)
+        try:
+            root = build(stream, opaque_tags)
+        except Unsupported:
+            return stream
+        self._prefix = '_path'
+        while any(self._prefix in token.token for token in stream):
+            self._prefix = '_' + self._prefix
+        self._count = 0
+        scopes = [root]
+        while scopes:
+            self._hoist_scope(scopes.pop(), scopes)
+        return flatten(root)
+
+    def _hoist_scope(self, children, scopes):
+        """Binds the paths of each stretch of children, and adds the scopes
+        inside it to scopes
+        """
+        result = []
+        stretch = []
+        for child in children + [None]:
+            if child is not None and not _is_boundary(child):
+                stretch.append(child)
+                continue
+            if stretch:
+                result.extend(self._hoist_stretch(stretch, scopes))
+                stretch = []
+            if child is None:
+                break
+            result.append(child)
+            if isinstance(child, Block) and (
+                    child.tag.open.__class__ in known_tags):
+                for tag, body in child.branches:
+                    if tag.open.__class__ is not tokens.Open_alt:
+                        scopes.append(body)
+        children[:] = result
+
+    def _hoist_stretch(self, stretch, scopes):
+        """Returns stretch, wrapped in the loop that binds its paths when
+        any are worth it, and adds the scopes inside it to scopes
+        """
+        # (tag, match) of each path the stretch always looks up
+        found = []
+        # And of those it may look up, in branches and loops
+        nested = []
+        # (children, names assigned by the loops around them, whether they
+        # always run)
+        work = [(stretch, frozenset(), True)]
+        while work:
+            children, bound, always = work.pop()
+            for child in children:
+                if isinstance(child, Block):
+                    # Only the first condition of an if always runs
+                    tags = [tag for tag, body in child.branches]
+                    cls = child.tag.open.__class__
+                    if cls in (tokens.Open_each, tokens.Open_loop):
+                        names = bound | _loop_names(child.tag)
+                    else:
+                        names = bound
+                    if cls is not tokens.Open_alt:
+                        for tag, body in child.branches:
+                            if always:
+                                scopes.append(body)
+                            work.append((body, names, False))
+                elif isinstance(child, Tag):
+                    tags = [child]
+                else:
+                    continue
+                for index, tag in enumerate(tags):
+                    if tag.open.__class__ not in rewritten_tags:
+                        continue
+                    out = found if always and not index else nested
+                    for match in path_r.finditer(tag.text):
+                        path = match.group(2)
+                        if path and path.split('.', 1)[0] not in bound:
+                            out.append((tag, match))
+        hoisted = self._choose(found)
+        if not hoisted:
+            return stretch
+        names = {}
+        for path in sorted(hoisted, key=len):
+            names[path] = '%s%d' % (self._prefix, self._count)
+            self._count += 1
+        # The binding runs before anything in the stretch, so the lookups
+        # that may run reuse it too
+        self._rewrite(found + nested, names)
+        self.bindings += len(names)
+        paths = sorted(names, key=names.get)
+        values = ', '.join(paths)
+        if len(paths) > 1:
+            values = '(%s)' % (values,)
+        text = '%s = (%s,)' % (', '.join(names[path] for path in paths),
+                               values)
+        block = Block(Tag.make(tokens.Open_each, '<?cs each:', text, 'each'))
+        block.branches[0][1] = stretch
+        block.close = tokens.CloseToken(None, '<?cs /each ?>', 'each')
+        return [block]
+
+    def _choose(self, found):
+        """Returns the paths to bind, longest first"""
+        uses = {}
+        for tag, match in found:
+            parts = match.group(2).split('.')
+            for length in xrange(2, len(parts) + 1):
+                prefix = '.'.join(parts[:length])
+                uses[prefix] = uses.get(prefix, 0) + 1
+        hoisted = []
+        for path in sorted(uses, key=lambda path: (-path.count('.'), path)):
+            count = uses[path]
+            if count < self.min_uses:
+                continue
+            hoisted.append(path)
+            # Its lookups are now the one that binds it
+            parts = path.split('.')
+            for length in xrange(2, len(parts)):
+                prefix = '.'.join(parts[:length])
+                uses[prefix] -= count - 1
+        return hoisted
+
+    def _rewrite(self, found, names):
+        """Puts the names of the bound paths in the tags of found"""
+        edits = {}
+        for tag, match in found:
+            path = match.group(2)
+            while path not in names and '.' in path:
+                path = path.rsplit('.', 1)[0]
+            if path in names:
+                edits.setdefault(tag, []).append(
+                    (match.start(2), match.start(2) + len(path), names[path]))
+        for tag, spans in edits.iteritems():
+            text = tag.text
+            for start, end, name in sorted(spans, reverse=True):
+                text = text[:start] + name + text[end:]
+                self.lookups += 1
+            tag.text = text
+
+
+def hoist_paths(stream):
+    """Returns the token list of stream, with the paths it looks up more
+    than once bound to locals. Streams it can not rewrite are returned as
+    they are.
+    """
+    return PathHoister().hoist(stream)
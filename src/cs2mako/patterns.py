@@ -7,3 +7,16 @@ open_r_str = r'\<\?cs\s*([a-zA-Z]+)([:]|\s)'
 close_r_str = r'\<\?cs\s*/([a-zA-Z]+)\s*\?\>'
 open_r = re.compile(open_r_str)
 close_r = re.compile(close_r_str)
+
+# The same tags as a single alternation over a whole buffer, for the one-pass
+# tokenizer. Whitespace is restricted to [^\S\n] because tags never span a
+# line; the alternatives are in the same priority order as the rules of the
+# per-line scanner in converter.py.
+_ws = r'[^\S\n]'
+tag_r = re.compile(
+    r'(?P<open>\<\?cs%(ws)s*[a-zA-Z]+(?:[:]|%(ws)s))'
+    r'|(?P<comment>\<\?cs%(ws)s*\#)'
+    r'|(?P<else>\<\?cs%(ws)s*else%(ws)s*)'
+    r'|(?P<close>\<\?cs%(ws)s*/[a-zA-Z]+%(ws)s*\?\>)'
+    r'|(?P<stop>%(ws)s*\?\>)' % {'ws': _ws}
+)
@@ -0,0 +1,246 @@
+# Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
+# See "LICENSE" file for license.
+
+"""Renders converted templates with the data of an Hdf.
+
+    runtime = TemplateRuntime(['converted/'], module_directory='modules/')
+    for name, error in runtime.warm_up():
+        ...
+    html = runtime.render('events/page.html', hdf)
+
+CompiledRuntime renders ClearSilver templates compiled straight to Python
+by codegen, without Mako.
+
+"""
+import __builtin__
+import os
+
+from mako import util
+from mako.lookup import TemplateLookup
+from mako.runtime import Context
+
+import helpers
+from cs2mako import __version__
+from batch import convert_string
+from batch import find_templates
+from codegen import compile_template
+
+
+def _set_defaults(data, hdf):
+    """Adds hdf and the helpers to the variables data of a template"""
+    data.setdefault('hdf', hdf)
+    data.setdefault('_', helpers.gettext)
+    data.setdefault('name', helpers.name)
+    data.setdefault('striptags', helpers.striptags)
+    data.setdefault('escapejs', helpers.escapejs)
+
+
+class HdfContext(Context):
+    """A Mako context that takes the variables of converted templates from
+    an Hdf.
+
+    Converted templates use the roots of the Hdf as names (${ mg.title }),
+    and hdf itself for <?cs set ?>. Names that are not in data and are not
+    builtins are looked up as roots of hdf, and missing ones are empty, as
+    in ClearSilver. The helpers that converted templates call are there
+    too, unless data has its own, like a real gettext for _.
+    """
+    def __init__(self, buffer, hdf, **data):
+        _set_defaults(data, hdf)
+        Context.__init__(self, buffer, **data)
+        self._data.setdefault('include', self.include)
+        self._hdf = hdf
+
+    def include(self, clearsilver_name):
+        """Renders the converted template of the ClearSilver file into this
+        context, like <%include/> does.
+
+        The template comes from the lookup of the context, which keeps it
+        once it is compiled. Returns '', so that ${ include("x.html") }
+        shows nothing but the included template.
+        """
+        template = self.lookup.get_template(
+            helpers.template_uri(clearsilver_name))
+        # A copy, as rendering sets self and local for the template
+        template.render_context(self._copy())
+        return ''
+
+    def get(self, key, default=None):
+        data = self._data
+        if key in data:
+            return data[key]
+        if key in __builtin__.__dict__:
+            return __builtin__.__dict__[key]
+        return self._hdf.get(key)
+
+    def _copy(self):
+        # Defs and includes render with a copy, which Context makes a plain
+        # Context
+        context = Context._copy(self)
+        context.__class__ = HdfContext
+        context._hdf = self._hdf
+        return context
+
+
+class _Converter(object):
+    """Converts ClearSilver to Mako as Mako reads a template, see
+    TemplateRuntime
+    """
+    def __init__(self, do_intl, cache):
+        self.do_intl = do_intl
+        self.cache = cache
+
+    def __call__(self, text):
+        # Mako hands over the decoded text
+        cs_data = text.encode('utf-8')
+        return convert_string(cs_data, True, self.do_intl,
+                              self.cache).decode('utf-8')
+
+
+class _Templates(object):
+    """What the runtimes share: the directories of a tree of templates"""
+    def templates(self):
+        """Yields the name of every template in the directories"""
+        for source, name in find_templates(self.directories):
+            yield name
+
+    def warm_up(self, names=None):
+        """Compiles and loads templates ahead of the first render, by
+        default every one in the directories, as a process starts.
+
+        Yields (name, error) pairs as templates are loaded, where error is
+        None for templates that compiled cleanly, or a message.
+        """
+        if names is None:
+            names = self.templates()
+        for name in names:
+            try:
+                self.get_template(name)
+                error = None
+            except Exception, e:
+                error = "%s: %s" % (e.__class__.__name__, e)
+            yield name, error
+
+
+class TemplateRuntime(_Templates):
+    """Loads, compiles and renders the templates of a converted tree.
+
+    directories -- Where the converted templates are. Template names, and
+        the files of <%include/>, are relative to these.
+    module_directory -- Where Mako writes the Python module it compiles
+        each template to. A module is reused until its template is newer,
+        in this process and in later ones, so only changed templates are
+        compiled again. Keep it out of directories. With None, templates
+        are compiled once per process.
+    convert -- The directories hold ClearSilver rather than converted
+        templates, and each template is converted as it is compiled,
+        through cache (a ConversionCache) when there is one. Modules are
+        kept apart by cs2mako version and do_intl, which change the
+        conversion.
+    filesystem_checks -- Whether templates that were loaded are checked
+        for changes each time they are used. Turn it off where templates
+        only change with a deploy.
+    """
+    def __init__(self, directories, module_directory=None, convert=False,
+                 do_intl=True, cache=None, filesystem_checks=True):
+        preprocessor = None
+        if convert:
+            preprocessor = _Converter(do_intl, cache)
+            if module_directory is not None:
+                module_directory = os.path.join(
+                    module_directory, 'cs-%s-%d' % (__version__, do_intl))
+        self.directories = list(directories)
+        self.lookup = TemplateLookup(
+            directories=self.directories,
+            module_directory=module_directory,
+            preprocessor=preprocessor,
+            filesystem_checks=filesystem_checks,
+        )
+
+    def get_template(self, name):
+        """Returns the compiled template of the file name"""
+        return self.lookup.get_template(helpers.template_uri(name))
+
+    def render(self, name, hdf, **data):
+        """Renders the template name with the values of hdf, and returns the
+        text, as unicode.
+
+        hdf -- <?cs set ?> tags write to it. Pass an HdfOverlay of a shared
+            Hdf to keep that as it is.
+        data -- Other variables for the template, see HdfContext.
+        """
+        buf = util.FastEncodingBuffer(as_unicode=True)
+        self.get_template(name).render_context(HdfContext(buf, hdf, **data))
+        return buf.getvalue()
+
+
+class CompiledRuntime(_Templates):
+    """Loads and renders ClearSilver templates compiled to Python by
+    codegen, which takes the place of converting them and compiling the
+    Mako. The values of a render are looked up as HdfContext looks them up.
+
+    directories -- Where the ClearSilver templates are. Template names, and
+        the files of <?cs include ?>, are relative to these.
+    filesystem_checks -- Whether templates that were loaded are checked
+        for changes each time they are used. Turn it off where templates
+        only change with a deploy.
+    """
+    def __init__(self, directories, filesystem_checks=True):
+        self.directories = list(directories)
+        self.filesystem_checks = filesystem_checks
+        # name -> (filename, mtime, render function)
+        self._templates = {}
+
+    def find(self, name):
+        """Returns the file of the template name"""
+        relative = name.lstrip('/')
+        for directory in self.directories:
+            filename = os.path.join(directory, relative)
+            if os.path.isfile(filename):
+                return filename
+        raise IOError("Can't locate template %r" % (name,))
+
+    def get_template(self, name):
+        """Returns the render function of the template name, see
+        codegen.compile_template
+        """
+        loaded = self._templates.get(name)
+        if loaded is not None:
+            if not self.filesystem_checks:
+                return loaded[2]
+            filename, mtime, render = loaded
+            try:
+                if os.path.getmtime(filename) == mtime:
+                    return render
+            except OSError:
+                pass
+        filename = self.find(name)
+        mtime = os.path.getmtime(filename)
+        with open(filename, 'rb') as f:
+            render = compile_template(f.read(), filename)
+        self._templates[name] = (filename, mtime, render)
+        return render
+
+    def render(self, name, hdf, **data):
+        """Renders the template name with the values of hdf, and returns the
+        text, as unicode. See TemplateRuntime.render.
+        """
+        out = []
+        write = out.append
+        _set_defaults(data, hdf)
+        hdf_get = hdf.get
+
+        def get(key):
+            if key in data:
+                return data[key]
+            if key in __builtin__.__dict__:
+                return __builtin__.__dict__[key]
+            return hdf_get(key)
+
+        def include(name):
+            self.get_template(name)(write, get)
+            return u''
+
+        data.setdefault('include', include)
+        self.get_template(name)(write, get)
+        return u''.join(out)
@@ -1,20 +1,116 @@
 # Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
 # See "LICENSE" file for license.
 
-import logging
 import re
 
+import expressions
 import patterns
 
 
 space_eq_space = re.compile(r'\s*=\s*')
 
-expr_repl = (
-    (re.compile(r'\#([a-zA-Z0-9._]+)'), r'int(\1)'),
-    (re.compile(r'\s*!\s*(?=[^=])'), ' not '),
-    (re.compile(r'\s*\|\|\s*'), ' or '),
-    (re.compile(r'\s*\&\&\s*'), ' and '),
-)
+# ClearSilver functions that become Mako filters when they wrap a whole
+# <?cs var: ?> expression. Use register_filter() to add to it.
+var_filters = {
+    'url_escape': 'u',
+    'html_escape': 'h',
+    'html_strip': 'striptags',
+    'js_escape': 'escapejs',
+}
+var_filter_r = None
+
+
+def compile_filters():
+    """Rebuilds var_filter_r, which matches a call to any of the var_filters
+    functions wrapping a whole expression.
+    """
+    global var_filter_r
+    names = sorted(var_filters, key=len, reverse=True)
+    var_filter_r = re.compile(r'^\s*(%s)\(\s*(.+?)\s*\)\s*$' % (
+        '|'.join(re.escape(name) for name in names),
+    ))
+
+compile_filters()
+
+
+def register_filter(cs_function, mako_filter):
+    """Converts <?cs var:cs_function(x) ?> to ${ x | mako_filter }"""
+    var_filters[cs_function] = mako_filter
+    compile_filters()
+
+
+def extract_filters(expression):
+    """Peels filter functions off a var expression, outermost first.
+
+    returns (expression, filters), where filters are Mako filter names in
+    the order Mako should apply them, innermost first.
+
+    example:
+        extract_filters("html_escape(url_escape(x))") -> ("x", ["u", "h"])
+    """
+    applied_filters = []
+    match = var_filter_r.match(expression)
+    while match is not None:
+        applied_filters.append(var_filters[match.group(1)])
+        expression = match.group(2)
+        match = var_filter_r.match(expression)
+    applied_filters.reverse()
+    return expression, applied_filters
+
+
+def parse(cursor, out=None, start=None):
+    """Pushdown automaton that turns the tokens from cursor into Mako.
+
+    Tags that are still open are kept on an explicit stack rather than on
+    the Python call stack, so templates can nest as deeply as memory
+    allows. Each open tag collects the text of what it contains and hands
+    its own text to the tag below it on the stack when it is complete.
+
+    out -- Text for each complete top-level token is appended to this, until
+        the cursor runs out and raises StopIteration, which is passed on.
+        Tags that were still open at that point are dropped.
+    start -- An open token that has just been pulled from the cursor. When
+        given, parsing stops as soon as that tag is complete, and its text
+        is returned.
+    """
+    stack = [_Document(out)]
+    if start is not None:
+        start.open(cursor)
+        stack.append(start)
+    top = stack[-1]
+    while True:
+        if not (top.peeks and top.ends_before(cursor.peek())):
+            token = cursor.next()
+            if not top.ends(token):
+                if token.nests:
+                    # pushdown
+                    token.open(cursor)
+                    stack.append(token)
+                    top = token
+                else:
+                    top.add(token.emit(cursor))
+                continue
+            if not top.end(cursor):
+                continue
+        # top is complete
+        stack.pop()
+        text = top.finish(cursor)
+        if top is start:
+            return text
+        top = stack[-1]
+        top.add(text)
+
+
+class _Document(object):
+    """The bottom of the parse stack, which never ends"""
+    peeks = False
+
+    def __init__(self, out):
+        if out is not None:
+            self.add = out.append
+
+    def ends(self, token):
+        return False
 
 
 class Token(object):
@@ -25,6 +121,8 @@ class Token(object):
     close_tag = True
     _tag_adds_depth = False
     name = ''
+    # Whether the token opens a tag, which parse() pushes on its stack
+    nests = False
 
     def __init__(self, scanner, token):
         self.token = token
@@ -32,65 +130,85 @@ class Token(object):
     def __str__(self):
         return "[%s: %s]" % (str(self.__class__.__name__), str(self.token),)
 
-    def emit(self, generator):
+    def emit(self, cursor):
         return self.token
 
     def sanitize_expression(self, expression):
-        for expr, repl in expr_repl:
-            expression = expr.sub(repl, expression)
-        return expression
+        return expressions.sanitize(expression)
 
 
 class OpenToken(Token):
-    def __init__(self, scanner, token, name=None):
-        Token.__init__(self, scanner, token)
-        self.name = name
-
-    def emit(self, generator):
-        """
+    """An open tag, parsed in two parts:
 
         <% tag_name: parts %>contents</% end_tag_name %>
 
-        """
+    parse() calls open() when the token is pulled, then add() with the text
+    of every token in the tag part until ends() sees the StopToken, and
+    end(). Tags that are not tag_only then get the contents part the same
+    way, until ends() sees their CloseToken, and end() again. finish()
+    returns the emitted text.
+    """
+    nests = True
+    # Whether parse() should ask ends_before() about every peeked token
+    peeks = False
 
-        #tag part
-        buf = [ self.start_tok(generator) ]
-        self.emit_name(generator, buf)
-        self.emit_tag(generator, buf)
-        buf.append(self.end_tok(generator))
-        # contents part
-        if not self.tag_only:
-            self.emit_contents(generator, buf)
-        logging.debug("Emitting %s" % str(buf))
-        return ''.join(buf)
+    def __init__(self, scanner, token, name=None):
+        Token.__init__(self, scanner, token)
+        self.name = name
 
-    def emit_name(self, generator, buf):
+    def emit(self, cursor):
+        """Parses the rest of this tag from cursor and returns its text"""
+        return parse(cursor, start=self)
+
+    def open(self, cursor):
+        self._buf = [self.start_tok(cursor)]
+        self.emit_name(cursor, self._buf)
+        # The tag part is collected separately for emit_tag, the contents go
+        # straight into _buf.
+        self._pieces = []
+        self._in_contents = False
+
+    def add(self, text):
+        self._pieces.append(text)
+
+    def ends_before(self, token):
+        """Whether the tag is complete before the peeked token is pulled"""
+        return False
+
+    def ends(self, token):
+        """Whether token ends the current part of the tag"""
+        if self._in_contents:
+            return isinstance(token, CloseToken) and token.name == self.name
+        return isinstance(token, StopToken)
+
+    def end(self, cursor):
+        """Ends the current part. Returns True when the tag is complete."""
+        if self._in_contents:
+            self.emit_close_tag(cursor, self._buf)
+            return True
+        self.emit_tag(cursor, self._buf, self._pieces)
+        self._buf.append(self.end_tok(cursor))
+        if self.tag_only:
+            return True
+        self._pieces = self._buf
+        self._in_contents = True
+        return False
+
+    def finish(self, cursor):
+        return ''.join(self._buf)
+
+    def emit_name(self, cursor, buf):
         if self._emit_name:
             if self._emit_name is True:
                 buf.append(self.name)
             else:
                 buf.append(str(self._emit_name))
 
-    def emit_tag(self, generator, buf):
-        while True:
-            token = generator()
-            if isinstance(token, StopToken):
-                break
-            else:
-                buf.append(token.emit(generator))
-
-    def emit_contents(self, generator, buf):
-        logging.debug("Contents of %s" % self.name)
-        while True:
-            token = generator()
-            if isinstance(token, CloseToken) and token.name == self.name:
-                self.emit_close_tag(generator, buf)
-                break
-            else:
-                # pushdown
-                buf.append(token.emit(generator))
+    def emit_tag(self, cursor, buf, pieces):
+        """Emits the tag part, given the text of each token in it"""
+        buf.extend(pieces)
 
-    def emit_close_tag(self, generator, buf):
+    def emit_close_tag(self, cursor, buf):
         """emits the <% endtag %> tag"""
         ct = self.close_tag
         if ct is False:
@@ -102,10 +220,10 @@ class OpenToken(Token):
         elif self.close_tag is not None:
             buf.append(self.close_tag)
 
-    def start_tok(self, generator):
+    def start_tok(self, cursor):
         return self._start_tok
 
-    def end_tok(self, generator):
+    def end_tok(self, cursor):
         return self._end_tok
 
 
@@ -118,30 +236,9 @@ class Open_var(OpenTagOnlyToken):
     _start_tok = '${ '
     _end_tok = ' }'
     _emit_name = False
-    def emit_tag(self, generator, buf):
-        expression = []
-        OpenToken.emit_tag(self, generator, expression)
-        expression = self.sanitize_expression(''.join(expression))
-        filters = {
-            '^\s*url_escape\(\s*(.+?)\s*\)\s*$': 'u',
-            '^\s*html_escape\(\s*(.+?)\s*\)\s*$': 'h',
-            '^\s*html_strip\(\s*(.+?)\s*\)\s*$': 'striptags',
-            '^\s*js_escape\(\s*(.+?)\s*\)\s*$': 'escapejs',
-        }
-        match = True
-        applied_filters = []
-        while match:
-            match = False
-            for pattern, mako_filter in filters.items():
-                filtered = re.sub(pattern, '\\1', expression)
-                if filtered != expression:
-                    # The patten matched add it to the list of filters
-                    expression = filtered
-                    applied_filters.append(mako_filter)
-                    match = True
-        # Mako filters are applied in order, but our loop matched them in
-        # reverse order so first we have to reverse our list.
-        applied_filters.reverse()
+    def emit_tag(self, cursor, buf, pieces):
+        expression = self.sanitize_expression(''.join(pieces))
+        expression, applied_filters = extract_filters(expression)
         if len(applied_filters) > 0:
             expression = '%s | %s' % (expression, ', '.join(applied_filters))
         buf.append(expression)
@@ -151,10 +248,8 @@ class Open_set(OpenTagOnlyToken):
     _start_tok = '<% '
     _end_tok = ' %>'
     _emit_name = False
-    def emit_tag(self, generator, buf):
-        expression = []
-        OpenTagOnlyToken.emit_tag(self, generator, expression)
-        expression = self.sanitize_expression(''.join(expression))
+    def emit_tag(self, cursor, buf, pieces):
+        expression = self.sanitize_expression(''.join(pieces))
         if '=' in expression:
             lh, rh = expression.split('=', 1)
             if '.' in lh:
@@ -172,17 +267,12 @@ class Open_include(OpenTagOnlyToken):
     _start_tok = '<%include file='
     _end_tok = '/>'
     _emit_name = False
-    def emit_tag(self, generator, buf):
-        while True:
-            token = generator()
-            if isinstance(token, StopToken):
-                break
-            else:
-                # file_string is '="<filename>"
-                file_string = token.emit(generator)
-                # We need to add a slash because ClearSilver templates are exact
-                # filenames where as Mako will be relative without the slash
-                buf.append(re.sub(r'"', r'"/', file_string, 1))
+    def emit_tag(self, cursor, buf, pieces):
+        # each file_string is '="<filename>"
+        for file_string in pieces:
+            # We need to add a slash because ClearSilver templates are exact
+            # filenames where as Mako will be relative without the slash
+            buf.append(re.sub(r'"', r'"/', file_string, 1))
 
 # <?cs # this is totally a comment ?>
 class Open_comment(OpenTagOnlyToken):
@@ -195,15 +285,10 @@ class Open_def(OpenToken):
     _start_tok = '<%def name="'
     _end_tok = '">'
     _emit_name = False
-    def emit_tag(self, generator, buf):
-        while True:
-            token = generator()
-            if isinstance(token, StopToken):
-                break
-            else:
-                macro_sig = token.emit(generator)
-                # Make sure there isn't additional whitespace around the function
-                buf.append(macro_sig.strip())
+    def emit_tag(self, cursor, buf, pieces):
+        for macro_sig in pieces:
+            # Make sure there isn't additional whitespace around the function
+            buf.append(macro_sig.strip())
 
 # <?cs name:cs_var ?>
 class Open_name(OpenTagOnlyToken):
@@ -225,56 +310,50 @@ class Open_if(OpenToken):
     _emit_name = False
     _tag_adds_depth = True
 
-    def emit(self, generator):
-        nest_depth = generator.nest_depth
+    def open(self, cursor):
+        self._nest_depth = cursor.nest_depth
         if self._tag_adds_depth:
-            generator.nest_depth += 1
-        ret = OpenToken.emit(self, generator)
-        generator.nest_depth = nest_depth
-        return ret
-
-    def emit_tag(self, generator, buf):
-        expression = []
-        OpenToken.emit_tag(self, generator, expression)
-        expression = ''.join(expression)
+            cursor.nest_depth += 1
+        OpenToken.open(self, cursor)
+
+    def finish(self, cursor):
+        cursor.nest_depth = self._nest_depth
+        return OpenToken.finish(self, cursor)
+
+    def emit_tag(self, cursor, buf, pieces):
+        expression = ''.join(pieces)
         expression = self.sanitize_expression(expression)
         buf.append(expression)
 
-    def start_tok(self, generator):
-        return '\\\n' + (generator.nest_depth * '  ') + self._start_tok
+    def start_tok(self, cursor):
+        return '\\\n' + (cursor.nest_depth * '  ') + self._start_tok
 
-    def emit_close_tag(self, generator, buf):
+    def emit_close_tag(self, cursor, buf):
         buf.append('\\\n')
-        if generator.nest_depth >= 0:
-            buf.append(generator.nest_depth * '  ')
-        OpenToken.emit_close_tag(self, generator, buf)
-
-    # def emit_contents(sef, generator, buf):
-    #     OpenToken.emit_contents(sef, generator, buf)
-    #     buf.append('\\')
+        if cursor.nest_depth >= 0:
+            buf.append(cursor.nest_depth * '  ')
+        OpenToken.emit_close_tag(self, cursor, buf)
 
 # <?cs elseif:conditional_expression ?>
-#class Open_elseif(Open_if):
 class Open_elif(Open_if):
+    """elif and else run until the /if of their if, which they leave for
+    the if to close.
+    """
     _start_tok = '% elif '
     _end_tok = ':\n'
     close_tag = False
     _emit_name = False
     _tag_adds_depth = False
+    peeks = True
 
-    # def emit(self, generator):
-    #     return OpenToken.emit(self, generator)
+    def ends_before(self, token):
+        return (self._in_contents and isinstance(token, CloseToken)
+                and token.name == 'if')
 
-    def emit_contents(self, generator, buf):
-        while True:
-            peek = generator.peek
-            logging.debug("elseifelif Contents of %s" % peek)
-            if (isinstance(peek, CloseToken) and peek.name == 'if'):
-                #buf.append('\\')
-                break
-            token = generator()
-            # pushdown
-            buf.append(token.emit(generator))
+    def ends(self, token):
+        if self._in_contents:
+            return False
+        return isinstance(token, StopToken)
 
 class Open_elseif(Open_elif): pass
 # <?cs else ?>
@@ -285,19 +364,6 @@ class Open_else(Open_elif):
     _emit_name = False
     _tag_adds_depth = False
 
-    def emit(self, generator):
-        return OpenToken.emit(self, generator)
-
-    # def emit_contents(self, generator, buf):
-    #     while True:
-    #         peek = generator.peek
-    #         if isinstance(peek, CloseToken) and peek.name == 'if':
-    #             buf.append('\\')
-    #             break
-    #         token = generator()
-    #         # pushdown
-    #         buf.append(token.emit(generator))
-
 
 # <?cs alt:item.sales ?>0.0<?cs /alt ?>
 class Open_alt(OpenTagOnlyToken):
@@ -305,30 +371,24 @@ class Open_alt(OpenTagOnlyToken):
     _end_tok = ' }'
     _emit_name = False
 
-    def emit(self, generator):
-
-        # tag part
-        buf = []
-        while True:
-            token = generator()
-            if isinstance(token, StopToken):
-                break
-            else:
-                # pushdown
-                buf.append(token.emit(generator))
-        variable = ''.join(buf)
-
+    def open(self, cursor):
+        self._pieces = []
+        self._in_contents = False
+
+    def end(self, cursor):
+        if not self._in_contents:
+            # tag part
+            self._variable = ''.join(self._pieces)
+            self._pieces = []
+            self._in_contents = True
+            return False
         # body part
-        buf = []
-        while True:
-            token = generator()
-            if isinstance(token, CloseToken) and token.name == self.name:
-                break
-            else:
-                # pushdown
-                buf.append(token.emit(generator))
-        body = ''.join(buf)
+        self._body = ''.join(self._pieces)
+        return True
 
+    def finish(self, cursor):
+        variable = self._variable
+        body = self._body
         return '${ %(variable)s if %(variable)s else "%(body)s" }' % locals()
 
 # looping constructs:
@@ -342,14 +402,6 @@ class Open_each(Open_if):
     _emit_name = False
     _tag_adds_depth = True
 
-    def emit_tag(self, generator, buf):
-        expression = []
-
-        # calls sanitize_expression
-        Open_if.emit_tag(self, generator, expression)
-        expression = ''.join(expression)
-        buf.append(expression)
-
     def sanitize_expression(self, expression):
         expression = Open_if.sanitize_expression(self, expression)
         expression = space_eq_space.subn(' in ', expression, 1)[0]
@@ -380,4 +432,3 @@ class CloseToken(Token):
 class StopToken(Token): pass
 # anything else.
 class Char(Token): pass
-
@@ -0,0 +1,159 @@
+# Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
+# See "LICENSE" file for license.
+
+"""The token stream of a template as a tree, for the passes that rewrite it
+ahead of the parser (hoist.py, fold.py).
+
+    root = build(tokenize(cs_data))
+    ...
+    stream = flatten(root)
+
+A tree is a list of children: plain tokens (Char, and stray StopTokens and
+CloseTokens), Tags and Blocks.
+
+"""
+import tokens
+
+
+# Tags that split the contents of an if rather than open a block
+branch_tags = (tokens.Open_elif, tokens.Open_elseif, tokens.Open_else)
+
+# The tags that have a class in tokens.py. Others are blocks the parser
+# copies, like <?cs with ?>.
+known_tags = branch_tags + (
+    tokens.Open_var, tokens.Open_set, tokens.Open_include,
+    tokens.Open_comment, tokens.Open_def, tokens.Open_name, tokens.Open_call,
+    tokens.Open_if, tokens.Open_alt, tokens.Open_each, tokens.Open_loop)
+
+
+class Unsupported(Exception):
+    """The template is not in a shape build() handles: a tag that is not
+    closed, or an elif or else outside an if.
+    """
+
+
+class Tag(object):
+    """An open token, the text of its tag part and its ?>"""
+    def __init__(self, open_token, text, stop):
+        self.open = open_token
+        self.text = text
+        self.stop = stop
+
+    @classmethod
+    def make(cls, token_class, token, text, name=None):
+        """Returns a new tag, as if token had been in the template"""
+        return cls(token_class(None, token, name), text,
+                   tokens.StopToken(None, ' ?>'))
+
+
+class Block(object):
+    """A tag with contents, as [tag, children] branches and a close token.
+    Only an if has more than one branch.
+    """
+    def __init__(self, tag):
+        self.branches = [[tag, []]]
+        self.close = None
+        # Whether it holds a tag of one of the opaque classes of build(),
+        # or an unknown tag
+        self.opaque = False
+
+    @property
+    def tag(self):
+        return self.branches[0][0]
+
+
+def _tag_part(stream, open_token):
+    pieces = []
+    for token in stream:
+        if token.__class__ is tokens.StopToken:
+            return Tag(open_token, ''.join(pieces), token)
+        if token.__class__ is not tokens.Char:
+            break
+        pieces.append(token.token)
+    raise Unsupported()
+
+
+def build(stream, opaque=()):
+    """Returns the token stream as a tree.
+
+    opaque -- Tag classes that mark every block around them opaque.
+        Unknown tags always do.
+
+    Raises Unsupported for streams it can not build a tree of.
+    """
+    root = []
+    children = root
+    stack = []
+    stream = iter(stream)
+    for token in stream:
+        if not isinstance(token, tokens.OpenToken):
+            if (token.__class__ is tokens.CloseToken and stack
+                    and stack[-1].tag.open.name == token.name):
+                stack.pop().close = token
+                children = stack[-1].branches[-1][1] if stack else root
+            else:
+                children.append(token)
+            continue
+        cls = token.__class__
+        tag = _tag_part(stream, token)
+        if cls in branch_tags:
+            if not (stack and
+                    stack[-1].tag.open.__class__ is tokens.Open_if):
+                raise Unsupported()
+            stack[-1].branches.append([tag, []])
+            children = stack[-1].branches[-1][1]
+            continue
+        if cls in opaque or cls not in known_tags:
+            for block in stack:
+                block.opaque = True
+        if token.tag_only and cls is not tokens.Open_alt:
+            children.append(tag)
+            continue
+        block = Block(tag)
+        block.opaque = cls not in known_tags
+        children.append(block)
+        stack.append(block)
+        children = block.branches[0][1]
+    if stack:
+        raise Unsupported()
+    return root
+
+
+def iter_tokens(children):
+    """Yields the tokens of the tree children"""
+    stack = [iter(children)]
+    while stack:
+        for child in stack[-1]:
+            if isinstance(child, list):
+                stack.append(iter(child))
+                break
+            if isinstance(child, Tag):
+                yield child.open
+                yield tokens.Char(None, child.text)
+                yield child.stop
+            elif isinstance(child, Block):
+                parts = []
+                for tag, body in child.branches:
+                    parts.append(tag)
+                    parts.append(body)
+                parts.append(child.close)
+                stack.append(iter(parts))
+                break
+            else:
+                yield child
+        else:
+            stack.pop()
+
+
+def flatten(root):
+    """Returns the token stream of the tree root"""
+    stream = list(iter_tokens(root))
+    # The tokenizers end with an empty Char, which the parser needs last,
+    # and which a pass may have moved into a block
+    stream.append(tokens.Char(None, ''))
+    return stream
+
+
+def size(children):
+    """Returns the length of the ClearSilver text of children"""
+    return sum(len(token.token) for token in iter_tokens(children))
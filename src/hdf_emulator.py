@@ -9,8 +9,16 @@ Unit-tests are run by calling this file directly, not through Django:
 
 """
 
+import array
+import contextlib
+import cPickle
+import gc
+import hashlib
+import itertools
 import logging
-import weakref
+import marshal
+import os
+import re
 import string
 
 class NotSet(object):
@@ -24,112 +32,790 @@ class NotSet(object):
         return long(0)
 NotSet = NotSet()
 
-# future potential performance improvement:
-# lookups like this:
+# The nodes are kept in a tree: each node keeps its children in its own
+# instance __dict__, keyed by their short name. Lookups like this:
 #    a.b.c.d
-# currently will look up in the hdf._map
-#      a.b, a.b.c, a.b.c.d
-# by way of __getattr__ in each node (starting from 'a')
-# These lookups could return an object that proxies all
-# actions (like __int__, __float__, __getitem__) and when
-# and action occurs, does the dict lookup.
+# are then plain attribute lookups, done by the interpreter without calling
+# back into Python, and without building the keys a.b, a.b.c, a.b.c.d along
+# the way. __getattr__ is only called for names that are not there.
 #
-# timeit module (code below) shows that looking up
-# 'a.b.c.d.e' is 4x slower than lookup of 'a'
+# A child hides a plain method of the same name, as the instance __dict__
+# comes first, so the internal methods of a node are called through its
+# class: type(node)._child(node, name), never node._child(name).
+#
+# Hdf(lazy_paths=True) makes get() return an HdfPath instead, a proxy that
+# only collects the names of a lookup, and looks the whole path up once when
+# it is used (like __int__, __float__, __getitem__). A missing path then
+# costs one NullHdfNode rather than one per name, and a path sees values
+# set after it was built. Every step of a path is a call into Python
+# though, where a step through the nodes is not, so lookups that are found
+# are several times slower this way (see perf_test), and it is off by
+# default.
+
+
+def _intern(name):
+    """Interns str names, which are repeated all over a tree"""
+    if type(name) is str:
+        return intern(name)
+    return name
 
 
-class Hdf():
-    def __init__(self):
-        self._map = {}
+class Hdf(object):
+    # Set once an HdfOverlay is built on this Hdf
+    _read_only = False
+    # How many times an HdfOverlay put a node of its own in the place of a
+    # node of its base, which HdfPaths that hold the old one look out for
+    _takeovers = 0
+
+    def __init__(self, lazy_paths=False):
         self._root_dict = {}
+        self._lazy_paths = lazy_paths
+        # Returns the child of a node for writing, adding it if need be
+        self._step = _child_or_new_of
+        # Returns the child of a node for reading, or None
+        self._lookup = _child_of
+
+    @property
+    def _map(self):
+        """A flat dict of every node keyed by its full key.
+
+        This is built on each access, for debugging. Use get() to look up
+        nodes.
+        """
+        return dict((node._key, node) for node in self._walk())
+
+    def _walk(self, nodes=None):
+        """Yields nodes (by default the roots) and all of the nodes below
+        them, parents before their children, in order.
+        """
+        if nodes is None:
+            nodes = self._root_dict.values()
+        stack = [iter(nodes)]
+        while stack:
+            for node in stack[-1]:
+                yield node
+                if node._children:
+                    stack.append(iter(node._children))
+                    break
+            else:
+                stack.pop()
+
+    def _find(self, key):
+        """Returns the node for key, or None"""
+        if '.' not in key:
+            return self._root_dict.get(key)
+        names = key.split('.')
+        node = self._root_dict.get(names[0])
+        for name in names[1:]:
+            if node is None:
+                return None
+            node = type(node)._child(node, name)
+        return node
 
     def set_value(self, key, val):
         if not key and key == '':
             raise ValueError('key can not be blank')
 
-        node = self._map.get(key)
-        if node is None:
-            node = self.create_node(key)
-        node._val = val
-        if isinstance(val, HdfNode):
-            node._val = val._val
+        self._store(self.create_node(key), val)
         # Explicity return an empty string because when this is rendered
         # in Mako the value will be converted to a string and show in the
         # template.
         return ''
 
     def get(self, key, default=NotSet):
-        value = NullHdfNode(key, default)
-        if key in self._map:
-            logging.debug('Map has key %s' % key)
-            value = self._map.get(key)
-
+        if self._lazy_paths:
+            return HdfPath(self, key, default)
+        value = self._find(key)
+        if value is None:
+            if default is NotSet and not track_missing_paths:
+                return null_node
+            return NullHdfNode(key, default)
+        logging.debug('Map has key %s', key)
         return value
 
     def roots(self):
         """Get a copy of the dictionary of root nodes from this object."""
         return self._root_dict.copy()
 
-    def get_value_dict(self):
-        """Builds dict from all hdf nodes that have actual values."""
+    def get_value_dict(self, prefix=None, nested=False):
+        """Builds dict from all hdf nodes that have actual values.
+
+        prefix -- Only the node with this key and the nodes below it are
+            exported. Only that part of the tree is walked, so the cost is
+            that of the subtree. A missing prefix gives an empty dict.
+        nested -- Builds nested dicts keyed by name, like the ones update()
+            takes, instead of one dict keyed by full key. With a prefix,
+            they hold what is below the prefix. A node that has children
+            and a value keeps its value under the key ''.
+        """
+        if prefix is None:
+            nodes = self._root_dict.values()
+        else:
+            # Without taking the nodes over, in an HdfOverlay
+            top = Hdf._find(self, prefix)
+            if top is None:
+                return {}
+            if nested:
+                return self._nested_values(top._children, top._val)
+            nodes = [top]
+        if nested:
+            return self._nested_values(nodes)
         value_dict = {}
-        for name, node in self._map.items():
-            if node._val != NotSet:
-                value_dict[name] = node._val
+        for node in self._walk(nodes):
+            if node._val is not NotSet:
+                value_dict[node._key] = node._val
         return value_dict
 
+    def _nested_values(self, nodes, val=NotSet):
+        """Builds the nested dict of the values of nodes and the nodes
+        below them, with val under ''
+        """
+        result = {}
+        if val is not NotSet:
+            result[''] = val
+        # For each node with children: its children left to export, the
+        # dict of their values, and the dict and name to put that in.
+        stack = [(iter(nodes), result, None, None)]
+        while stack:
+            children, values, parent_values, name = stack[-1]
+            for node in children:
+                if node._children:
+                    child_values = {}
+                    if node._val is not NotSet:
+                        child_values[''] = node._val
+                    stack.append((iter(node._children), child_values, values,
+                                  node._name))
+                    break
+                if node._val is not NotSet:
+                    values[node._name] = node._val
+            else:
+                stack.pop()
+                # Nodes without any values below them are left out
+                if values and parent_values is not None:
+                    parent_values[name] = values
+        return result
+
+    def freeze(self):
+        """Returns a FrozenHdf with the contents of this Hdf as they are
+        now.
+
+        The nodes are copied and the values shared. Nodes that are frozen
+        already, like those an HdfOverlay of a FrozenHdf did not write
+        below, are shared rather than copied.
+        """
+        frozen = FrozenHdf(self._lazy_paths)
+        roots = _frozen_copies(self._root_dict.values())
+        frozen._root_dict = dict((node._key, node) for node in roots)
+        return frozen
+
     def create_node(self, key):
         """Instatiate a node, and build its parent nodes if need"""
+        return self._descend(None, key)
+
+    def _descend(self, parent, key):
+        """Returns the node for the dotted key below parent (None for the
+        roots), building the missing nodes on the way down.
+        """
+        if not isinstance(key, basestring):
+            key = str(key)
+        names = key.split('.')
+        node = parent
+        if node is None:
+            node = self._root(names[0])
+            names = names[1:]
+        step = self._step
+        for name in names:
+            node = step(node, name)
+        return node
+
+    def _set_read_only(self):
+        """Refuses any further changes, as an HdfOverlay shares the nodes.
 
-        # create_node('a.b.c')
-        # if a.b.c.d doesn't exist:
-        #     recursively build from a, a.b, a.b.c
+        The nodes refuse them too, so that nodes an overlay hands out can
+        not be changed under the other overlays. This walks the tree once,
+        the first time.
+        """
+        if self._read_only:
+            return
+        self._read_only = True
+        shared = _shared_classes
+        for node in self._walk():
+            cls = shared.get(type(node))
+            if cls is not None:
+                # The same layout, so the node stays where it is
+                node.__class__ = cls
 
-        if self._map.has_key(key):
-            return self._map[key]
+    def _root(self, name):
+        """Returns the root node called name for writing, adding it if need
+        be.
+        """
+        if self._read_only:
+            raise ValueError('Hdf is the base of an overlay, and can not be '
+                             'changed')
+        node = self._root_dict.get(name)
+        if node is None:
+            name = _intern(name)
+            node = self._root_dict[name] = HdfNode(name)
+        return node
 
-        sub_keys = key.split('.')
-        len_sub_keys = len(sub_keys)
+    def _store(self, node, val):
+        if isinstance(val, HdfPath):
+            val = val._resolve()
+        if isinstance(val, HdfNode):
+            val = val._val
+        node._val = val
 
-        parent = None
-        root_node = None
-        for i in xrange(len_sub_keys):
-            # i is the zero-count index of the current node
+    @classmethod
+    def from_dict(cls, mapping, lazy_paths=False):
+        """Builds an Hdf from mapping, as update() does"""
+        hdf = cls(lazy_paths)
+        hdf.update(mapping)
+        return hdf
 
-            # i=0: a
-            # i=1: a.b
-            # i=2: a.b.c
-            partial_key = '.'.join(sub_keys[:i+1])
+    def update(self, mapping):
+        """Sets the values of mapping, which is keyed by dotted keys.
 
-            node = self._map.get(partial_key)
+        Values that are dicts hold the children of their key, so nested
+        dicts, flat ones or a mix of the two all work:
+
+            hdf.update({'mg': {'event': {'id': 1}}, 'mg.user.name': 'x'})
+
+        In a nested dict, the key '' sets the value of the node of the dict
+        itself, as in get_value_dict(nested=True).
+
+        Each dict is walked once below the node of its key, and the parent
+        of dotted keys is only looked up once for all of its children,
+        rather than looking every key up from the roots as set_value()
+        does.
+        """
+        step = self._step
+        with _collection_paused():
+            # The node, items and parent nodes by dotted key of each dict
+            stack = [(None, mapping.iteritems(), {})]
+            while stack:
+                parent, items, parents = stack[-1]
+                for key, val in items:
+                    if not key and key == '':
+                        if parent is None or isinstance(val, dict):
+                            raise ValueError('key can not be blank')
+                        self._store(parent, val)
+                        continue
+                    if not isinstance(key, basestring):
+                        key = str(key)
+                    if '.' in key:
+                        prefix, _, key = key.rpartition('.')
+                        node = parents.get(prefix)
+                        if node is None:
+                            node = parents[prefix] = self._descend(
+                                parent, prefix)
+                    else:
+                        node = parent
+                    if node is None:
+                        node = self._descend(None, key)
+                    else:
+                        node = step(node, key)
+                    if isinstance(val, dict):
+                        stack.append((node, val.iteritems(), {}))
+                        break
+                    if isinstance(val, (HdfNode, HdfPath)):
+                        self._store(node, val)
+                    else:
+                        node._val = val
+                else:
+                    stack.pop()
+
+    def read_file(self, path):
+        """Reads a ClearSilver .hdf file, see read_string()"""
+        with open(path) as f:
+            text = f.read()
+        with _collection_paused():
+            self._read(text, None, os.path.dirname(path))
+
+    def read_string(self, text):
+        """Reads ClearSilver .hdf text, like hdf.readString() does:
+
+            # comment
+            mg.event.title = Value to the end of the line
+            mg.event {
+                id = 1
+                copy := mg.event.title
+                text << EOM
+            lines up to
+            EOM
+            }
+            #include "other.hdf"
+
+        The lines of a { } block are set below its node, which is only
+        looked up once. Links (name : other.key) are read as a copy of the
+        value, like :=, because Hdf has no links. Attributes in brackets
+        before the operator are skipped. Raises ValueError for lines that
+        can not be read.
+        """
+        with _collection_paused():
+            self._read(text, None, os.getcwd())
+
+    def _read(self, text, parent, directory):
+        # The nodes of the open { } blocks
+        stack = [parent]
+        step = self._step
+        lines = enumerate(text.splitlines(), 1)
+        for number, line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] == '#':
+                match = hdf_include_r.match(line)
+                if match is not None:
+                    with open(os.path.join(directory, match.group(1))) as f:
+                        self._read(f.read(), stack[-1], directory)
+                continue
+            if line == '}':
+                if len(stack) == 1:
+                    raise ValueError('line %d: } without {' % number)
+                stack.pop()
+                continue
+            match = hdf_line_r.match(line)
+            if match is None:
+                raise ValueError('line %d: can not read %r' % (number, line))
+            name, operator, value = match.groups()
+            parent = stack[-1]
+            if parent is None or '.' in name:
+                node = self._descend(parent, name)
+            else:
+                node = step(parent, name)
+            if operator == '=':
+                node._val = value
+            elif operator == '{':
+                if value:
+                    raise ValueError('line %d: text after {' % number)
+                stack.append(node)
+            elif operator == '<<':
+                start = number
+                value_lines = []
+                for number, line in lines:
+                    if line.strip() == value:
+                        break
+                    value_lines.append(line)
+                else:
+                    raise ValueError('line %d: %s is never ended' % (
+                        start, value))
+                node._val = '\n'.join(value_lines)
+            else:
+                # : and :=
+                source = self._find(value)
+                node._val = '' if source is None else source._val
+        if len(stack) > 1:
+            raise ValueError('%d { not closed' % (len(stack) - 1))
+
+    def dumps(self):
+        """Returns the contents of this Hdf as a string for loads().
+
+        The tree is written as flat arrays: the names of the nodes in
+        order, parents before their children, the index of the parent of
+        each, and the values with the index of their node. Values are
+        written with marshal where they can be, and with cPickle otherwise.
+        The indexes are in the byte order of the machine, so a dump is for
+        processes on the same kind of machine, like a pool of workers.
+        Pickling an Hdf writes this too.
+        """
+        data = self.__dict__.get('_dump')
+        if data is not None:
+            # Loaded, and never used since
+            return data
+        names = []
+        parents = array.array('i')
+        valued = array.array('i')
+        values = []
+        stack = [(iter(self._root_dict.values()), -1)]
+        while stack:
+            nodes, parent = stack[-1]
+            for node in nodes:
+                index = len(names)
+                key = node._key
+                name = key[key.rfind('.') + 1:]
+                if type(name) is str:
+                    # marshal writes each interned string once
+                    name = intern(name)
+                names.append(name)
+                parents.append(parent)
+                if node._val is not NotSet:
+                    valued.append(index)
+                    values.append(node._val)
+                if node._children:
+                    stack.append((iter(node._children), index))
+                    break
+            else:
+                stack.pop()
+        dump = [dump_format, names, parents.tostring(), valued.tostring(),
+                False, values]
+        try:
+            return marshal.dumps(tuple(dump), 2)
+        except ValueError:
+            dump[4:] = [True, cPickle.dumps(values, 2)]
+            return marshal.dumps(tuple(dump), 2)
+
+    @classmethod
+    def loads(cls, data, lazy_paths=False):
+        """Returns an Hdf with the contents of a string from dumps().
+
+        The nodes are only built the first time the Hdf is used, so an Hdf
+        that is loaded and passed on, or dumped again, costs next to
+        nothing.
+        """
+        hdf = cls(lazy_paths)
+        # __getattr__ builds it
+        del hdf._root_dict
+        hdf._dump = data
+        return hdf
+
+    def __getattr__(self, attr):
+        # Only called for attributes that are not set, like _root_dict of
+        # an Hdf from loads() before its first use
+        if attr == '_root_dict' and '_dump' in self.__dict__:
+            roots = self._root_dict = self._load_roots(self.__dict__['_dump'])
+            del self._dump
+            return roots
+        raise AttributeError(attr)
+
+    def _load_roots(self, data):
+        """Builds the nodes of a string from dumps(), and returns the roots
+        by name
+        """
+        try:
+            dump = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            dump = None
+        if type(dump) is not tuple or len(dump) != 6 or \
+                dump[0] != dump_format:
+            raise ValueError('not an Hdf dump')
+        names, parents, valued, pickled, values = dump[1:]
+        if pickled:
+            values = cPickle.loads(values)
+        parents = array.array('i', parents)
+        roots = {}
+        nodes = []
+        append = nodes.append
+        with _collection_paused():
+            for name, parent in itertools.izip(names, parents):
+                if parent < 0:
+                    node = roots[name] = HdfNode(name)
+                else:
+                    up = nodes[parent]
+                    node = HdfNode('%s.%s' % (up._key, name))
+                    if up._children:
+                        up._children.append(node)
+                    else:
+                        up._children = [node]
+                    up.__dict__[name] = node
+                append(node)
+            for index, val in itertools.izip(array.array('i', valued),
+                                             values):
+                nodes[index]._val = val
+        return roots
+
+    def __reduce__(self):
+        # Pickles as the string from dumps(), whatever kind of Hdf it is
+        return (_load_hdf, (Hdf, self.dumps(), self._lazy_paths))
+
+
+class HdfOverlay(Hdf):
+    """An Hdf that starts out with the contents of base, and keeps its own
+    changes to itself.
+
+    The base is built once and shared by any number of overlays. It
+    becomes read-only, and so do its nodes, which refuse changes as
+    FrozenHdfNodes do. Lookups return the nodes of the base, so they cost
+    about what they do there, and nothing is copied until something is
+    written. A write gives the nodes above it an _OverlayNode, which holds
+    the changes below it and reads through to the node of the base for the
+    rest, so a write costs the same however many children those nodes
+    have. get(), attribute lookups, iteration and get_value_dict() all see
+    the base with the changes on top.
+
+    The roots returned by get() belong to the overlay, so they see later
+    changes below them, as a rendered template needs for <?cs set ?>. A
+    node below a root is the one of the base until something below it is
+    written, and when it is held on to across such a write, it does not
+    see the write: look it up again, or use lazy_paths, as HdfPaths look
+    their nodes up again after such writes.
+    """
+    def __init__(self, base, lazy_paths=False):
+        Hdf.__init__(self, lazy_paths)
+        base._set_read_only()
+        self._base = base
+        self._root_dict = dict(base._root_dict)
+        # ids of the nodes that were made or added by this overlay
+        self._owned = set()
+        self._step = self._owned_child
+
+    def _own_root(self, name):
+        """Returns the root called name for this overlay, or None"""
+        node = self._root_dict.get(name)
+        if node is not None and id(node) not in self._owned:
+            node = self._root_dict[name] = _OverlayNode(node)
+            self._owned.add(id(node))
+            self._takeovers += 1
+        return node
+
+    def _root(self, name):
+        node = None
+        if not self._read_only:
+            node = self._own_root(name)
+        if node is None:
+            node = Hdf._root(self, name)
+            self._owned.add(id(node))
+        return node
+
+    def _owned_child(self, node, name):
+        """Returns the child called name of a node of this overlay, giving
+        it an _OverlayNode or adding it as need be.
+        """
+        cls = type(node)
+        child = cls._child(node, name)
+        if child is None:
+            child = cls._child_or_new(node, name)
+            self._owned.add(id(child))
+        elif id(child) not in self._owned:
+            # Only _OverlayNodes have children that are not owned
+            child = cls._take_over(node, name, child)
+            self._owned.add(id(child))
+            self._takeovers += 1
+        return child
+
+    def _find(self, key):
+        if self._read_only:
+            return Hdf._find(self, key)
+        names = key.split('.')
+        node = self._own_root(names[0])
+        for name in names[1:]:
             if node is None:
-                node = HdfNode(hdf=self, key=partial_key)
+                return None
+            node = type(node)._child(node, name)
+        return node
+
+
+class FrozenHdf(Hdf):
+    """An immutable snapshot of an Hdf, made by Hdf.freeze().
+
+    It reads like the Hdf it was made from: get(), attribute lookups,
+    iteration, comparisons and get_value_dict() all work as they do there,
+    so it can be rendered in place of the Hdf. set_value() and the other
+    ways of loading raise ValueError. Templates that set values can be
+    rendered with an HdfOverlay of it, which shares its nodes.
+
+    fingerprint() digests the whole tree or the subtree of a key, for use as
+    the key of a cache of rendered output. Frozen Hdfs with the same values
+    compare equal and have the same hash.
+    """
+    _read_only = True
+
+    def __init__(self, lazy_paths=False):
+        Hdf.__init__(self, lazy_paths)
+        self._fingerprint = None
+
+    def freeze(self):
+        return self
+
+    def _root(self, name):
+        raise ValueError('Hdf is frozen, and can not be changed')
+
+    def fingerprint(self, prefix=None):
+        """Returns a hex digest of the names and values of the whole tree,
+        or of the node with the key prefix and the nodes below it.
+
+        It only changes when a name or value in that part of the tree does,
+        so a subtree with the same contents has the same fingerprint in any
+        snapshot. Only the subtree is walked, and only the first time, as
+        the digest of every node is kept. A missing prefix gives None.
+
+        Values are digested by their repr(), so they are the same from one
+        process to the next for strings and numbers, but not for objects
+        whose repr() holds their address.
+        """
+        if prefix is not None:
+            node = Hdf._find(self, prefix)
+            if node is None:
+                return None
+            return FrozenHdfNode._digest(node).encode('hex')
+        if self._fingerprint is None:
+            roots = self._root_dict
+            digest = FrozenHdfNode._digest
+            self._fingerprint = hashlib.sha1(''.join(
+                digest(roots[name]) for name in sorted(roots))).hexdigest()
+        return self._fingerprint
+
+    def _load_roots(self, data):
+        roots = _frozen_copies(Hdf._load_roots(self, data).values())
+        return dict((node._key, node) for node in roots)
+
+    def __reduce__(self):
+        return (_load_hdf, (FrozenHdf, self.dumps(), self._lazy_paths))
+
+    def __hash__(self):
+        return hash(self.fingerprint())
+
+    def __eq__(self, other):
+        if not isinstance(other, FrozenHdf):
+            return NotImplemented
+        return self.fingerprint() == other.fingerprint()
+
+    def __ne__(self, other):
+        if not isinstance(other, FrozenHdf):
+            return NotImplemented
+        return self.fingerprint() != other.fingerprint()
+
+
+@contextlib.contextmanager
+def _collection_paused():
+    """Turns off the cyclic garbage collector while a tree is loaded.
+
+    Nodes never form cycles, but every few hundred new nodes would set off
+    a collection that goes over the whole tree built so far.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _load_hdf(cls, data, lazy_paths):
+    """Unpickles an Hdf, see Hdf.__reduce__()"""
+    return cls.loads(data, lazy_paths)
+
+
+
+def _frozen_copies(nodes):
+    """Returns FrozenHdfNode copies of nodes and of the nodes below them.
+
+    Nodes that are frozen already are shared rather than copied.
+    """
+    roots = []
+    with _collection_paused():
+        # For each node with children: its children left to copy, their
+        # copies so far, and the copy of the node to give them to.
+        stack = [(iter(nodes), roots, None)]
+        while stack:
+            nodes, copies, parent = stack[-1]
+            for node in nodes:
+                if type(node) is FrozenHdfNode:
+                    copies.append(node)
+                    continue
+                copy = FrozenHdfNode(node._key, node._val)
+                copies.append(copy)
+                if node._children:
+                    stack.append((iter(node._children), [], copy))
+                    break
+            else:
+                stack.pop()
                 if parent is not None:
-                    parent._children.append(node)
-            parent = node
-            if root_node is None:
-                root_node = node
+                    FrozenHdfNode._freeze_children(parent, copies)
+    return roots
+
+
+# A line of a .hdf file: name [attributes] operator value
+hdf_line_r = re.compile(
+    r'([^\s=:<{\[]+)\s*(?:\[[^\]]*\]\s*)?(:=|=|:|<<|\{)\s*(.*)$')
+hdf_include_r = re.compile(r'#include\s+"([^"]+)"')
+
+# The first item of what Hdf.dumps() writes, changed with the layout
+dump_format = 'hdf-dump-1'
+
 
-        self._root_dict[sub_keys[0]] = root_node
-        return self._map[key]
+# The children of every leaf node, until it gets a child of its own. This
+# is shared, and never modified.
+no_children = ()
+
+
+class _node_method(object):
+    """Keeps a method of HdfNode ahead of a child node of the same name.
+
+    Attribute lookup tries the instance __dict__, where the children are,
+    before plain methods, but after data descriptors like this one.
+    """
+    def __init__(self, function):
+        self._function = function
+        self.__doc__ = function.__doc__
+
+    def __get__(self, obj, objtype=None):
+        return self._function.__get__(obj, objtype)
+
+    def __set__(self, obj, value):
+        raise AttributeError("can't set attribute")
+
+
+def _to_number(val):
+    """float(val) as HdfNode uses it, or None when val is not set"""
+    if val == NotSet:
+        return None
+    try:
+        return float(val)
+    except ValueError:
+        return 0.0
 
 
 class HdfNode(object):
-    # __slots__ = ('_hdf', '_key', '_name', '_val', '_children', )
-    def __init__(self, hdf, key, val=NotSet):
-        self._hdf = weakref.ref(hdf)
+    # Trees have hundreds of thousands of nodes. Only nodes with children
+    # get a __dict__, which holds the children by name. _children keeps
+    # them in order.
+    # _number_cache and _text_cache hold (value, converted value) once the
+    # value was used as a number or as text, and are only used while _val
+    # is still that value, so changing _val in any way clears them.
+    __slots__ = ('_key', '_val', '_children', '_number_cache', '_text_cache',
+                 '__dict__', )
+    def __init__(self, key, val=NotSet):
         self._key = key
+        self._val = val
+        self._children = no_children
+        self._number_cache = None
+        self._text_cache = None
 
-        # if: key = 'a.b.c.d'
-        # then: name = 'd'
-        # if: key = 'a'
-        # then: name = 'a'
-        self._name = key[key.rfind('.')+1:]
-        hdf._map[ key ] = self
+    @property
+    def _name(self):
+        """The last part of the key
 
-        self._val = val
-        self._children = []
+        if: key = 'a.b.c.d'
+        then: name = 'd'
+        if: key = 'a'
+        then: name = 'a'
+        """
+        key = self._key
+        return key[key.rfind('.')+1:]
+
+    @property
+    def _child_map(self):
+        """The children by name"""
+        if self._children:
+            return self.__dict__
+        return {}
 
+    def _child(self, name):
+        """Returns the child called name, or None"""
+        # Leaves have no __dict__ until something asks for one
+        if self._children:
+            return self.__dict__.get(name)
+        return None
+
+    def _child_or_new(self, name):
+        """Returns the child called name, adding it if there is none"""
+        children = self._children
+        if children:
+            child = self.__dict__.get(name)
+            if child is not None:
+                return child
+        if type(name) is str:
+            name = intern(name)
+        child = HdfNode("%s.%s" % (self._key, name))
+        if children:
+            children.append(child)
+        else:
+            self._children = [child]
+        self.__dict__[name] = child
+        return child
+
+    @_node_method
     def num_children(self):
         """Returns the number of child nodes that this node has."""
         return len(self._children)
@@ -138,28 +824,60 @@ class HdfNode(object):
         self._val = val
 
     def __getitem__(self, key):
-        return self.__getattr__(key)
+        if not isinstance(key, basestring):
+            key = str(key)
+        node = self
+        for name in key.split('.'):
+            node = type(node)._child(node, name)
+            if node is None:
+                if track_missing_paths:
+                    return NullHdfNode(("%s.%s" % (self._key, key)))
+                return null_node
+        return node
     def __getattr__(self, attr):
-        try:
-            return self._hdf()._map[ "%s.%s" % (self._key, attr) ]
-        except KeyError:
+        # attr is not a child, or it would have been found in __dict__
+        if track_missing_paths:
             return NullHdfNode(("%s.%s" % (self._key, attr)))
+        return null_node
 
+    @_node_method
     def find(self, arg):
         return string.find(str(self._val), arg)
+    # The operators check the caches themselves, and only call these when
+    # the value has changed, as a call costs more than the conversion.
+    def _cache_number(self):
+        val = self._val
+        cache = self._number_cache = (val, _to_number(val))
+        return cache
+
+    def _cache_text(self):
+        val = self._val
+        cache = self._text_cache = (val, unicode(val))
+        return cache
+
     def __str__(self):
-        return unicode(self._val)
+        cache = self._text_cache
+        if cache is None or cache[0] is not self._val:
+            cache = type(self)._cache_text(self)
+        return cache[1]
 
     def __unicode__(self):
-        return unicode(self._val)
+        cache = self._text_cache
+        if cache is None or cache[0] is not self._val:
+            cache = type(self)._cache_text(self)
+        return cache[1]
 
     def __int__(self):
-        val = 0
+        cache = self._number_cache
+        if cache is None or cache[0] is not self._val:
+            cache = type(self)._cache_number(self)
+        if cache[1] is None:
+            return 0
         try:
-            val = int(float(self._val))
+            return int(cache[1])
         except ValueError:
-            pass
-        return val
+            # nan
+            return 0
     def __long__(self):
         val = 0.0
         try:
@@ -168,12 +886,12 @@ class HdfNode(object):
             pass
         return val
     def __float__(self):
-        val = 0.0
-        try:
-            val = float(self._val)
-        except ValueError:
-            pass
-        return val
+        cache = self._number_cache
+        if cache is None or cache[0] is not self._val:
+            cache = type(self)._cache_number(self)
+        if cache[1] is None:
+            return 0.0
+        return cache[1]
     def __oct__(self):
         try:
             return oct(self._val)
@@ -191,31 +909,45 @@ class HdfNode(object):
             return self is other
         if self._val == NotSet and not bool(other):
             return True
-        return unicode(self._val) == unicode(other)
+        cache = self._text_cache
+        if cache is None or cache[0] is not self._val:
+            cache = type(self)._cache_text(self)
+        return cache[1] == unicode(other)
     def __ne__(self, other):
         if self._val == NotSet:
-            return not self.__eq__(other)
-        return unicode(self._val) != unicode(other)
+            return not HdfNode.__eq__(self, other)
+        cache = self._text_cache
+        if cache is None or cache[0] is not self._val:
+            cache = type(self)._cache_text(self)
+        return cache[1] != unicode(other)
     def __lt__(self, other):
-        if self._val == NotSet:
+        cache = self._number_cache
+        if cache is None or cache[0] is not self._val:
+            cache = type(self)._cache_number(self)
+        if cache[1] is None:
             return False
-        else:
-            return float(self) < other
+        return cache[1] < other
     def __gt__(self, other):
-        if self._val == NotSet:
+        cache = self._number_cache
+        if cache is None or cache[0] is not self._val:
+            cache = type(self)._cache_number(self)
+        if cache[1] is None:
             return False
-        else:
-            return float(self) > other
+        return cache[1] > other
     def __le__(self, other):
-        if self._val == NotSet:
+        cache = self._number_cache
+        if cache is None or cache[0] is not self._val:
+            cache = type(self)._cache_number(self)
+        if cache[1] is None:
             return True
-        else:
-            return float(self) <= other
+        return cache[1] <= other
     def __ge__(self, other):
-        if self._val == NotSet:
+        cache = self._number_cache
+        if cache is None or cache[0] is not self._val:
+            cache = type(self)._cache_number(self)
+        if cache[1] is None:
             return True
-        else:
-            return float(self) >= other
+        return cache[1] >= other
     def __nonzero__(self):
         if self._val == NotSet:
             return self.num_children() > 0
@@ -243,22 +975,387 @@ class HdfNode(object):
         return other - int(self)
 
 class NullHdfNode(HdfNode):
+    """What lookups of keys that are not in the Hdf return.
+
+    They are shared, so they can not be changed.
+    """
+    __slots__ = ()
     def __init__(self, key, default_value=NotSet):
-        self._key = key
-        self._val = default_value
-        self._children = []
+        _set_attribute = object.__setattr__
+        _set_attribute(self, '_key', key)
+        _set_attribute(self, '_val', default_value)
+        _set_attribute(self, '_children', no_children)
+        _set_attribute(self, '_number_cache', None)
+        _set_attribute(self, '_text_cache', None)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("%s is not in the Hdf" % (self._key or 'node',))
+
+    def _set_value(self, val):
+        type(self).__setattr__(self, '_val', val)
+
+    # Converts every time, as the caches can not be set either
+    def _cache_number(self):
+        return (self._val, _to_number(self._val))
+
+    def _cache_text(self):
+        return (self._val, unicode(self._val))
 
     def __getattr__(self, attr):
-        return NullHdfNode(("%s.%s" % (self._key, attr)))
+        if track_missing_paths:
+            return NullHdfNode(("%s.%s" % (self._key, attr)))
+        return null_node
 
     def __getitem__(self, attr):
-        return NullHdfNode(("%s.%s" % (self._key, attr)))
+        if track_missing_paths:
+            return NullHdfNode(("%s.%s" % (self._key, attr)))
+        return null_node
 
     def __call__(self, *args):
         # Take args, convert the values to strings and join with commas
         arg_string = reduce(lambda x, y: "%s, %s" % (str(x), str(y)), args)
         return "%s(%s)" % (self._val, arg_string)
 
+
+# Misses return this one node rather than a new NullHdfNode for the key that
+# is missing, and a lookup below it returns it again. Set
+# track_missing_paths for missing nodes that know their key, which costs a
+# node and a key for every step of a missing lookup.
+null_node = NullHdfNode('')
+track_missing_paths = False
+
+
+class FrozenHdfNode(HdfNode):
+    """A node of a FrozenHdf, which can not be changed.
+
+    The children are kept in a tuple. _fingerprint holds the digest of the
+    node and the nodes below it once fingerprint() needed it, which stays
+    good as none of them can change.
+    """
+    __slots__ = ('_fingerprint', )
+    def __init__(self, key, val=NotSet):
+        # Through the slots, as __setattr__ refuses
+        _set_key(self, key)
+        _set_val(self, val)
+        _set_children(self, no_children)
+        _set_number_cache(self, None)
+        _set_text_cache(self, None)
+        _set_fingerprint(self, None)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("%s is frozen" % (self._key, ))
+
+    def _set_value(self, val):
+        type(self).__setattr__(self, '_val', val)
+
+    def _freeze_children(self, children):
+        """Gives the node its children, once, while it is being frozen"""
+        _set_children(self, tuple(children))
+        child_map = self.__dict__
+        start = len(self._key) + 1
+        for child in children:
+            name = child._key[start:]
+            if type(name) is str:
+                name = intern(name)
+            child_map[name] = child
+
+    # The value never changes, so the caches are only filled once
+    def _cache_number(self):
+        cache = (self._val, _to_number(self._val))
+        _set_number_cache(self, cache)
+        return cache
+
+    def _cache_text(self):
+        cache = (self._val, unicode(self._val))
+        _set_text_cache(self, cache)
+        return cache
+
+    def _digest(self):
+        """Returns the sha1 digest of the name and value of the node and of
+        the digests of its children, in order.
+        """
+        if self._fingerprint is not None:
+            return self._fingerprint
+        # The nodes without a digest, parents before their children, so
+        # that going through them backwards digests children first
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend([child for child in node._children
+                          if child._fingerprint is None])
+        sha1 = hashlib.sha1
+        for node in reversed(nodes):
+            key = node._key
+            name = key[key.rfind('.') + 1:]
+            if node._val is NotSet:
+                header = '%r\0' % (name, )
+            else:
+                header = '%r\0%r\0' % (name, node._val)
+            if node._children:
+                header += ''.join([child._fingerprint
+                                   for child in node._children])
+            _set_fingerprint(node, sha1(header).digest())
+        return self._fingerprint
+
+
+# Setters of the slots of a node, which FrozenHdfNode goes through
+_set_key = HdfNode._key.__set__
+_set_val = HdfNode._val.__set__
+_set_children = HdfNode._children.__set__
+_set_number_cache = HdfNode._number_cache.__set__
+_set_text_cache = HdfNode._text_cache.__set__
+_set_fingerprint = FrozenHdfNode._fingerprint.__set__
+
+
+_get_children = HdfNode._children.__get__
+
+
+def _child_of(node, name):
+    """node._child(name), for Hdf._lookup"""
+    return type(node)._child(node, name)
+
+
+def _child_or_new_of(node, name):
+    """node._child_or_new(name), for Hdf._step"""
+    return type(node)._child_or_new(node, name)
+
+
+class _OverlayNode(HdfNode):
+    """A node of an HdfOverlay, over the node of its base with the same key.
+
+    The value is its own. Its __dict__ holds the children that were looked
+    up by attribute, the ones that were written below, which are
+    _OverlayNodes too, and the ones that were added, which are also in
+    _added. Any other child is the one of the base node. _children is made
+    from the children of the base node when it is used, and kept until a
+    child is replaced or added.
+    """
+    __slots__ = ('_base', '_added')
+    def __init__(self, base):
+        # Not HdfNode.__init__, as _children is not set here
+        self._key = base._key
+        self._val = base._val
+        self._number_cache = None
+        self._text_cache = None
+        self._base = base
+        self._added = no_children
+        _set_children(self, None)
+
+    @property
+    def _children(self):
+        children = _get_children(self)
+        if children is None:
+            own = self.__dict__
+            start = len(self._key) + 1
+            children = [own.get(child._key[start:], child)
+                        for child in self._base._children]
+            children.extend(self._added)
+            _set_children(self, children)
+        return children
+
+    @property
+    def _child_map(self):
+        start = len(self._key) + 1
+        return dict((child._key[start:], child) for child in self._children)
+
+    def _child(self, name):
+        child = self.__dict__.get(name)
+        if child is None:
+            child = _child_of(self._base, name)
+        return child
+
+    def _child_or_new(self, name):
+        child = _OverlayNode._child(self, name)
+        if child is not None:
+            return child
+        if type(name) is str:
+            name = intern(name)
+        child = HdfNode("%s.%s" % (self._key, name))
+        self.__dict__[name] = child
+        if self._added:
+            self._added.append(child)
+        else:
+            self._added = [child]
+        _set_children(self, None)
+        return child
+
+    def _take_over(self, name, child):
+        """Returns an _OverlayNode over child, the child called name of the
+        base node, which takes its place
+        """
+        child = self.__dict__[name] = _OverlayNode(child)
+        _set_children(self, None)
+        return child
+
+    @_node_method
+    def num_children(self):
+        """Returns the number of child nodes that this node has."""
+        return len(self._base._children) + len(self._added)
+
+    def __getattr__(self, attr):
+        # attr is not in __dict__ yet
+        child = _child_of(self._base, attr)
+        if child is None:
+            return HdfNode.__getattr__(self, attr)
+        # So that the next lookup finds it where it finds those of an HdfNode
+        self.__dict__[attr] = child
+        return child
+
+
+class _SharedNode(object):
+    """What the nodes of the base of an HdfOverlay become, see
+    Hdf._set_read_only. Like FrozenHdfNode, they refuse changes.
+    """
+    __slots__ = ()
+    def __setattr__(self, attr, value):
+        raise AttributeError("%s is in the base of an HdfOverlay" % (
+            self._key, ))
+
+    def _set_value(self, val):
+        type(self).__setattr__(self, '_val', val)
+
+    # The value never changes, so the caches are only filled once
+    def _cache_number(self):
+        cache = (self._val, _to_number(self._val))
+        _set_number_cache(self, cache)
+        return cache
+
+    def _cache_text(self):
+        cache = (self._val, unicode(self._val))
+        _set_text_cache(self, cache)
+        return cache
+
+
+class _SharedHdfNode(_SharedNode, HdfNode):
+    __slots__ = ()
+
+
+class _SharedOverlayNode(_SharedNode, _OverlayNode):
+    __slots__ = ()
+
+
+# The class each kind of node becomes in the base of an HdfOverlay
+_shared_classes = {
+    HdfNode: _SharedHdfNode,
+    _OverlayNode: _SharedOverlayNode,
+}
+
+
+# What an HdfPath looks up on its node rather than taking as a child name
+_node_attributes = frozenset(dir(HdfNode))
+
+
+class HdfPath(object):
+    """A lookup path in an Hdf, looked up when it is used.
+
+    hdf.get('mg').a.b only records the names. The first time the path is
+    used, _resolve() walks down once from the nearest part of the path that
+    has been used before, and every operation is passed on to the node
+    found, or to a NullHdfNode for the whole path when it is missing. Found
+    nodes are kept, missing paths are looked up again on each use, as they
+    may have been set since. Kept nodes are looked up again too once an
+    HdfOverlay may have put nodes of its own in their place.
+    """
+    __slots__ = ('_path_parent', '_path_name', '_path_default', '_node',
+                 '_path_hdf', '_stamp')
+
+    def __init__(self, parent, name, default=NotSet):
+        # parent is the Hdf for the first name of a path
+        self._path_parent = parent
+        self._path_name = name
+        self._path_default = default
+        self._node = None
+        if type(parent) is HdfPath:
+            self._path_hdf = parent._path_hdf
+        else:
+            self._path_hdf = parent
+        # hdf._takeovers when _node was found
+        self._stamp = 0
+
+    def _missing(self):
+        if track_missing_paths:
+            return NullHdfNode(self._path_key())
+        return null_node
+
+    def _path_key(self):
+        names = []
+        path = self
+        while type(path) is HdfPath:
+            names.append(path._path_name)
+            path = path._path_parent
+        names.reverse()
+        return '.'.join(names)
+
+    def _resolve(self):
+        """Returns the node at this path"""
+        node = self._node
+        hdf = self._path_hdf
+        stamp = hdf._takeovers
+        if node is not None and self._stamp == stamp:
+            return node
+        paths = []
+        path = self
+        while type(path) is HdfPath and (path._node is None or
+                                         path._stamp != stamp):
+            paths.append(path)
+            path = path._path_parent
+        paths.reverse()
+        if path is hdf:
+            first = paths.pop(0)
+            node = hdf._find(first._path_name)
+            if node is None:
+                if first is self and self._path_default is not NotSet:
+                    return NullHdfNode(self._path_name, self._path_default)
+                return self._missing()
+            first._node = node
+            first._stamp = stamp
+        else:
+            node = path._node
+        lookup = hdf._lookup
+        for path in paths:
+            node = lookup(node, path._path_name)
+            if node is None:
+                return self._missing()
+            path._node = node
+            path._stamp = stamp
+        return node
+
+    def __getattr__(self, attr):
+        if attr in _node_attributes:
+            return getattr(self._resolve(), attr)
+        return HdfPath(self, attr)
+
+    def __getitem__(self, key):
+        if not isinstance(key, basestring):
+            key = str(key)
+        path = self
+        for name in key.split('.'):
+            path = HdfPath(path, name)
+        return path
+
+    def __iter__(self):
+        return iter(self._resolve())
+
+    def __call__(self, *args):
+        return self._resolve()(*args)
+
+
+def _pass_on(name):
+    function = getattr(HdfNode, name)
+    def method(self, *args):
+        return function(self._resolve(), *args)
+    method.__name__ = name
+    return method
+
+for name in ('__str__', '__unicode__', '__repr__', '__hash__', '__int__',
+             '__long__', '__float__', '__oct__', '__hex__', '__eq__', '__ne__',
+             '__lt__', '__gt__', '__le__', '__ge__', '__nonzero__', '__len__',
+             '__add__', '__radd__', '__sub__', '__rsub__'):
+    setattr(HdfPath, name, _pass_on(name))
+del name
+
 if __name__ == "__main__":
     import unittest
 
@@ -383,20 +1480,701 @@ if __name__ == "__main__":
                 # python 2.7: self.assertGreater(len(n), len(previous))
                 previous = n
 
-    def perf_test():
+        def test_30_compact_nodes(self):
+            self.hdf.set_value('mg.a.b', 'x')
+            mg = self.hdf.get('mg')
+            leaf = mg.a.b
+            self.assertEqual(leaf._children, ())
+            self.assertEqual(leaf.num_children(), 0)
+            self.assertEqual(mg.a._children, [leaf])
+            self.assertTrue(mg.a._child_map['b'] is leaf)
+            missing = mg.a.c.d
+            self.assertTrue(missing is null_node)
+            self.assertFalse(missing)
+            self.assertEqual(list(missing), [])
+
+        def test_31_tree(self):
+            for key in ('a.b.c', 'a.b.d', 'a.x', 'a.b.d.e', 'z'):
+                self.hdf.set_value(key, key)
+            self.assertEqual(self.hdf.get('a.b.d')._val, 'a.b.d')
+            self.assertEqual(self.hdf.get('a.b.d.e')._key, 'a.b.d.e')
+            self.assertTrue(isinstance(self.hdf.get('a.q'), NullHdfNode))
+            a = self.hdf.get('a')
+            self.assertEqual([n._name for n in a.b], ['c', 'd'])
+            self.assertEqual(a['b.d.e']._val, 'a.b.d.e')
+            self.assertTrue(a['b.q'] is null_node)
+            self.assertEqual(sorted(self.hdf._map),
+                ['a', 'a.b', 'a.b.c', 'a.b.d', 'a.b.d.e', 'a.x', 'z'])
+            self.assertEqual(self.hdf.get_value_dict(), {
+                'a.b.c': 'a.b.c', 'a.b.d': 'a.b.d', 'a.x': 'a.x',
+                'a.b.d.e': 'a.b.d.e', 'z': 'z'})
+
+        def test_32_numeric_index(self):
+            self.hdf.set_value('mg.items.0', 'first')
+            self.assertEqual(str(self.hdf.get('mg').items[0]), 'first')
+
+        def test_33_children_named_like_methods(self):
+            self.hdf.set_value('mg.find', 'child')
+            self.hdf.set_value('mg.num_children', 'child')
+            mg = self.hdf.get('mg')
+            self.assertEqual(mg.num_children(), 2)
+            self.assertEqual(str(mg['find']), 'child')
+            self.assertEqual(str(self.hdf.get('mg.num_children')), 'child')
+
+        def test_37_children_named_like_internals(self):
+            names = ('_child', '_child_or_new', '_cache_text',
+                     '_cache_number', '_set_value', '_take_over', '_digest',
+                     '_freeze_children', '__eq__', '__setattr__')
+            for name in names:
+                self.hdf.set_value('a.%s' % name, name)
+            self.hdf.set_value('a.x', 'x')
+            self.hdf.set_value('a', 'a')
+            frozen = self.hdf.freeze()
+            overlay = HdfOverlay(frozen)
+            overlay.set_value('a._child.y', 'y')
+            for hdf in (self.hdf, frozen, overlay,
+                        Hdf.loads(self.hdf.dumps(), lazy_paths=True)):
+                a = hdf.get('a')
+                self.assertEqual(str(hdf.get('a.x')), 'x')
+                self.assertEqual(unicode(a), u'a')
+                self.assertEqual(int(a), 0)
+                self.assertTrue(a != 'b')
+                for name in names:
+                    self.assertEqual(str(hdf.get('a.' + name)), name)
+                    self.assertEqual(str(a[name]), name)
+            self.assertEqual(str(overlay.get('a._child.y')), 'y')
+            self.assertTrue(frozen.fingerprint('a'))
+            self.assertRaises(AttributeError, FrozenHdfNode._set_value,
+                              frozen.get('a'), 1)
+
+        def test_34_missing_nodes(self):
+            global track_missing_paths
+            self.hdf.set_value('mg.a', 'x')
+            mg = self.hdf.get('mg')
+            for missing in (mg.b, mg.b.c.d, mg['b.c'], mg.a.b,
+                            self.hdf.get('mg.q'), self.hdf.get('q')):
+                self.assertTrue(missing is null_node)
+            self.assertFalse(null_node)
+            self.assertEqual((str(null_node), int(null_node),
+                              float(null_node), len(null_node)),
+                             ('', 0, 0.0, 0))
+            self.assertTrue(null_node == '' and null_node == 0)
+            self.assertFalse(null_node == 'x' or null_node > 0)
+            self.assertEqual(null_node + 1, 1)
+            self.assertRaises(AttributeError, setattr, null_node, '_val', 1)
+            self.assertRaises(AttributeError, null_node._set_value, 1)
+            self.assertEqual(null_node._val, NotSet)
+            default = self.hdf.get('q', 'd')
+            self.assertEqual(str(default), 'd')
+            self.assertTrue(default.x is null_node)
+            track_missing_paths = True
+            try:
+                self.assertEqual(mg.b.c['d.e']._key, 'mg.b.c.d.e')
+                self.assertEqual(mg.a.b._name, 'b')
+                self.assertEqual(self.hdf.get('mg.q')._key, 'mg.q')
+                lazy = Hdf(lazy_paths=True)
+                self.assertEqual(lazy.get('mg').x.y._key, 'mg.x.y')
+            finally:
+                track_missing_paths = False
+
+        def test_35_cached_conversions(self):
+            self.hdf.set_value('mg.n', '3')
+            n = self.hdf.get('mg').n
+            self.assertTrue(n > 2 and int(n) == 3)
+            self.assertTrue(n == '3' and str(n) == '3')
+            for write in (lambda: self.hdf.set_value('mg.n', '1.5'),
+                          lambda: n._set_value('1.5'),
+                          lambda: self.hdf.update({'mg': {'n': '1.5'}}),
+                          lambda: self.hdf.read_string('mg.n = 1.5')):
+                self.hdf.set_value('mg.n', '3')
+                self.assertTrue(n > 2 and n == '3')
+                write()
+                self.assertFalse(n > 2)
+                self.assertEqual((int(n), float(n), str(n), n == '1.5'),
+                                 (1, 1.5, '1.5', True))
+            n._set_value('x')
+            self.assertEqual((int(n), float(n), n > -1), (0, 0.0, True))
+            n._set_value(NotSet)
+            self.assertEqual((int(n), n > -1, n <= -1), (0, False, True))
+
+        def test_36_value_dict_prefix(self):
+            for key in ('mg.event.id', 'mg.event.name', 'mg.event.t.0',
+                        'mg.eventful', 'mg.user', 'mg.user.id', 'z'):
+                self.hdf.set_value(key, key)
+            self.hdf.create_node('mg.event.empty.child')
+            full = self.hdf.get_value_dict()
+            self.assertEqual(self.hdf.get_value_dict('mg.event'), dict(
+                (k, v) for k, v in full.items()
+                if k.startswith('mg.event.')))
+            self.assertEqual(self.hdf.get_value_dict('mg.user'), {
+                'mg.user': 'mg.user', 'mg.user.id': 'mg.user.id'})
+            self.assertEqual(self.hdf.get_value_dict('mg.nothing'), {})
+            self.assertEqual(
+                self.hdf.get_value_dict('mg.event', nested=True),
+                {'id': 'mg.event.id', 'name': 'mg.event.name',
+                 't': {'0': 'mg.event.t.0'}})
+            nested = self.hdf.get_value_dict(nested=True)
+            self.assertEqual(nested['mg']['user'], {
+                '': 'mg.user', 'id': 'mg.user.id'})
+            self.assertEqual(Hdf.from_dict(nested).get_value_dict(), full)
+            self.assertEqual(self.hdf.get_value_dict('mg.user', nested=True),
+                             {'': 'mg.user', 'id': 'mg.user.id'})
+
+    class TestHdfPath(unittest.TestCase):
+        def setUp(self):
+            self.eager = Hdf()
+            self.lazy = Hdf(lazy_paths=True)
+            for hdf in (self.eager, self.lazy):
+                hdf.set_value('mg.a.b', 'x')
+                hdf.set_value('mg.a.n', '3')
+                hdf.set_value('mg.a.zero', '0')
+                hdf.set_value('mg.items.0', 'first')
+                hdf.set_value('mg.items.1', 'second')
+
+        def check(self, fn):
+            def outcome(hdf):
+                try:
+                    return fn(hdf.get('mg'))
+                except Exception, e:
+                    return type(e)
+            self.assertEqual(outcome(self.eager), outcome(self.lazy))
+
+        def test_same_as_nodes(self):
+            for path in (lambda mg: mg.a.b, lambda mg: mg.a.n,
+                         lambda mg: mg.a.zero, lambda mg: mg.a,
+                         lambda mg: mg.missing.deep.path, lambda mg: mg.a.q,
+                         lambda mg: mg['a.n'], lambda mg: mg.items[1],
+                         lambda mg: mg.a['q.r']):
+                for fn in (str, unicode, int, float, long, bool, len, hex,
+                           lambda x: x._key, lambda x: x._val,
+                           lambda x: x.num_children(),
+                           lambda x: x.find('x'), lambda x: x == 'x',
+                           lambda x: x != '3', lambda x: x > 2,
+                           lambda x: x <= 2, lambda x: x + 1,
+                           lambda x: 'p' + x, lambda x: 5 - x,
+                           lambda x: [str(n) for n in x],
+                           lambda x: x == x):
+                    self.check(lambda mg: fn(path(mg)))
+
+        def test_missing_path(self):
+            missing = self.lazy.get('mg').missing.deep
+            self.assertTrue(isinstance(missing, HdfPath))
+            self.assertTrue(missing._resolve() is null_node)
+            self.assertEqual(self.lazy.get('nope', 'd')._val, 'd')
+            self.assertTrue(self.lazy.get('nope', 'd').a._resolve()
+                            is null_node)
+            self.lazy.set_value('mg.missing.deep', 'now')
+            self.assertEqual(str(missing), 'now')
+
+        def test_set_value_from_path(self):
+            self.lazy.set_value('mg.copy', self.lazy.get('mg').a.b)
+            self.assertEqual(self.lazy.get_value_dict()['mg.copy'], 'x')
+
+    class TestHdfLoading(unittest.TestCase):
+        def test_update(self):
+            from collections import OrderedDict
+            expected = Hdf()
+            for key, val in (('mg.a', 1), ('mg.b.c', 'x'), ('mg.b.d', 'y'),
+                             ('z', 'top'), ('mg.items.0', 'first')):
+                expected.set_value(key, val)
+            nested = Hdf.from_dict(OrderedDict([
+                ('mg', OrderedDict([('a', 1), ('b', OrderedDict(
+                    [('c', 'x'), ('d', 'y')]))])),
+                ('z', 'top'),
+                ('mg.items', {0: 'first'})]))
+            flat = Hdf()
+            flat.update(expected.get_value_dict())
+            for hdf in (nested, flat):
+                self.assertEqual(hdf.get_value_dict(),
+                                 expected.get_value_dict())
+            self.assertEqual([n._key for n in nested.get('mg')],
+                             ['mg.a', 'mg.b', 'mg.items'])
+            self.assertEqual([n._key for n in nested.get('mg.b')],
+                             ['mg.b.c', 'mg.b.d'])
+            self.assertRaises(ValueError, Hdf().update, {'': 'x'})
+
+        def test_read_string(self):
+            hdf = Hdf()
+            hdf.read_string("""
+# a comment
+mg.event.title = Some  title  
+mg.event {
+    id=1
+    ticket.0 [Lang="en"] = first
+    copy := mg.event.title
+    link : mg.event.missing
+    text << EOM
+  line one
+line two
+EOM
+    empty =
+}
+top = x
+""")
+            self.assertEqual(hdf.get_value_dict(), {
+                'mg.event.title': 'Some  title',
+                'mg.event.id': '1',
+                'mg.event.ticket.0': 'first',
+                'mg.event.copy': 'Some  title',
+                'mg.event.link': '',
+                'mg.event.text': '  line one\nline two',
+                'mg.event.empty': '',
+                'top': 'x'})
+            for text in ('a {\nb = 1\n', '}', 'a\n', 'a {b}',
+                         'a << EOM\nx\n'):
+                self.assertRaises(ValueError, Hdf().read_string, text)
+
+        def test_read_file(self):
+            import shutil
+            import tempfile
+            directory = tempfile.mkdtemp()
+            try:
+                with open(os.path.join(directory, 'main.hdf'), 'w') as f:
+                    f.write('mg {\n#include "part.hdf"\n}\n')
+                with open(os.path.join(directory, 'part.hdf'), 'w') as f:
+                    f.write('a.b = c\n')
+                hdf = Hdf()
+                hdf.read_file(os.path.join(directory, 'main.hdf'))
+            finally:
+                shutil.rmtree(directory)
+            self.assertEqual(hdf.get_value_dict(), {'mg.a.b': 'c'})
+
+    class TestHdfOverlay(unittest.TestCase):
+        def setUp(self):
+            self.base = Hdf()
+            for key in ('site.name', 'mg.nav.0', 'mg.nav.1', 'mg.user.id'):
+                self.base.set_value(key, key)
+            self.hdf = HdfOverlay(self.base)
+
+        def test_reads_fall_through(self):
+            mg = self.hdf.get('mg')
+            self.assertEqual(str(mg.nav[1]), 'mg.nav.1')
+            self.assertEqual(str(self.hdf.get('site.name')), 'site.name')
+            self.assertEqual(self.hdf.get_value_dict(),
+                             self.base.get_value_dict())
+            self.assertTrue(isinstance(mg.missing, NullHdfNode))
+
+        def test_writes_stay_local(self):
+            before = self.base.get_value_dict()
+            mg = self.hdf.get('mg')
+            self.hdf.set_value('mg.user.id', 'me')
+            self.hdf.set_value('mg.nav.2', 'new')
+            self.hdf.update({'mg.user.name': 'x', 'other': 'y'})
+            self.assertEqual(str(mg.user.id), 'me')
+            self.assertEqual([str(n) for n in mg.nav],
+                             ['mg.nav.0', 'mg.nav.1', 'new'])
+            expected = dict(before)
+            expected.update({'mg.user.id': 'me', 'mg.nav.2': 'new',
+                             'mg.user.name': 'x', 'other': 'y'})
+            self.assertEqual(self.hdf.get_value_dict(), expected)
+            self.assertEqual(self.base.get_value_dict(), before)
+            self.assertEqual(str(self.base.get('mg').user.id), 'mg.user.id')
+            # A second overlay starts from the base again
+            other = HdfOverlay(self.base)
+            self.assertEqual(other.get_value_dict(), before)
+            # Lookups return the nodes of the base that were not written
+            self.assertTrue(other.get('mg.nav.0') is
+                            self.base.get('mg.nav.0'))
+            self.assertTrue(self.hdf.get('mg.nav.0') is
+                            self.base.get('mg.nav.0'))
+
+        def test_base_is_read_only(self):
+            self.assertRaises(ValueError, self.base.set_value, 'mg.x', '1')
+            self.assertRaises(ValueError, self.base.update, {'x': '1'})
+            self.hdf.set_value('mg.user.id', 'me')
+            top = HdfOverlay(self.hdf, lazy_paths=True)
+            self.assertRaises(ValueError, self.hdf.set_value, 'mg.x', '1')
+            self.assertEqual(str(self.hdf.get('mg.user.id')), 'me')
+            self.assertEqual(str(HdfPath(self.hdf, 'mg').user.id), 'me')
+            top.set_value('mg.user.id', 'top')
+            self.assertEqual(str(top.get('mg').user.id), 'top')
+            self.assertEqual(str(self.hdf.get('mg').user.id), 'me')
+
+        def test_shared_nodes_refuse_writes(self):
+            other = HdfOverlay(self.base)
+            node = self.hdf.get('mg.nav.0')
+            self.assertRaises(AttributeError, node._set_value, 'req')
+            self.assertRaises(AttributeError, setattr, node, '_val', 'req')
+            self.assertRaises(AttributeError, setattr, node, 'x', node)
+            self.assertEqual(str(node), 'mg.nav.0')
+            self.assertEqual(str(other.get('mg.nav.0')), 'mg.nav.0')
+            self.assertFalse(other.get('mg.nav.0').x)
+            # The nodes of an overlay can be written, below other overlays
+            # too
+            self.hdf.get('mg')._set_value('mine')
+            self.hdf.set_value('mg.nav.0', 'mine')
+            self.assertEqual(str(other.get('mg')), '')
+            self.assertEqual(str(other.get('mg.nav.0')), 'mg.nav.0')
+            top = HdfOverlay(self.hdf)
+            self.assertRaises(AttributeError,
+                              self.hdf.get('mg.nav.0')._set_value, 'x')
+            self.assertRaises(AttributeError,
+                              self.hdf.get('mg')._set_value, 'x')
+            top.get('mg')._set_value('top')
+            self.assertEqual(str(top.get('mg')), 'top')
+            self.assertEqual(str(self.hdf.get('mg')), 'mine')
+
+        def test_lazy_paths(self):
+            hdf = HdfOverlay(self.base, lazy_paths=True)
+            path = hdf.get('mg').user.id
+            self.assertEqual(str(path), 'mg.user.id')
+            hdf.set_value('mg.user.id', 'me')
+            self.assertEqual(str(path), 'me')
+            # Paths found before a write below them see it too
+            nav = hdf.get('mg').nav
+            self.assertEqual(len(nav), 2)
+            hdf.set_value('mg.nav.2', 'new')
+            self.assertEqual([str(n) for n in nav],
+                             ['mg.nav.0', 'mg.nav.1', 'new'])
+
+        def test_write_below_wide_node(self):
+            base = Hdf()
+            for i in xrange(1000):
+                base.set_value('mg.nav.%d' % i, 'x')
+            hdf = HdfOverlay(base)
+            hdf.set_value('mg.nav.5.title', 'five')
+            self.assertEqual(str(hdf.get('mg.nav.5.title')), 'five')
+            self.assertEqual(len(hdf.get('mg.nav')), 1000)
+            # Only the nodes above the write are the overlay's own
+            self.assertTrue(hdf.get('mg.nav.6') is base.get('mg.nav.6'))
+            self.assertTrue(hdf.get('mg.nav.5') is not base.get('mg.nav.5'))
+            self.assertFalse(base.get('mg.nav.5').title)
+
+    class TestFrozenHdf(unittest.TestCase):
+        def setUp(self):
+            self.values = {'mg': {
+                'user': {'id': '1', 'name': 'me'},
+                'event': {'title': 'Party', 'qty': '3'},
+            }}
+            self.hdf = Hdf.from_dict(self.values)
+            self.frozen = self.hdf.freeze()
+
+        def test_reads_like_the_hdf(self):
+            frozen = self.frozen
+            self.assertEqual(frozen.get_value_dict(),
+                             self.hdf.get_value_dict())
+            mg = frozen.get('mg')
+            self.assertEqual(str(mg.event.title), 'Party')
+            self.assertTrue(mg.event.qty > 2)
+            self.assertEqual(int(mg['event.qty']), 3)
+            self.assertEqual([str(node) for node in mg.user], ['1', 'me'])
+            self.assertEqual(mg.num_children(), 2)
+            self.assertTrue(mg.nothing.here is null_node)
+            self.assertTrue(frozen.freeze() is frozen)
+
+        def test_snapshot(self):
+            self.hdf.set_value('mg.user.id', '2')
+            self.hdf.set_value('mg.new', 'x')
+            self.assertEqual(str(self.frozen.get('mg.user.id')), '1')
+            self.assertTrue(self.frozen.get('mg.new') is null_node)
+            self.assertNotEqual(self.hdf.freeze(), self.frozen)
+
+        def test_immutable(self):
+            self.assertRaises(ValueError, self.frozen.set_value, 'mg.x', 1)
+            self.assertRaises(ValueError, self.frozen.set_value,
+                              'mg.user.id', 1)
+            self.assertRaises(ValueError, self.frozen.update, {'x': 1})
+            node = self.frozen.get('mg.user.id')
+            self.assertRaises(AttributeError, node._set_value, '2')
+            self.assertRaises(AttributeError, setattr, node, 'x', 1)
+            self.assertEqual(str(node), '1')
+
+        def test_fingerprint(self):
+            frozen = self.frozen
+            same = Hdf.from_dict(self.values).freeze()
+            self.assertEqual(frozen.fingerprint(), same.fingerprint())
+            self.assertEqual(frozen, same)
+            self.assertEqual(hash(frozen), hash(same))
+            self.assertEqual(len(set([frozen, same])), 1)
+            self.assertEqual(frozen.fingerprint('mg.user'),
+                             same.fingerprint('mg.user'))
+            self.assertTrue(frozen.fingerprint('mg.nothing') is None)
+            # The order of the roots does not count, that of children does
+            hdf = Hdf()
+            hdf.set_value('b.x', '1')
+            hdf.set_value('b.y', '2')
+            hdf.set_value('a', '0')
+            other = Hdf()
+            other.set_value('a', '0')
+            other.set_value('b.x', '1')
+            other.set_value('b.y', '2')
+            self.assertEqual(hdf.freeze(), other.freeze())
+            other = Hdf()
+            other.set_value('a', '0')
+            other.set_value('b.y', '2')
+            other.set_value('b.x', '1')
+            self.assertNotEqual(hdf.freeze(), other.freeze())
+            self.assertEqual(hdf.freeze().fingerprint('a'),
+                             other.freeze().fingerprint('a'))
+
+            self.hdf.set_value('mg.event.qty', 4)
+            changed = self.hdf.freeze()
+            self.assertNotEqual(changed.fingerprint(), frozen.fingerprint())
+            self.assertNotEqual(changed.fingerprint('mg.event'),
+                                frozen.fingerprint('mg.event'))
+            self.assertEqual(changed.fingerprint('mg.user'),
+                             frozen.fingerprint('mg.user'))
+            # Both the value and its type count
+            self.hdf.set_value('mg.event.qty', '4')
+            self.assertNotEqual(self.hdf.freeze().fingerprint('mg.event'),
+                                changed.fingerprint('mg.event'))
+            # Only a node with no value differs from one valued ''
+            empty = Hdf()
+            empty.create_node('mg')
+            blank = Hdf()
+            blank.set_value('mg', '')
+            self.assertNotEqual(empty.freeze().fingerprint(),
+                                blank.freeze().fingerprint())
+
+        def test_overlay(self):
+            hdf = HdfOverlay(self.frozen)
+            hdf.set_value('mg.user.id', '2')
+            self.assertEqual(str(hdf.get('mg.user.id')), '2')
+            self.assertEqual(str(self.frozen.get('mg.user.id')), '1')
+            frozen = hdf.freeze()
+            self.assertTrue(frozen.get('mg.event') is
+                            self.frozen.get('mg.event'))
+            self.assertEqual(frozen.fingerprint('mg.event'),
+                             self.frozen.fingerprint('mg.event'))
+            self.assertNotEqual(frozen.fingerprint('mg.user'),
+                                self.frozen.fingerprint('mg.user'))
+
+    class TestHdfDump(unittest.TestCase):
+        def setUp(self):
+            self.hdf = Hdf()
+            self.hdf.set_value('mg.event.title', 'Party')
+            self.hdf.set_value('mg.event.qty', 3)
+            self.hdf.set_value('mg.price', 2.5)
+            self.hdf.set_value('mg.name', u'caf\xe9')
+            self.hdf.create_node('mg.empty.leaf')
+            self.hdf.set_value('top', '1')
+
+        def keys(self, hdf):
+            return [(node._key, node._val) for node in hdf._walk()]
+
+        def test_round_trip(self):
+            hdf = Hdf.loads(self.hdf.dumps())
+            self.assertEqual(self.keys(hdf), self.keys(self.hdf))
+            self.assertEqual(str(hdf.get('mg').event.title), 'Party')
+            self.assertEqual(hdf.get('mg').event.qty, 3)
+            hdf.set_value('mg.event.title', 'Other')
+            self.assertEqual(str(self.hdf.get('mg.event.title')), 'Party')
+
+        def test_lazy_load(self):
+            data = self.hdf.dumps()
+            hdf = Hdf.loads(data)
+            self.assertFalse('_root_dict' in hdf.__dict__)
+            self.assertTrue(hdf.dumps() is data)
+            self.assertEqual(str(hdf.get('top')), '1')
+            self.assertTrue('_root_dict' in hdf.__dict__)
+            self.assertRaises(AttributeError, getattr, hdf, 'nothing')
+
+        def test_pickle(self):
+            import cPickle
+            import pickle
+            for dumps, loads in ((pickle.dumps, pickle.loads),
+                                 (cPickle.dumps, cPickle.loads)):
+                for protocol in (0, 2):
+                    hdf = loads(dumps(self.hdf, protocol))
+                    self.assertEqual(self.keys(hdf), self.keys(self.hdf))
+            overlay = HdfOverlay(self.hdf)
+            overlay.set_value('mg.event.title', 'Other')
+            hdf = cPickle.loads(cPickle.dumps(overlay, 2))
+            self.assertEqual(type(hdf), Hdf)
+            self.assertEqual(self.keys(hdf), self.keys(overlay))
+            frozen = self.hdf.freeze()
+            hdf = cPickle.loads(cPickle.dumps(frozen, 2))
+            self.assertEqual(type(hdf), FrozenHdf)
+            self.assertEqual(hdf, frozen)
+            self.assertRaises(ValueError, hdf.set_value, 'top', '2')
+
+        def test_values_marshal_can_not_write(self):
+            import decimal
+            self.hdf.set_value('mg.total', decimal.Decimal('1.50'))
+            hdf = Hdf.loads(self.hdf.dumps())
+            self.assertEqual(hdf.get('mg.total')._val, decimal.Decimal('1.50'))
+            self.assertEqual(self.keys(hdf), self.keys(self.hdf))
+
+        def test_bad_dump(self):
+            for data in ('', 'junk', marshal.dumps((1, 2))):
+                self.assertRaises(ValueError, Hdf.loads(data).get, 'x')
+
+    def memory_test(count=100000):
+        """Prints the memory each node of a large tree takes up"""
+        import gc
+        import resource
+        def resident():
+            # VmRSS where there is one, otherwise the peak size
+            try:
+                with open('/proc/self/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            return int(line.split()[1]) * 1024
+            except IOError:
+                pass
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        keys = ['mg.event.%d.ticket.%d' % (i // 10, i % 10)
+                for i in xrange(count)]
+        gc.collect()
+        before = resident()
+        hdf = Hdf()
+        for key in keys:
+            hdf.set_value(key, 'x')
+        used = resident() - before
+        nodes = len(hdf._map)
+        print "%d nodes: %.0f bytes/node" % (nodes, float(used) / nodes)
+
+    def load_test(count=100000):
+        """Times the ways of filling an Hdf with count keys"""
+        import timeit
+        keys = ['mg.event.%d.field%d' % (i // 10, i % 10)
+                for i in xrange(count)]
+        def set_values():
+            hdf = Hdf()
+            for key in keys:
+                hdf.set_value(key, 'x')
+        flat = dict.fromkeys(keys, 'x')
+        nested = {'mg': {'event': dict(
+            (str(i), dict(('field%d' % j, 'x') for j in range(10)))
+            for i in xrange(count // 10))}}
+        text = '\n'.join(
+            'mg.event.%d {\n%s\n}' % (i, '\n'.join(
+                'field%d = x' % j for j in range(10)))
+            for i in xrange(count // 10))
+        for label, fn in (('set_value loop', set_values),
+                          ('update, flat dict', lambda: Hdf().update(flat)),
+                          ('from_dict, nested dict',
+                           lambda: Hdf.from_dict(nested)),
+                          ('read_string', lambda: Hdf().read_string(text))):
+            # With the garbage collector on, as it is when serving pages
+            seconds = min(timeit.repeat(fn, 'import gc; gc.enable()',
+                                        number=1, repeat=3))
+            print "%s, %d keys: %.1f msec" % (label, count, 1000 * seconds)
+
+    def overlay_test(count=100000):
+        """Times setting up a request on a shared base"""
+        import timeit
+        base = Hdf()
+        base.update(dict(('site.page%d.field%d' % (i // 10, i % 10), 'x')
+                         for i in xrange(count)))
+        base.set_value('mg.user.id', '1')
+        def overlay():
+            hdf = HdfOverlay(base)
+            for i in range(10):
+                hdf.set_value('mg.request.%d' % i, 'x')
+            hdf.set_value('site.page5.field5', 'y')
+        for label, fn in (('HdfOverlay', overlay),
+                          ('building the whole Hdf', lambda: Hdf.from_dict(
+                              base.get_value_dict()))):
+            seconds = min(timeit.repeat(fn, number=10, repeat=3)) / 10
+            print "%s of a %d key base, 11 writes: %.3f msec" % (
+                label, count, 1000 * seconds)
+
+    def comparison_test():
+        """Times the comparisons that converted templates make"""
         import timeit
         setup = """from __main__ import Hdf
 hdf = Hdf()
-hdf.set_value('%(key)s', 'a')
-mg = hdf.get('mg')
+hdf.set_value('mg.qty', '3')
+hdf.set_value('mg.flag', '1')
+item = hdf.get('mg')
         """
-        statement = """x = str(%(key)s)"""
-        for key in ('mg.a', 'mg.a.b.c.d.e'):
-            t = timeit.Timer(statement % locals(), setup % locals())
+        for statement in ('int(item.qty) > 0', 'item.qty > 0',
+                          'item.qty <= 2', 'item.flag == "1"',
+                          'item.flag != "1"', 'str(item.qty)'):
+            t = timeit.Timer(statement, setup)
             print "%s: %.2f usec/pass" % (
-                key,
-                1000000 * t.timeit(number=100000)/100000
+                statement,
+                1000000 * min(t.repeat(number=100000, repeat=3))/100000
             )
+
+    def value_dict_test(count=100000):
+        """Times get_value_dict() of a large tree, and of a subtree"""
+        import timeit
+        hdf = Hdf()
+        hdf.update(dict(('mg.event.%d.field%d' % (i // 10, i % 10), 'x')
+                        for i in xrange(count)))
+        for label, fn in (
+                ('get_value_dict()', hdf.get_value_dict),
+                ('get_value_dict(nested=True)',
+                 lambda: hdf.get_value_dict(nested=True)),
+                ("get_value_dict('mg.event.5')",
+                 lambda: hdf.get_value_dict('mg.event.5'))):
+            seconds = min(timeit.repeat(fn, number=10, repeat=3)) / 10
+            print "%s, %d keys: %.3f msec" % (label, count, 1000 * seconds)
+
+    def freeze_test(count=100000):
+        """Times freezing a large tree and fingerprinting it"""
+        import timeit
+        hdf = Hdf()
+        hdf.update(dict(('mg.event.%d.field%d' % (i // 10, i % 10), 'x')
+                        for i in xrange(count)))
+        frozen = hdf.freeze()
+        frozen.fingerprint()
+        for label, fn in (
+                ('freeze()', hdf.freeze),
+                ('freeze().fingerprint()',
+                 lambda: hdf.freeze().fingerprint()),
+                ("freeze().fingerprint('mg.event.5')",
+                 lambda: hdf.freeze().fingerprint('mg.event.5')),
+                ('fingerprint(), once known', frozen.fingerprint)):
+            seconds = min(timeit.repeat(fn, number=3, repeat=3)) / 3
+            print "%s, %d keys: %.3f msec" % (label, count, 1000 * seconds)
+
+    def dump_test(count=100000):
+        """Times dumps() and loads() of a large tree, against sending the
+        flat value dict and setting it key by key
+        """
+        import cPickle
+        import timeit
+        hdf = Hdf()
+        hdf.update(dict(('mg.event.%d.field%d' % (i // 10, i % 10), 'x%d' % i)
+                        for i in xrange(count)))
+        data = hdf.dumps()
+        flat = cPickle.dumps(hdf.get_value_dict(), 2)
+        print "dumps() / pickled value dict, %d keys: %d / %d bytes" % (
+            count, len(data), len(flat))
+        def set_values():
+            loaded = Hdf()
+            for key, val in cPickle.loads(flat).iteritems():
+                loaded.set_value(key, val)
+        for label, fn in (
+                ('dumps()', hdf.dumps),
+                ('loads()', lambda: Hdf.loads(data)),
+                ('loads() and first use',
+                 lambda: Hdf.loads(data).get('mg')),
+                ('pickling the value dict',
+                 lambda: cPickle.dumps(hdf.get_value_dict(), 2)),
+                ('unpickling, set_value loop', set_values),
+                ('unpickling, update()',
+                 lambda: Hdf().update(cPickle.loads(flat)))):
+            seconds = min(timeit.repeat(fn, 'import gc; gc.enable()',
+                                        number=1, repeat=3))
+            print "%s, %d keys: %.3f msec" % (label, count, 1000 * seconds)
+
+    def perf_test():
+        memory_test()
+        value_dict_test()
+        freeze_test()
+        dump_test()
+        load_test()
+        overlay_test()
+        comparison_test()
+        import timeit
+        setup = """from __main__ import Hdf
+hdf = Hdf(lazy_paths=%(lazy_paths)s)
+hdf.set_value('mg.a.b.c.d.e', 'a')
+mg = hdf.get('mg')
+        """
+        statement = """x = str(%(key)s)"""
+        for lazy_paths in (False, True):
+            for key in ('mg.a', 'mg.a.b.c.d.e', 'mg.x.y.z'):
+                t = timeit.Timer(statement % locals(), setup % locals())
+                print "%s%s: %.2f usec/pass" % (
+                    key,
+                    lazy_paths and ' (lazy paths)' or '',
+                    1000000 * t.timeit(number=100000)/100000
+                )
     import sys
     if len(sys.argv) > 1:
         perf_test()
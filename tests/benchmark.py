@@ -0,0 +1,426 @@
+# Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
+# See "LICENSE" file for license.
+
+"""Rough timings for the cs2mako conversion stages.
+
+    python benchmark.py [name ...]
+
+With no names every benchmark is run.
+
+"""
+
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+sys.path[0] = os.path.join(sys.path[0], '..', 'src')
+from cs2mako.addintl import IgnoredSection
+from cs2mako.addintl import _analyze_groups
+from cs2mako.addintl import add_intl
+from cs2mako.addintl import lexer
+from cs2mako.addintl import to_ignore
+from cs2mako.addintl import wrap_text
+from cs2mako.converter import Converter
+from cs2mako.converter import tokenize
+from cs2mako.converter import tokenize_lines
+from cs2mako.expressions import ExpressionCache
+from cs2mako.expressions import rewrite
+from cs2mako.fold import BranchFolder
+from cs2mako.hoist import PathHoister
+from cs2mako.runtime import CompiledRuntime
+from cs2mako.runtime import TemplateRuntime
+from cs2mako.tokens import extract_filters
+from hdf_emulator import Hdf
+
+
+# A template shaped like ours: mostly HTML with the odd <?cs ?> tag.
+chunk = """<div class="event-header">
+    <h1 class="title"><?cs var:html_escape(mg.event.title) ?></h1>
+    <p class="summary">Lots of plain HTML between tags, like most pages.</p>
+    <?cs if:mg.event.show_date ?>
+        <span class="date"><?cs var:mg.event.date ?></span>
+    <?cs /if ?>
+    <ul>
+    <?cs each:item = mg.event.items ?>
+        <li><a href="<?cs var:url_escape(item.url) ?>"><?cs var:item.name ?></a></li>
+    <?cs /each ?>
+    </ul>
+</div>
+"""
+
+
+def template(size):
+    """Returns a template of roughly size bytes"""
+    return chunk * (size // len(chunk) + 1)
+
+
+def report(label, fn, number=5):
+    seconds = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    print "%-40s %10.2f msec" % (label, seconds * 1000)
+
+
+def bench_tokenize():
+    for size in (10000, 100000, 500000):
+        s = template(size)
+        report("tokenize_lines %d bytes" % size,
+               lambda: list(tokenize_lines(s)))
+        report("tokenize %d bytes" % size, lambda: list(tokenize(s)))
+
+
+def bench_convert():
+    for size in (10000, 100000, 500000):
+        s = template(size)
+        report("convert %d bytes" % size, lambda: Converter(s).convert())
+
+
+def convert_file(path):
+    with open(path) as f:
+        result = Converter(f.read()).convert()
+    with open(os.devnull, 'w') as out:
+        out.write(result)
+
+
+def convert_file_stream(path):
+    with open(path) as f:
+        with open(os.devnull, 'w') as out:
+            Converter.convert_stream(f, out)
+
+
+def max_resident():
+    """Returns the peak resident size of this process in KB"""
+    # ru_maxrss survives exec on Linux, so a child would report the size of
+    # the parent. VmHWM does not.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def peak_memory(fn, path):
+    """Runs fn(path) in a fresh interpreter and returns its peak resident
+    size in KB.
+    """
+    output = subprocess.Popen(
+        [sys.executable, __file__, '--peak', fn.__name__, path],
+        stdout=subprocess.PIPE).communicate()[0]
+    return int(output)
+
+
+def bench_stream():
+    for size in (1000000, 10000000):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(template(size))
+        report("convert %d bytes" % size,
+               lambda: convert_file(path), number=1)
+        report("convert_stream %d bytes" % size,
+               lambda: convert_file_stream(path), number=1)
+        print "peak memory convert / convert_stream: %d / %d KB" % (
+            peak_memory(convert_file, path),
+            peak_memory(convert_file_stream, path))
+        os.unlink(path)
+
+
+def legacy_extract_filters(expression):
+    """Open_var's filter loop as it was before extract_filters"""
+    filters = {
+        '^\s*url_escape\(\s*(.+?)\s*\)\s*$': 'u',
+        '^\s*html_escape\(\s*(.+?)\s*\)\s*$': 'h',
+        '^\s*html_strip\(\s*(.+?)\s*\)\s*$': 'striptags',
+        '^\s*js_escape\(\s*(.+?)\s*\)\s*$': 'escapejs',
+    }
+    match = True
+    applied_filters = []
+    while match:
+        match = False
+        for pattern, mako_filter in filters.items():
+            filtered = re.sub(pattern, '\\1', expression)
+            if filtered != expression:
+                expression = filtered
+                applied_filters.append(mako_filter)
+                match = True
+    applied_filters.reverse()
+    return expression, applied_filters
+
+
+def bench_var_filters():
+    expressions = [
+        'mg.event.title',
+        'html_escape(mg.event.title)',
+        'url_escape(item.url)',
+        'js_escape(html_strip(mg.event.description))',
+        'html_escape(url_escape(item.name))',
+    ] * 200
+    report("legacy filter loop, %d vars" % len(expressions),
+           lambda: [legacy_extract_filters(e) for e in expressions])
+    report("extract_filters, %d vars" % len(expressions),
+           lambda: [extract_filters(e) for e in expressions])
+
+
+legacy_expr_repl = (
+    (re.compile(r'\#([a-zA-Z0-9._]+)'), r'int(\1)'),
+    (re.compile(r'\s*!\s*(?=[^=])'), ' not '),
+    (re.compile(r'\s*\|\|\s*'), ' or '),
+    (re.compile(r'\s*\&\&\s*'), ' and '),
+)
+
+
+def legacy_rewrite(expression):
+    """Token.sanitize_expression as it was before expressions.rewrite"""
+    for expr, repl in legacy_expr_repl:
+        expression = expr.sub(repl, expression)
+    return expression
+
+
+def bench_expressions():
+    expressions = [
+        'mg.foo.bar',
+        '!item.is_on',
+        'x>0 && some_exception',
+        'mg.noton + #1',
+        'item.limit < 10 || !mg.show_all',
+    ] * 200
+    report("legacy regex chain, %d exprs" % len(expressions),
+           lambda: [legacy_rewrite(e) for e in expressions])
+    report("rewrite, %d exprs" % len(expressions),
+           lambda: [rewrite(e) for e in expressions])
+    cache = ExpressionCache()
+    report("cached rewrite, %d exprs" % len(expressions),
+           lambda: [cache.rewrite(e) for e in expressions])
+    print "cache hits/misses/maxsize/size: %d/%d/%d/%d" % cache.info()
+
+
+def bench_nesting():
+    # Deeply nested ifs, as in our layout templates
+    depth = 60
+    s = ('<?cs if:mg.a ?>x<?cs else ?>y' * depth + '<?cs /if ?>' * depth) * 20
+    report("convert %d nested ifs x 20" % depth, lambda: Converter(s).convert())
+
+
+def legacy_isolate_strings(to_ignore, analyze):
+    """addintl.isolate_strings as it was before the Lexer: one pass over
+    the whole fragment list per pattern.
+    """
+    for regex in to_ignore:
+        def analyze_string(analyze_list, cur_str):
+            if not isinstance(cur_str, IgnoredSection):
+                sec_ex = None
+                pri_ex = regex
+                if type(pri_ex).__name__ == 'list':
+                    pri_ex = regex[0]
+                    sec_ex = regex[1]
+                matches = legacy_analyze_matches(pri_ex, cur_str, sec_ex)
+                for item in matches:
+                    analyze_list.append(item)
+            else:
+                analyze_list.append(cur_str)
+            return analyze_list
+
+        analyze = reduce(analyze_string, analyze, [])
+    return analyze
+
+
+def legacy_analyze_matches(regex, string, sec_exs=None):
+    analyzed_list = []
+    cur_index = 0
+    for match in re.finditer(regex, string, (re.M | re.S)):
+        start = match.start()
+        end = match.end()
+        if(cur_index != start):
+            analyzed_list.append(string[cur_index:start])
+
+        if sec_exs is None:
+            _analyze_groups(match, analyzed_list)
+        else:
+            analyzed_list += legacy_isolate_strings(sec_exs, [match.group(0)])
+        cur_index=end
+
+    if cur_index != len(string):
+        analyzed_list.append(string[cur_index:len(string)])
+    return analyzed_list
+
+
+def legacy_clean_up(analyze):
+    """The clean up of addintl.add_intl as it was before wrap_text: a chain
+    of replaces over the whole document.
+    """
+    res_array = []
+    for cur_str in analyze:
+        if isinstance(cur_str, IgnoredSection):
+            res_array.append(cur_str.val)
+        else:
+            res_array.append('${ _("%s") }' % cur_str)
+    res_string = "".join(res_array)
+    for old, new in (('${ _(">") }', '>'), ('${ _("/>") }', '/>'),
+                     ('${ _(" ', ' ${ _("'), (' ") }', '") } '),
+                     ('${ _("(") }', '('), ('${ _(")") }', ')'),
+                     ('${ _("(', '(${ _("'), (')") }', '") })'),
+                     ('${ _(":") }', ':'), ('${ _("*") }', '*'),
+                     ('${ _("-") }', '-'), ('${ _("%") }', '%'),
+                     ('${ _("[") }', '['), ('${ _("]") }', ']'),
+                     ('${ _("|") }', '|')):
+        res_string = res_string.replace(old, new)
+    return res_string
+
+
+def bench_intl():
+    for size in (10000, 100000, 500000):
+        s = Converter(template(size)).convert()
+        report("legacy isolate_strings %d bytes" % size,
+               lambda: legacy_isolate_strings(to_ignore, [s]), number=1)
+        report("lexer.isolate %d bytes" % size,
+               lambda: lexer.isolate(s), number=1)
+        report("add_intl %d bytes" % size, lambda: add_intl(s), number=1)
+        analyzed = lexer.isolate(s)
+        report("replace chain clean up %d bytes" % size,
+               lambda: legacy_clean_up(analyzed))
+        report("wrap_text clean up %d bytes" % size,
+               lambda: ''.join([
+                   text.val if isinstance(text, IgnoredSection)
+                   else wrap_text(text) for text in analyzed]))
+
+
+def render_hdf():
+    """Returns the values chunk uses"""
+    items = dict((str(i), {'url': '/events/%d?a=b' % i,
+                           'name': 'Item %d' % i}) for i in range(10))
+    return Hdf.from_dict({'mg': {'event': {
+        'title': 'Party & <friends>', 'show_date': 1, 'date': '2014-05-01',
+        'items': items}}})
+
+
+def bench_render():
+    hdf = render_hdf()
+    for size in (10000, 100000):
+        tmp = tempfile.mkdtemp()
+        with open(os.path.join(tmp, 'page.html'), 'w') as f:
+            f.write(template(size))
+        mako = TemplateRuntime([tmp], convert=True, do_intl=False)
+        compiled = CompiledRuntime([tmp])
+        report("mako compile %d bytes" % size,
+               lambda: TemplateRuntime([tmp], convert=True,
+                                       do_intl=False).get_template(
+                                           'page.html'), number=1)
+        report("codegen compile %d bytes" % size,
+               lambda: CompiledRuntime([tmp]).get_template('page.html'),
+               number=1)
+        report("mako render %d bytes" % size,
+               lambda: mako.render('page.html', hdf), number=20)
+        report("codegen render %d bytes" % size,
+               lambda: compiled.render('page.html', hdf), number=20)
+        shutil.rmtree(tmp)
+
+
+# A page that looks the same paths up over and over, as ours do: the title in
+# the head, the header and a meta tag, optional flags that are mostly not
+# set, and the fields of each item several times per row.
+page_chunk = """<head>
+    <title><?cs var:html_escape(mg.event.title) ?> | <?cs var:mg.site.name ?></title>
+    <meta property="og:title" content="<?cs var:html_escape(mg.event.title) ?>">
+    <?cs if:mg.features.new_header.enabled ?><link rel="stylesheet" href="/new.css"><?cs /if ?>
+</head>
+<div class="event-header">
+    <h1><?cs var:html_escape(mg.event.title) ?></h1>
+    <?cs if:mg.features.show_date.enabled && mg.event.date ?>
+        <span class="date"><?cs var:mg.event.date ?></span>
+    <?cs /if ?>
+    <table>
+    <?cs each:item = mg.event.items ?>
+        <tr class="<?cs if:item.sold_out ?>sold-out<?cs /if ?>">
+            <td><a href="<?cs var:url_escape(item.url) ?>"><?cs var:item.name ?></a></td>
+            <td><?cs var:mg.event.currency.symbol ?><?cs var:item.price ?></td>
+            <td><?cs if:item.price && !item.sold_out ?><?cs var:item.name ?><?cs /if ?></td>
+            <?cs if:mg.features.show_fees.enabled ?><td><?cs var:item.fee ?></td><?cs /if ?>
+        </tr>
+    <?cs /each ?>
+    </table>
+</div>
+"""
+
+
+def bench_hoist():
+    hdf = render_hdf()
+    for name, cs_data in (('chunk', template(20000)),
+                          ('page', page_chunk * 10)):
+        plain = Converter(cs_data).convert()
+        hoisted = Converter(cs_data, hoist=True).convert()
+        report("convert %s" % name, lambda: Converter(cs_data).convert())
+        report("convert %s, hoisted" % name,
+               lambda: Converter(cs_data, hoist=True).convert())
+        hoister = PathHoister()
+        hoister.hoist(tokenize(cs_data))
+        print "%s: %d paths bound for %d lookups" % (
+            name, hoister.bindings, hoister.lookups)
+        tmp = tempfile.mkdtemp()
+        for directory, text in (('plain', plain), ('hoisted', hoisted)):
+            os.makedirs(os.path.join(tmp, directory))
+            with open(os.path.join(tmp, directory, 'page.html'), 'w') as f:
+                f.write(text)
+        for directory in ('plain', 'hoisted'):
+            runtime = TemplateRuntime([os.path.join(tmp, directory)])
+            for label, data in (('', hdf), (', empty hdf', Hdf())):
+                report("render %s %s%s" % (name, directory, label),
+                       lambda: runtime.render('page.html', data), number=50)
+        shutil.rmtree(tmp)
+
+
+def bench_fold():
+    constants = Hdf.from_dict({'mg': {'features': {
+        'new_header': {'enabled': 0}, 'show_date': {'enabled': 1},
+        'show_fees': {'enabled': 0}}}})
+    hdf = render_hdf()
+    hdf.update(constants.get_value_dict(nested=True))
+    cs_data = page_chunk * 10
+    folder = BranchFolder(constants)
+    plain = Converter(cs_data).convert()
+    folded = Converter(cs_data, folder=folder).convert()
+    print "%d conditions folded, %d branches removed, %d bytes removed" % (
+        folder.stats())
+    print "converted: %d bytes, folded %d bytes" % (len(plain), len(folded))
+    report("convert page", lambda: Converter(cs_data).convert())
+    report("convert page, folded",
+           lambda: Converter(cs_data, folder=folder).convert())
+    tmp = tempfile.mkdtemp()
+    for directory, text in (('plain', plain), ('folded', folded)):
+        os.makedirs(os.path.join(tmp, directory))
+        with open(os.path.join(tmp, directory, 'page.html'), 'w') as f:
+            f.write(text)
+        runtime = TemplateRuntime([os.path.join(tmp, directory)])
+        report("render page %s" % directory,
+               lambda: runtime.render('page.html', hdf), number=50)
+    shutil.rmtree(tmp)
+
+
+benchmarks = [
+    ('tokenize', bench_tokenize),
+    ('convert', bench_convert),
+    ('nesting', bench_nesting),
+    ('stream', bench_stream),
+    ('intl', bench_intl),
+    ('var_filters', bench_var_filters),
+    ('expressions', bench_expressions),
+    ('render', bench_render),
+    ('hoist', bench_hoist),
+    ('fold', bench_fold),
+]
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--peak']:
+        # peak_memory() runs one conversion per process
+        globals()[sys.argv[2]](sys.argv[3])
+        print max_resident()
+        sys.exit(0)
+    names = sys.argv[1:]
+    for name, fn in benchmarks:
+        if not names or name in names:
+            print "== %s" % name
+            fn()
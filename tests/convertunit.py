@@ -2,12 +2,36 @@
 # See "LICENSE" file for license.
 
 import os
+import shutil
 import sys
+import tempfile
 import unittest
+from StringIO import StringIO
 
 sys.path[0] = os.path.join(sys.path[0],'..', 'src')
 from cs2mako.addintl import add_intl
+from cs2mako.addintl import wrap_text
+from cs2mako.batch import convert_string
+from cs2mako.batch import convert_tree
+from cs2mako.cache import ConversionCache
+from cs2mako.codegen import compile_template
+from cs2mako.codegen import generate
+from cs2mako.converter import ContinuationFilter
 from cs2mako.converter import Converter
+from cs2mako.converter import TokenCursor
+from cs2mako.expressions import ExpressionCache
+from cs2mako.expressions import rewrite
+from cs2mako.fold import BranchFolder
+from cs2mako.helpers import escapejs
+from cs2mako.helpers import striptags
+from cs2mako.runtime import CompiledRuntime
+from cs2mako.runtime import TemplateRuntime
+from cs2mako.converter import tokenize
+from cs2mako.converter import tokenize_lines
+from cs2mako.tokens import compile_filters
+from cs2mako.tokens import register_filter
+from cs2mako.tokens import var_filters
+from hdf_emulator import Hdf
 
 class TestClearSilverConverter(unittest.TestCase):
     def setUp(self):
@@ -93,6 +117,20 @@ class TestClearSilverConverter(unittest.TestCase):
         result_buf = converter.convert()
         self.assertEqual(''.join(result_buf), mako)
 
+    def test_deep_nesting(self):
+        # Nesting is limited by memory, not by the Python recursion limit
+        depth = sys.getrecursionlimit() * 2
+        clear_silver = '<?cs each:x = y ?>' * depth + '<?cs /each ?>' * depth
+        result = Converter(clear_silver).convert()
+        self.assertEqual(result.count('% for x in y:'), depth)
+        self.assertEqual(result.count('% endfor'), depth)
+
+    def test_unclosed_tag(self):
+        # A tag that is never closed is dropped, with whatever it contained
+        clear_silver='before<?cs if:x ?>inside'
+        converter = Converter(clear_silver)
+        self.assertEqual(converter.convert(), 'before')
+
     def test_set(self):
         clear_silver='<?cs set:test = 1 ?>'
         mako='<% test = 1 %>'
@@ -119,6 +157,18 @@ class TestClearSilverConverter(unittest.TestCase):
         result = converter.convert()
         self.assertEqual(result, mako)
 
+    def test_registered_filter(self):
+        register_filter('money_format', 'money')
+        try:
+            clear_silver='<?cs var:html_escape(money_format( price )) ?>'
+            mako='${ price | money, h }'
+            converter = Converter(clear_silver)
+            result = converter.convert()
+            self.assertEqual(result, mako)
+        finally:
+            del var_filters['money_format']
+            compile_filters()
+
     def test_no_functions(self):
         clear_silver='<?cs var:test ?>'
         mako='${ test }'
@@ -147,6 +197,576 @@ class TestClearSilverConverter(unittest.TestCase):
         result = converter.convert()
         self.assertEqual(result, mako)
 
+class TestTokenizer(unittest.TestCase):
+    def assertSameTokens(self, clear_silver):
+        # The single-pass tokenizer has to match the line scanner exactly
+        expected = [(t.__class__, t.token, t.name)
+                    for t in tokenize_lines(clear_silver)]
+        result = [(t.__class__, t.token, t.name)
+                  for t in tokenize(clear_silver)]
+        self.assertEqual(result, expected)
+
+    def test_text_only(self):
+        self.assertSameTokens('')
+        self.assertSameTokens('just text\nover two lines\n')
+
+    def test_tags(self):
+        self.assertSameTokens(
+            '<div><?cs if:a ?>x<?cs elseif:b?>y<?cs else ?>z<?cs /if ?>\n'
+            '<?cs # a comment ?><?cs var:html_escape(c) ?>  ?></div>\n'
+            '<?cs each:item = mg.items ?><?cs var:item.x ?><?cs /each ?>')
+
+    def test_tags_do_not_span_lines(self):
+        self.assertSameTokens('<?cs\nif:a ?>\n<?cs if\n:a ?><?cs else\n?>')
+        self.assertSameTokens('<?cs var:a\n  ?>\r\n<?cs /if\n?>')
+
+class TestExpressions(unittest.TestCase):
+    def test_operators(self):
+        self.assertEqual(rewrite('#mg.count > #1'), 'int(mg.count) > int(1)')
+        self.assertEqual(rewrite('!item.is_on'), ' not item.is_on')
+        self.assertEqual(rewrite('a||b && c'), 'a or b and c')
+        self.assertEqual(rewrite('a != b'), 'a != b')
+
+    def test_adjacent_operators(self):
+        # Matches what the old chain of regex substitutions produced
+        self.assertEqual(rewrite('a || !b'), 'a or not b')
+        self.assertEqual(rewrite('a && !b'), 'a and not b')
+        self.assertEqual(rewrite('!!a'), ' not  not a')
+        self.assertEqual(rewrite('a || || b'), 'a or  or b')
+
+    def test_cache(self):
+        cache = ExpressionCache(maxsize=2)
+        self.assertEqual(cache.rewrite('!a'), ' not a')
+        self.assertEqual(cache.rewrite('!a'), ' not a')
+        self.assertEqual(cache.info(), (1, 1, 2, 1))
+        cache.rewrite('b')
+        cache.rewrite('c')
+        self.assertEqual(cache.info(), (1, 3, 2, 1))
+        cache.clear()
+        self.assertEqual(cache.info(), (0, 0, 2, 0))
+
+class TestTokenCursor(unittest.TestCase):
+    def test_next_and_peek(self):
+        cursor = TokenCursor(tokenize('<?cs var:x ?>'))
+        self.assertEqual(cursor.peek().name, 'var')
+        self.assertEqual(cursor.next().name, 'var')
+        self.assertEqual(cursor.next().token, 'x')
+        self.assertEqual(cursor.peek().token, ' ?>')
+        self.assertEqual(cursor.next().token, ' ?>')
+        # The trailing empty Char is only ever peeked at
+        self.assertEqual(cursor.peek().token, '')
+        self.assertRaises(StopIteration, cursor.next)
+        self.assertEqual(cursor.count, 4)
+
+class TestConvertStream(unittest.TestCase):
+    def assertSameAsConvert(self, clear_silver):
+        expected = Converter(clear_silver).convert()
+        # Small chunks split text and tags across reads
+        for chunk_size in (1, 5, 4096):
+            out = StringIO()
+            Converter.convert_stream(StringIO(clear_silver), out, chunk_size)
+            self.assertEqual(out.getvalue(), expected)
+
+    def test_tags(self):
+        self.assertSameAsConvert(
+            '<div>\n<?cs if:a ?>\n  <?cs var:html_escape(x) ?>\n'
+            '<?cs elif:!b ?>y<?cs else ?>\n<?cs if:c ?>z<?cs /if ?>'
+            '<?cs /if ?>\n</div>\n')
+
+    def test_tag_parts_across_chunks(self):
+        # include and def treat every token of their tag part on its own
+        self.assertSameAsConvert(
+            'text before\n<?cs include:"a/b.html" ?>\n'
+            '<?cs def:macro(a, b) ?>body<?cs /def ?>')
+
+    def test_unclosed_tag(self):
+        self.assertSameAsConvert('before\n<?cs each:x = y ?>inside\n')
+
+    def test_continuation_filter(self):
+        out = StringIO()
+        lines = ContinuationFilter(out, buffer_size=1)
+        for text in ('a', '\n  \\', '\n', '\t\\\r', '\nb\\\n', 'c'):
+            lines.append(text)
+        lines.close()
+        self.assertEqual(out.getvalue(), 'a\nb\\\nc')
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        os.makedirs(os.path.join(self.src, 'forms'))
+        with open(os.path.join(self.src, 'page.html'), 'w') as f:
+            f.write('<?cs var:test ?>')
+        with open(os.path.join(self.src, 'forms', 'form.html'), 'w') as f:
+            f.write('<?cs include:"forms/other.html" ?>')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_convert_tree(self):
+        # The output tree mirrors the input tree
+        out = os.path.join(self.tmp, 'out')
+        results = list(convert_tree([self.src], out, do_intl=False))
+        self.assertEqual(sorted(error for source, error in results),
+                         [None, None])
+        with open(os.path.join(out, 'page.html')) as f:
+            self.assertEqual(f.read(), '${ test }')
+        with open(os.path.join(out, 'forms', 'form.html')) as f:
+            self.assertEqual(f.read(), '<%include file="/forms/other.html"/>')
+
+    def test_failures_are_reported(self):
+        out = os.path.join(self.tmp, 'out')
+        os.makedirs(os.path.join(out, 'page.html'))
+        results = dict(convert_tree([self.src], out, do_intl=False))
+        self.assertEqual(results[os.path.join(self.src, 'forms', 'form.html')],
+                         None)
+        self.assertTrue(results[os.path.join(self.src, 'page.html')])
+
+class TestConversionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = ConversionCache(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_hit(self):
+        clear_silver = '<?cs var:test ?>'
+        key = self.cache.key(clear_silver, True, False)
+        self.assertEqual(self.cache.get(key), None)
+        self.assertEqual(convert_string(clear_silver, True, False, self.cache),
+                         '${ test }')
+        self.assertEqual(self.cache.get(key), '${ test }')
+        # A stored result is returned as is
+        self.cache.put(key, 'cached')
+        self.assertEqual(convert_string(clear_silver, True, False, self.cache),
+                         'cached')
+
+    def test_key(self):
+        # Contents and options are both part of the key
+        key = self.cache.key('a', True, True)
+        self.assertNotEqual(key, self.cache.key('b', True, True))
+        self.assertNotEqual(key, self.cache.key('a', True, False))
+        self.assertNotEqual(key, self.cache.key('a', False, True))
+
+    def test_prune_evicts_least_recently_used(self):
+        self.cache.max_size = 10
+        for n, key in enumerate(('aa1', 'bb2', 'cc3')):
+            self.cache.put(key, 'x' * 4)
+            os.utime(self.cache._path(key), (n, n))
+        # Reading an entry makes it the most recently used
+        self.cache.get('aa1')
+        self.assertEqual(self.cache.prune(), 1)
+        self.assertEqual(self.cache.get('bb2'), None)
+        self.assertEqual(self.cache.get('aa1'), 'xxxx')
+        self.assertEqual(self.cache.get('cc3'), 'xxxx')
+
+    def test_clear(self):
+        self.cache.put('aa1', 'x')
+        self.cache.clear()
+        self.assertEqual(self.cache.get('aa1'), None)
+
+class TestTemplateRuntime(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        os.makedirs(os.path.join(self.src, 'forms'))
+        with open(os.path.join(self.src, 'page.html'), 'w') as f:
+            f.write('<h1><?cs var:html_escape(mg.title) ?></h1>'
+                    '<?cs each:item = mg.items ?>'
+                    '<?cs name:item ?>=<?cs var:item ?>,<?cs /each ?>'
+                    '<?cs set:mg.seen = #1 ?>'
+                    '<?cs include:"forms/form.html" ?>'
+                    '[<?cs var:mg.missing ?>]')
+        with open(os.path.join(self.src, 'forms', 'form.html'), 'w') as f:
+            f.write('<?cs if:mg.seen ?><?cs var:mg.title ?><?cs /if ?>')
+        self.out = os.path.join(self.tmp, 'out')
+        list(convert_tree([self.src], self.out, do_intl=False))
+        self.modules = os.path.join(self.tmp, 'modules')
+        self.hdf = Hdf.from_dict({'mg': {'title': 'A & B',
+                                         'items': {'a': 1, 'b': 2}}})
+        self.expected = u'<h1>A &amp; B</h1>a=1,b=2,A & B[]'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_render(self):
+        runtime = TemplateRuntime([self.out])
+        self.assertEqual(runtime.render('page.html', self.hdf), self.expected)
+        self.assertEqual(str(self.hdf.get('mg.seen')), '1')
+        # Names passed in come before the roots of the Hdf
+        other = Hdf.from_dict({'mg': {'seen': 1, 'title': 'x'}})
+        self.assertEqual(runtime.render('forms/form.html', self.hdf,
+                                        mg=other.get('mg')),
+                         'x')
+
+    def test_module_directory(self):
+        runtime = TemplateRuntime([self.out], self.modules)
+        self.assertEqual(sorted(runtime.warm_up()),
+                         [('forms/form.html', None), ('page.html', None)])
+        module = os.path.join(self.modules, 'page.html.py')
+        os.utime(module, (1, 1))
+        os.utime(os.path.join(self.out, 'page.html'), (0, 0))
+        # Another process reuses the module, unless the template is newer
+        runtime = TemplateRuntime([self.out], self.modules)
+        self.assertEqual(runtime.render('page.html', self.hdf), self.expected)
+        self.assertEqual(os.stat(module).st_mtime, 1)
+        os.utime(os.path.join(self.out, 'page.html'), (2, 2))
+        runtime = TemplateRuntime([self.out], self.modules)
+        runtime.get_template('page.html')
+        self.assertNotEqual(os.stat(module).st_mtime, 1)
+
+    def test_warm_up_errors(self):
+        with open(os.path.join(self.out, 'broken.html'), 'w') as f:
+            f.write('% if x:\n')
+        results = dict(TemplateRuntime([self.out]).warm_up())
+        self.assertEqual(results['page.html'], None)
+        self.assertTrue(results['broken.html'])
+
+    def test_convert(self):
+        runtime = TemplateRuntime([self.src], self.modules, convert=True,
+                                  do_intl=False,
+                                  cache=ConversionCache(self.tmp + '/cache'))
+        self.assertEqual(runtime.render('page.html', self.hdf), self.expected)
+        self.assertTrue(os.listdir(self.modules))
+
+    def test_include_helper(self):
+        with open(os.path.join(self.out, 'call.html'), 'w') as f:
+            f.write('<i>${ include("forms/form.html") }</i>${ mg.title }')
+        self.hdf.set_value('mg.seen', 1)
+        self.assertEqual(TemplateRuntime([self.out]).render('call.html',
+                                                            self.hdf),
+                         u'<i>A & B</i>A & B')
+
+    def test_helpers(self):
+        self.assertEqual(striptags('<b>bold</b> <br/>text'), u'bold text')
+        self.assertEqual(escapejs(u'"</script>\n'),
+                         u'\\u0022\\u003C/script\\u003E\\u000A')
+
+class TestCompiledRuntime(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp, 'forms'))
+        self.write('page.html',
+                   '<h1><?cs var:html_escape(mg.title) ?></h1>\n'
+                   '<?cs def:pair(a, b) ?>[<?cs var:a ?>|<?cs var:b ?>]'
+                   '<?cs /def ?>\n'
+                   '<?cs if:mg.show && !mg.hide ?>\n'
+                   '  <?cs var:mg.count + #1 ?>\n'
+                   '<?cs elif:mg.other ?>\n'
+                   '<?cs else ?>\n'
+                   '  no\n'
+                   '<?cs /if ?>\n'
+                   '<?cs each:item = mg.items ?>\n'
+                   '  <a href="<?cs var:url_escape(item.url) ?>">'
+                   '<?cs name:item ?></a>\n'
+                   '<?cs /each ?>\n'
+                   '<?cs loop:i = 1, 3, 1 ?><?cs var:i ?>,<?cs /loop ?>\n'
+                   '<?cs set:mg.count = #5 ?><?cs var:mg.count ?>\n'
+                   '<?cs alt:mg.missing ?>none<?cs /alt ?> '
+                   '<?cs alt:mg.count ?>none<?cs /alt ?>\n'
+                   '<?cs call:pair(mg.title, 2) ?><?cs # comment ?>\n'
+                   '<?cs include:"forms/form.html" ?>'
+                   '<?cs var:js_escape(mg.title) ?> '
+                   '<?cs var:html_strip(mg.html) ?>\n')
+        self.write('forms/form.html', 'form <?cs var:mg.title ?>\n')
+        self.hdf = {'mg': {'title': 'A & <b>', 'show': 1, 'count': 3,
+                           'html': '<i>x</i>y',
+                           'items': {'a': {'url': '/a?b=1'},
+                                     'b': {'url': '/c d'}}}}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        with open(os.path.join(self.tmp, name), 'w') as f:
+            f.write(text)
+
+    def test_same_as_mako(self):
+        expected = TemplateRuntime([self.tmp], convert=True,
+                                   do_intl=False).render(
+            'page.html', Hdf.from_dict(self.hdf))
+        self.assertEqual(CompiledRuntime([self.tmp]).render(
+            'page.html', Hdf.from_dict(self.hdf)), expected)
+        self.assertTrue(u'  4\n' in expected)
+        self.assertTrue(u'<a href="%2Fc+d">b</a>' in expected)
+
+    def test_set(self):
+        hdf = Hdf.from_dict(self.hdf)
+        self.write('set.html', '<?cs set:mg.seen = #1 ?>'
+                   '<?cs set:fresh.x = "new" ?><?cs var:fresh.x ?>'
+                   '<?cs set:count = 2 ?><?cs var:count ?>')
+        # A root that <?cs set ?> makes is there for the rest of the page
+        self.assertEqual(CompiledRuntime([self.tmp]).render('set.html', hdf),
+                         u'new2')
+        self.assertEqual(str(hdf.get('mg.seen')), '1')
+
+    def test_reload(self):
+        runtime = CompiledRuntime([self.tmp])
+        self.assertEqual(runtime.render('forms/form.html', Hdf()), u'form \n')
+        self.write('forms/form.html', 'changed')
+        os.utime(os.path.join(self.tmp, 'forms', 'form.html'), (1, 1))
+        self.assertEqual(runtime.render('forms/form.html', Hdf()),
+                         u'changed')
+        self.assertEqual(
+            sorted(CompiledRuntime([self.tmp]).warm_up()),
+            [('forms/form.html', None), ('page.html', None)])
+
+    def test_errors(self):
+        for cs_data in ('<?cs if:x ?>', '<?cs else ?>',
+                        '<?cs with:x = y ?><?cs /with ?>', '<?cs var:x',
+                        '<?cs var:x + ?>'):
+            self.assertRaises(ValueError, generate, cs_data)
+        # As in the converted Mako, a close tag of nothing is text
+        out = []
+        compile_template('a<?cs /if ?>')(out.append, None)
+        self.assertEqual(out, [u'a<?cs /if ?>'])
+
+class TestHoist(unittest.TestCase):
+    def convert(self, clear_silver):
+        return Converter(clear_silver, hoist=True).convert()
+
+    def test_repeated_path(self):
+        self.assertEqual(
+            self.convert('<?cs var:mg.a.b ?>-<?cs var:html_escape(mg.a.b) ?>'
+                         '<?cs if:mg.c.d ?>x<?cs /if ?>'),
+            '% for _path0 in (mg.a.b,):\n'
+            '${ _path0 }-${ _path0 | h }\\\n'
+            '  % if mg.c.d:\nx\\\n  % endif\n'
+            '% endfor\n')
+        # A path that prefixes others is bound once for all of them
+        self.assertEqual(
+            self.convert('<?cs var:mg.a.b ?><?cs var:mg.a.c ?>'
+                         '<?cs var:"mg.a.b" ?>'),
+            '% for _path0 in (mg.a,):\n'
+            '${ _path0.b }${ _path0.c }${ "mg.a.b" }\\\n% endfor\n')
+
+    def test_set_is_a_barrier(self):
+        result = self.convert('<?cs var:mg.a.b ?><?cs set:mg.a.b = 1 ?>'
+                              '<?cs var:mg.a.b ?>')
+        self.assertFalse('_path' in result)
+        result = self.convert('<?cs var:mg.a.b ?><?cs var:mg.a.b ?>'
+                              '<?cs include:"x.html" ?>'
+                              '<?cs var:mg.a.b ?><?cs var:mg.a.b ?>')
+        self.assertEqual(result.count('_path0 in'), 1)
+        self.assertEqual(result.count('_path1 in'), 1)
+        self.assertTrue('% endfor\n<%include file="/x.html"/>' in result)
+
+    def test_loops(self):
+        result = self.convert('<?cs each:item = mg.items ?>'
+                              '<?cs var:item.x.y ?><?cs var:item.x.y ?>'
+                              '<?cs var:mg.currency.symbol ?>'
+                              '<?cs /each ?>')
+        # The loop may not run, so only its own paths are bound, in it
+        self.assertEqual(
+            result,
+            '% for item in mg.items:\n'
+            '  % for _path0 in (item.x.y,):\n'
+            '${ _path0 }${ _path0 }${ mg.currency.symbol }\\\n'
+            '  % endfor\n'
+            '% endfor\n')
+        # Though it reuses the bindings around it
+        result = self.convert('<?cs var:mg.c.s ?><?cs var:mg.c.s ?>'
+                              '<?cs each:item = mg.items ?>'
+                              '<?cs var:mg.c.s ?><?cs var:item.c.s ?>'
+                              '<?cs /each ?>')
+        self.assertTrue(result.startswith('% for _path0 in (mg.c.s,):\n'))
+        self.assertTrue('${ _path0 }${ item.c.s }' in result, result)
+
+    def test_guarded(self):
+        # Lookups in an if are not moved above it, where they would run
+        # without its guard
+        clear_silver = ('<?cs def:show(a) ?><?cs if:a ?>'
+                        '<?cs var:a.price ?><?cs var:a.price ?>'
+                        '<?cs /if ?><?cs /def ?>'
+                        '<?cs call:show("") ?><?cs call:show(mg.item) ?>')
+        result = self.convert(clear_silver)
+        self.assertTrue('% if a:\n  % for _path0 in (a.price,):\n'
+                        in result, result)
+        tmp = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmp, 'page.html'), 'w') as f:
+                f.write(result)
+            self.assertEqual(
+                TemplateRuntime([tmp]).render(
+                    'page.html',
+                    Hdf.from_dict({'mg': {'item': {'price': '5'}}})),
+                '55')
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_same_output(self):
+        clear_silver = (
+            '<?cs def:m(a) ?><?cs var:a.b ?><?cs var:a.b ?><?cs /def ?>'
+            '<h1><?cs var:mg.e.title ?></h1>\n'
+            '<?cs if:mg.e.show ?><?cs var:mg.e.title ?>\n'
+            '<?cs else ?>none<?cs /if ?>\n'
+            '<?cs each:item = mg.e.items ?>\n'
+            '  <?cs var:item.name ?>/<?cs var:item.name ?>'
+            '<?cs var:mg.e.show ?>\n'
+            '<?cs /each ?>\n'
+            '<?cs call:m(mg.e) ?> <?cs alt:mg.e.x ?>no x<?cs /alt ?>\n')
+        hdf = {'mg': {'e': {'title': 'T', 'show': 1, 'b': 'B',
+                            'items': {'0': {'name': 'a'},
+                                      '1': {'name': 'b'}}}}}
+        tmp = tempfile.mkdtemp()
+        try:
+            for name, hoist in (('plain', False), ('hoisted', True)):
+                os.mkdir(os.path.join(tmp, name))
+                with open(os.path.join(tmp, name, 'page.html'), 'w') as f:
+                    f.write(Converter(clear_silver, hoist).convert())
+            self.assertTrue('_path' in open(
+                os.path.join(tmp, 'hoisted', 'page.html')).read())
+            for values in (hdf, {}):
+                self.assertEqual(
+                    TemplateRuntime([os.path.join(tmp, 'hoisted')]).render(
+                        'page.html', Hdf.from_dict(values)),
+                    TemplateRuntime([os.path.join(tmp, 'plain')]).render(
+                        'page.html', Hdf.from_dict(values)))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_unsupported(self):
+        # What hoisting does not understand is converted as it is
+        for clear_silver in ('<?cs var:mg.a.b ?><?cs var:mg.a.b ?><?cs if:x',
+                             '<?cs else ?><?cs var:mg.a.b ?>'
+                             '<?cs var:mg.a.b ?>'):
+            self.assertEqual(self.convert(clear_silver),
+                             Converter(clear_silver).convert())
+        # Bindings do not take names the template already uses
+        self.assertTrue('__path0 in' in self.convert(
+            '<?cs var:mg.a.b ?><?cs var:mg.a.b ?><?cs var:_path0 ?>'))
+
+class TestFold(unittest.TestCase):
+    def setUp(self):
+        constants = Hdf()
+        constants.read_string('Lang.Locale = en_US\n'
+                              'Features.header = 0\n'
+                              'Features.footer = 1\n')
+        self.folder = BranchFolder(constants)
+
+    def convert(self, clear_silver):
+        return Converter(clear_silver, folder=self.folder).convert()
+
+    def test_fold(self):
+        # Only the branch that is always taken is left
+        self.assertEqual(
+            self.convert('<?cs if:Features.header ?>new'
+                         '<?cs elif:Lang.Locale == "en_US" ?>us'
+                         '<?cs else ?>other<?cs /if ?>'),
+            'us')
+        self.assertEqual(self.folder.stats(), (2, 2, 92))
+        self.assertEqual(self.convert('a<?cs if:#Features.header ?>b'
+                                      '<?cs /if ?>c'), 'ac')
+
+    def test_partly_known(self):
+        # A branch that is always taken ends the chain as its else
+        self.assertEqual(
+            self.convert('<?cs if:x ?>X<?cs elif:Features.footer ?>F'
+                         '<?cs elif:y ?>Y<?cs /if ?>'),
+            '% if x:\nX\\\n% else:\nF\\\n% endif\n')
+        # An elif left first becomes the if
+        self.assertEqual(
+            self.convert('<?cs if:Features.header ?>H<?cs elif:x ?>X'
+                         '<?cs else ?>E<?cs /if ?>'),
+            '% if x:\nX\\\n% else:\nE\\\n% endif\n')
+        # A known operand of and and or can decide the condition
+        self.assertEqual(self.convert('<?cs if:x && Features.header ?>X'
+                                      '<?cs /if ?>'), '')
+        self.assertEqual(self.convert('<?cs if:!Features.footer || x ?>X'
+                                      '<?cs /if ?>'),
+                         '% if  not Features.footer or x:\nX\\\n% endif\n')
+        # Unless that would skip a call
+        self.assertTrue('% if f(x) and Features.header:' in self.convert(
+            '<?cs if:f(x) && Features.header ?>X<?cs /if ?>'))
+
+    def test_nested(self):
+        self.assertEqual(
+            self.convert('<?cs each:item = items ?>'
+                         '<?cs if:Features.footer ?><?cs if:Features.header ?>'
+                         'H<?cs else ?><?cs var:item ?><?cs /if ?><?cs /if ?>'
+                         '<?cs /each ?>'),
+            '% for item in items:\n${ item }\\\n% endfor\n')
+
+    def test_not_constant(self):
+        # Constants the template sets or binds are left alone
+        for clear_silver in (
+                '<?cs set:Features.header = 1 ?>'
+                '<?cs if:Features.header ?>H<?cs /if ?>',
+                '<?cs set:Features = x ?>'
+                '<?cs if:Features.header ?>H<?cs /if ?>',
+                '<?cs each:Features = x ?>'
+                '<?cs if:Features.header ?>H<?cs /if ?><?cs /each ?>',
+                '<?cs def:m(Lang) ?><?cs if:Lang.Locale ?>L<?cs /if ?>'
+                '<?cs /def ?>',
+                '<?cs if:Features ?>H<?cs /if ?>'
+                '<?cs if:Features.other ?>H<?cs /if ?>',
+                '<?cs if:Features.header ?>H',
+        ):
+            self.assertEqual(self.convert(clear_silver),
+                             Converter(clear_silver).convert())
+        self.assertEqual(self.folder.stats(), (0, 0, 0))
+
+    def test_same_output(self):
+        clear_silver = (
+            '<h1><?cs if:Features.header ?>new<?cs else ?>old<?cs /if ?>'
+            '</h1>\n'
+            '<?cs if:Lang.Locale != "en_US" && title ?>'
+            '<?cs var:title ?>\n<?cs elif:Features.footer ?>'
+            '<?cs var:footer ?>\n<?cs /if ?>\n'
+            '<?cs if:title ?><?cs if:#Features.footer + 1 > 1 ?>'
+            '<?cs var:title ?><?cs /if ?><?cs /if ?>\n')
+        tmp = tempfile.mkdtemp()
+        try:
+            for name, folder in (('plain', None), ('folded', self.folder)):
+                os.mkdir(os.path.join(tmp, name))
+                with open(os.path.join(tmp, name, 'page.html'), 'w') as f:
+                    f.write(Converter(clear_silver, folder=folder).convert())
+            self.assertEqual(self.folder.stats()[:2], (4, 2))
+            for values in ({'title': 'T', 'footer': 'F'}, {}):
+                hdf = Hdf.from_dict(values)
+                hdf.update(self.folder.hdf.get_value_dict(nested=True))
+                self.assertEqual(
+                    TemplateRuntime([os.path.join(tmp, 'folded')]).render(
+                        'page.html', hdf),
+                    TemplateRuntime([os.path.join(tmp, 'plain')]).render(
+                        'page.html', hdf))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_batch(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmp, 'src')
+            os.mkdir(src)
+            for name in ('a.html', 'b.html'):
+                with open(os.path.join(src, name), 'w') as f:
+                    f.write('<?cs if:Features.header ?>H<?cs /if ?>')
+            stats = {}
+            results = list(convert_tree([src], os.path.join(tmp, 'out'),
+                                        do_intl=False, stats=stats,
+                                        folder=self.folder))
+            self.assertEqual([error for source, error in results],
+                             [None, None])
+            self.assertEqual((stats['folded_conditions'],
+                              stats['removed_branches'],
+                              stats['removed_bytes']), (2, 2, 76))
+            # The constants are part of the cache key
+            cache = ConversionCache(os.path.join(tmp, 'cache'))
+            self.assertNotEqual(
+                cache.key('a', True, True),
+                cache.key('a', True, True, constants=self.folder.digest()))
+            # Files found in the cache are counted too
+            for attempt in range(2):
+                stats = {}
+                list(convert_tree([src], os.path.join(tmp, 'out'),
+                                  do_intl=False, cache=cache, stats=stats,
+                                  folder=self.folder))
+                self.assertEqual(stats['removed_bytes'], 76)
+            self.assertEqual(self.folder.stats(), (6, 6, 228))
+        finally:
+            shutil.rmtree(tmp)
+
 class TestGettextIntl(unittest.TestCase):
     def test_add_simple(self):
         self.assertEqual(add_intl("this is a\nlame test"),
@@ -186,6 +806,37 @@ class TestGettextIntl(unittest.TestCase):
         res = "<script>blah blah\ntest value\n\t</script>"
         self.assertEqual(add_intl(html), res)
 
+    def test_attributes(self):
+        # title and alt are translated unless they hold markup or code
+        html = '<p>Pick <option title="Best choice" value="a">A</option>\n' \
+            + '<area alt="x = y" title="Go"></p>'
+        res = '<p>${ _("Pick") } <option title="${ _("Best choice") }" ' \
+            + 'value="a">${ _("A") }</option>\n' \
+            + '<area alt="x = y" title="${ _("Go") }"></p>'
+        self.assertEqual(add_intl(html), res)
+
+    def test_pattern_order(self):
+        # Earlier patterns win even when a later one starts first
+        html = '<!-- <script>x</script> --><b>Hi &nbsp;there</b>'
+        res = '${ _("<!--") } <script>x</script> ${ _("-->") }' \
+            + '<b>${ _("Hi") } &nbsp;${ _("there") }</b>'
+        self.assertEqual(add_intl(html), res)
+
+    def test_wrap_text(self):
+        self.assertEqual(wrap_text('/>'), '/>')
+        self.assertEqual(wrap_text(' ( '), ' ( ')
+        self.assertEqual(wrap_text(' (Hello) '), ' (${ _("Hello") }) ')
+        self.assertEqual(wrap_text('(:)'), '(:)')
+        self.assertEqual(wrap_text('  Hi  '), ' ${ _(" Hi ") } ')
+
+    def test_existing_gettext(self):
+        # Wrapping the template already had is kept as it is
+        html = '<a title="${ _("(") }">(Hi) ${ _("there") }\n' \
+            + '<input title="${ _(" Go ") }">${_("x")}'
+        res = '<a title="${ _("(") }">(${ _("Hi") }) ${ _("there") }\n' \
+            + '<input title="${ _(" Go ") }">${_("x")}'
+        self.assertEqual(add_intl(html), res)
+
     def test_if_tag(self):
         html = '<div id="test" class="\"\n% if mg.signup:' \
             + '\n"container_signup\"\n%endif">'
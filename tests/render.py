@@ -1,11 +1,37 @@
 # Copyright (c) 2014 Eventbrite, Inc. All rights reserved.
 # See "LICENSE" file for license.
 
+"""Renders converted templates, to check that Mako can run them.
+
+    python render.py [--hdf=<file.hdf>] [--module-dir=<dir>] <template>
+    python render.py --bulk [-j <jobs>] [--report=<file.json>]
+                     [--module-dir=<dir>] <converted dir>
+
+With --hdf the template is rendered with the values of that .hdf file,
+otherwise with TestContext, which has a value for every name. Templates
+are compiled through a TemplateRuntime, so with --module-dir the compiled
+modules are kept, and only changed templates are compiled on the next run.
+
+--bulk renders every template of a converted tree with TestContext, over
+-j processes, and prints the failures and the slowest templates. The exit
+code is 1 if any template failed. --report writes the compile time, render
+time, output size and error of every template as JSON.
+
+"""
+import json
+import multiprocessing
+import os
 import sys
+import timeit
+from getopt import GetoptError
+from getopt import gnu_getopt
 from StringIO import StringIO
 
 from mako.runtime import Context
-from mako.template import Template
+
+sys.path[0] = os.path.join(sys.path[0], '..', 'src')
+from cs2mako.runtime import TemplateRuntime
+from hdf_emulator import Hdf
 
 class TestValue():
     def __init__(self, name):
@@ -19,30 +45,182 @@ class TestValue():
 
     def __call__(self, *args):
         # Take args, convert the values to strings and join with commas
-        arg_string = reduce(lambda x, y: "%s, %s" % (str(x), str(y)), args)
+        arg_string = ', '.join(str(arg) for arg in args)
         return TestValue("%s(%s)" % (self.name, arg_string))
 
     def __nonzero__(self):
         return 1
 
+    def __iter__(self):
+        # each: loops run once
+        return iter([TestValue("%s[0]" % self.name)])
+
+    # set: tags do arithmetic
+    def __add__(self, other):
+        return TestValue("%s + %s" % (self.name, other))
+
+    def __radd__(self, other):
+        return TestValue("%s + %s" % (other, self.name))
+
+    def __sub__(self, other):
+        return TestValue("%s - %s" % (self.name, other))
+
+    def __rsub__(self, other):
+        return TestValue("%s - %s" % (other, self.name))
+
     def __getattr__(self, attr_name):
+        if attr_name.startswith('__'):
+            # Like __coerce__, which Python looks up on old-style classes
+            raise AttributeError(attr_name)
         return TestValue("%s.%s" % (self.name, attr_name))
 
 class TestContext(Context):
     def get(self, key, default=None):
         return TestValue("*****%s" % key)
 
+    def _copy(self):
+        # Defs and includes render with a copy, which Context makes a plain
+        # Context
+        context = Context._copy(self)
+        context.__class__ = TestContext
+        return context
+
+
+# The TemplateRuntime of each worker process, by (directory, module dir)
+runtimes = {}
+
+
+def render_file(job):
+    """Compiles and renders one template with TestContext. This is the unit
+    of work handed to the pool.
+
+    job -- A (directory, name, module_directory) tuple.
+
+    returns a dict of the template name, compile and render times in
+    seconds, output size in characters, and error, which is None on
+    success or a message. Rendering includes compiling any template it
+    includes that the process has not loaded yet.
+    """
+    directory, name, module_directory = job
+    runtime = runtimes.get((directory, module_directory))
+    if runtime is None:
+        runtime = runtimes[directory, module_directory] = TemplateRuntime(
+            [directory], module_directory)
+    result = {'template': name, 'compile_seconds': None,
+              'render_seconds': None, 'size': None, 'error': None}
+    timer = timeit.default_timer
+    phase = 'compile'
+    try:
+        start = timer()
+        template = runtime.get_template(name)
+        result['compile_seconds'] = timer() - start
+        phase = 'render'
+        buf = StringIO()
+        start = timer()
+        template.render_context(TestContext(buf))
+        result['render_seconds'] = timer() - start
+        result['size'] = len(buf.getvalue())
+    except Exception, e:
+        result['error'] = "%s: %s: %s" % (phase, e.__class__.__name__, e)
+    return result
+
+
+def render_tree(directory, jobs=1, module_directory=None):
+    """Renders every template under directory, see render_file.
+
+    Yields the result of each template as it finishes, in no particular
+    order when jobs > 1.
+    """
+    work = [(directory, name, module_directory)
+            for name in TemplateRuntime([directory]).templates()]
+    if jobs <= 1 or len(work) <= 1:
+        for job in work:
+            yield render_file(job)
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        chunksize = max(1, len(work) // (jobs * 4))
+        for result in pool.imap_unordered(render_file, work, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def summarize(results):
+    """Returns the totals of a list of render_file results"""
+    done = [result for result in results if result['error'] is None]
+    return {
+        'templates': len(results),
+        'failed': len(results) - len(done),
+        'compile_seconds': sum(result['compile_seconds'] for result in done),
+        'render_seconds': sum(result['render_seconds'] for result in done),
+        'size': sum(result['size'] for result in done),
+    }
+
+
+def bulk_render(directory, jobs, module_directory, report):
+    """Renders a whole tree and prints how it went. Returns the exit code."""
+    start = timeit.default_timer()
+    results = sorted(render_tree(directory, jobs, module_directory),
+                     key=lambda result: result['template'])
+    summary = summarize(results)
+    summary['seconds'] = timeit.default_timer() - start
+    for result in results:
+        if result['error'] is not None:
+            print "FAILED  %s: %s" % (result['template'], result['error'])
+    done = [result for result in results if result['error'] is None]
+    for key in ('compile_seconds', 'render_seconds'):
+        print "slowest by %s:" % key
+        for result in sorted(done, key=lambda result: -result[key])[:5]:
+            print "  %8.2f msec  %s" % (1000 * result[key],
+                                       result['template'])
+    print ("%(templates)d templates, %(failed)d failed, "
+           "%(compile_seconds).2f sec compiling, "
+           "%(render_seconds).2f sec rendering, %(size)d characters, "
+           "%(seconds).2f sec in all" % summary)
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump({'directory': directory, 'jobs': jobs,
+                       'summary': summary, 'templates': results},
+                      f, indent=1, sort_keys=True)
+    return 1 if summary['failed'] else 0
+
 
 def test_render():
-    if len(sys.argv) < 2:
+    try:
+        opts, args = gnu_getopt(sys.argv[1:], 'j:', [
+            'hdf=', 'module-dir=', 'bulk', 'report='])
+    except GetoptError, goe:
+        print str(goe)
+        sys.exit(2)
+    if len(args) < 1:
         print "Missing filename"
         sys.exit(2)
+    opts = dict(opts)
+
+    if '--bulk' in opts:
+        try:
+            jobs = int(opts.get('-j', 1))
+        except ValueError:
+            print "-j takes a number of processes."
+            sys.exit(2)
+        sys.exit(bulk_render(args[0], jobs, opts.get('--module-dir'),
+                             opts.get('--report')))
 
-    template = Template(filename=sys.argv[1])
-    buf = StringIO()
-    ctx = TestContext(buf)
-    template.render_context(ctx)
-    print buf.getvalue()
+    directory, name = os.path.split(os.path.abspath(args[0]))
+    runtime = TemplateRuntime([directory], opts.get('--module-dir'))
+    if '--hdf' in opts:
+        hdf = Hdf()
+        hdf.read_file(opts['--hdf'])
+        print runtime.render(name, hdf)
+    else:
+        buf = StringIO()
+        runtime.get_template(name).render_context(TestContext(buf))
+        print buf.getvalue()
 
     sys.exit(0)
 